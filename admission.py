@@ -0,0 +1,149 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+ADMISSION_REJECTED = metrics.counter(
+    'fitness_admission_rejected_total', 'Записи, отклонённые до бронирования: overload — очередь процесса '
+    'заполнена, queue — в очереди занятия больше запросов, чем мест, rate — превышен темп записи на занятие, '
+    'lane — не дождались свободного исполнителя', ('reason',))
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    'fitness_admission_wait_seconds', 'Ожидание в очереди записи до начала бронирования')
+
+
+# Запрос на запись отклонён до бронирования; retry_after — через сколько
+# секунд имеет смысл повторить
+class Rejected(Exception):
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Ведро токенов в виде GCRA: вместо счётчика токенов хранится теоретическое
+# время следующего запроса, поэтому ожидание известно сразу, без опроса
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.next_at = 0.0
+
+    # Сколько ждать токена (0 — можно сразу); None — дольше max_wait, токен не выдан
+    def reserve(self, now, max_wait):
+        next_at = max(self.next_at, now)
+        wait = next_at - self.tolerance - now
+        if wait > max_wait:
+            return None
+        self.next_at = next_at + self.interval
+        return max(0.0, wait)
+
+
+# Очередь записи на одно занятие: waiting — ждут токена или исполнителя,
+# pending — все допущенные, включая уже бронирующих место
+class ClassGate:
+    __slots__ = ('waiting', 'pending', 'bucket')
+
+    def __init__(self, rate, burst):
+        self.waiting = 0
+        self.pending = 0
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+
+
+# Допуск запросов на запись при ажиотаже. Запрос сразу получает отказ, если:
+# - в процессе уже max_pending записей (ждущих и выполняемых);
+# - ждущих в очереди занятия не меньше, чем осталось мест: лишние всё
+#   равно получили бы «мест нет», незачем держать их в очереди (уже
+#   забронированные места в seats_left не входят, поэтому бронирующие
+#   запросы в этом сравнении не участвуют);
+# - токена на это занятие (rate в секунду, запас burst) пришлось бы ждать
+#   дольше max_wait.
+# Остальные ждут своего токена и одного из workers исполнителей записи.
+# Чтение в этой очереди не участвует, поэтому при ажиотаже ему остаются
+# свободные потоки и процессор.
+class AdmissionController:
+    def __init__(self, rate=200.0, burst=50, max_wait=1.0, max_pending=256, workers=8):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self._lane = threading.BoundedSemaphore(workers)
+        self._gates = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _reject(self, reason, retry_after=1):
+        ADMISSION_REJECTED.inc(reason)
+        raise Rejected(reason, retry_after)
+
+    def _enter_lane(self, deadline):
+        if not self._lane.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._reject('lane')
+
+    # Допуск записи на занятие class_id; seats_left — функция, возвращающая
+    # число свободных мест. Если мест уже нет, запрос пропускается без очереди:
+    # бронирование отклонит его сразу.
+    @contextmanager
+    def admit(self, class_id, seats_left):
+        with self._lock:
+            left = seats_left()
+            if left <= 0:
+                gate = None
+            else:
+                if self._pending >= self.max_pending:
+                    self._reject('overload')
+                gate = self._gates.get(class_id)
+                if gate is None:
+                    gate = self._gates[class_id] = ClassGate(self.rate, self.burst)
+                if gate.waiting >= left:
+                    self._reject('queue')
+                now = time.monotonic()
+                wait = 0.0
+                if gate.bucket is not None:
+                    wait = gate.bucket.reserve(now, self.max_wait)
+                    if wait is None:
+                        self._reject('rate', max(1, math.ceil(gate.bucket.next_at - gate.bucket.tolerance - now)))
+                gate.waiting += 1
+                gate.pending += 1
+                self._pending += 1
+        if gate is None:
+            yield
+            return
+        try:
+            began = time.monotonic()
+            try:
+                if wait:
+                    time.sleep(wait)
+                self._enter_lane(began + self.max_wait)
+            finally:
+                with self._lock:
+                    gate.waiting -= 1
+            ADMISSION_WAIT_SECONDS.observe(time.monotonic() - began)
+            try:
+                yield
+            finally:
+                self._lane.release()
+        finally:
+            with self._lock:
+                gate.pending -= 1
+                self._pending -= 1
+                if gate.pending == 0 and (gate.bucket is None or gate.bucket.next_at <= time.monotonic()):
+                    del self._gates[class_id]
+
+    # Допуск без очереди занятия (пакетная запись): только общий лимит и исполнитель
+    @contextmanager
+    def lane(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._reject('overload')
+            self._pending += 1
+        try:
+            self._enter_lane(time.monotonic() + self.max_wait)
+            try:
+                yield
+            finally:
+                self._lane.release()
+        finally:
+            with self._lock:
+                self._pending -= 1
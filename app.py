@@ -1,430 +1,610 @@
-from flask import Flask, jsonify, request, abort, render_template_string
-from datetime import datetime, timezone
+from flask import Flask, Response, g, jsonify, request, abort, stream_with_context
+from werkzeug.exceptions import HTTPException
+from datetime import datetime, timedelta, timezone
+from contextlib import nullcontext
+import atexit
+import heapq
+import itertools
 import json
+import logging
 import os
+import time
+import metrics
+from logs import configure_logging
+from schedule_store import ScheduleStore, ClassNotFound, ClassFull, datetime_key
+from shared_counters import SharedCounters
+from storage import AlreadyRegistered, FileStorage, SqliteStorage
+from journal import ScheduleWatcher
+from cold_archive import ArchiveWorker, ColdArchive
+from occupancy import OccupancyStats
+from admission import AdmissionController, Rejected
+from recurrence import InvalidRule, Recurrence, RecurringSchedule, start_key, today
+from http_cache import AssetBundle, EncodedBody, VersionedCache, IMMUTABLE_CACHE_CONTROL, encoded_response
 
 app = Flask(__name__)
 
-# Абсолютные пути к файлам
+# Журнал буферизуется и пишется фоновым потоком. FITNESS_LOG_LEVEL:
+# DEBUG (в том числе каждая регистрация), INFO (по умолчанию), WARNING, ERROR, OFF
+LOG_LEVEL = os.environ.get('FITNESS_LOG_LEVEL', 'INFO')
+configure_logging(LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+# Метрики для GET /metrics
+REQUEST_SECONDS = metrics.histogram(
+    'fitness_http_request_duration_seconds', 'Время обработки запроса', ('route', 'method'))
+REQUESTS = metrics.counter(
+    'fitness_http_requests_total', 'Запросы по маршрутам и кодам ответа', ('route', 'method', 'status'))
+SEATS_RESERVED = metrics.counter(
+    'fitness_seats_reserved_total', 'Места, занятые сохранёнными регистрациями')
+SEATS_REJECTED = metrics.counter(
+    'fitness_seats_rejected_total', 'Отклонённые записи: full — нет мест, not_found — нет занятия, '
+    'duplicate — участник уже записан', ('reason',))
+SCHEDULE_RELOADS = metrics.counter(
+    'fitness_schedule_reloads_total', 'Применённые правки schedule.json, сделанные вручную')
+
+# Абсолютные пути к файлам (каталог данных можно переопределить через FITNESS_DATA_DIR)
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-SCHEDULE_FILE = os.path.join(BASE_DIR, 'schedule.json')
-USERS_FILE = os.path.join(BASE_DIR, 'users.txt')
-
-# Загрузка расписания из файла или инициализация по умолчанию
+DATA_DIR = os.path.abspath(os.environ.get('FITNESS_DATA_DIR', BASE_DIR))
+SCHEDULE_FILE = os.path.join(DATA_DIR, 'schedule.json')
+USERS_FILE = os.path.join(DATA_DIR, 'users.txt')
+TEMPLATES_FILE = os.path.join(DATA_DIR, 'templates.json')
+OCCUPANCY_FILE = os.path.join(DATA_DIR, 'occupancy.json')
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+
+# Хранилище данных: 'files' — schedule.json и users.txt (по умолчанию),
+# 'sqlite' — встроенная база SQLite с индексами и транзакциями
+STORAGE_BACKEND = os.environ.get('FITNESS_STORAGE', 'files')
+SQLITE_FILE = os.environ.get('FITNESS_SQLITE_FILE', os.path.join(DATA_DIR, 'fitness.db'))
+SQLITE_SYNCHRONOUS = os.environ.get('FITNESS_SQLITE_SYNCHRONOUS', 'FULL')
+
+# Режим хранения расписания: 'journal' — изменения дописываются в журнал
+# и периодически сжимаются в снимок, 'snapshot' — полная перезапись schedule.json
+PERSISTENCE_MODE = os.environ.get('FITNESS_PERSISTENCE', 'journal')
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get('FITNESS_JOURNAL_COMPACT_THRESHOLD', '1000'))
+
+# Режим нескольких процессов (например, gunicorn -w 4): счётчики мест и ID
+# хранятся в общем файле, отображённом в память, новые занятия пишутся
+# в общий журнал, а снимок schedule.json сохраняет только один процесс.
+# Нужен только файловому хранилищу: SQLite сам разделяет данные между процессами.
+SHARED_STATE = os.environ.get('FITNESS_SHARED_STATE') == '1' and STORAGE_BACKEND == 'files'
+COUNTERS_FILE = os.path.join(DATA_DIR, 'schedule.counters')
+SNAPSHOT_INTERVAL = float(os.environ.get('FITNESS_SNAPSHOT_INTERVAL', '5'))
+
+counters = SharedCounters(COUNTERS_FILE) if SHARED_STATE else None
+
+# Размер страницы GET /api/registrations по умолчанию и максимальный
+REGISTRATIONS_PAGE_SIZE = 100
+REGISTRATIONS_MAX_PAGE_SIZE = 1000
+
+# Перенос прошедших занятий вместе с их регистрациями в сжатый архив
+# (каталог archive/): занятия, начавшиеся больше FITNESS_ARCHIVE_AFTER_DAYS
+# дней назад, переносятся раз в FITNESS_ARCHIVE_INTERVAL секунд. 0 — выключено.
+ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive')
+ARCHIVE_AFTER_DAYS = float(os.environ.get('FITNESS_ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_INTERVAL = float(os.environ.get('FITNESS_ARCHIVE_INTERVAL', '3600'))
+
+archive = ColdArchive(ARCHIVE_DIR)
+
+# Правка schedule.json вручную без перезапуска: раз в FITNESS_RELOAD_INTERVAL
+# секунд сверяются inode, время изменения и размер файла, и только если они
+# другие, файл перечитывается. 0 — выключено. Только для файлового хранилища
+# без FITNESS_SHARED_STATE.
+RELOAD_INTERVAL = float(os.environ.get('FITNESS_RELOAD_INTERVAL', '2'))
+
+# Повторения шаблонов, которые попадают в полное расписание (GET /api/schedule
+# без фильтров): от начала текущих суток на столько дней вперёд
+RECURRING_HORIZON_DAYS = int(os.environ.get('FITNESS_RECURRING_HORIZON_DAYS', '28'))
+
+# Наибольшее число повторений шаблонов в ответе на запрос с from/to: более
+# широкий интервал отклоняется с 400, а не собирается целиком в памяти
+RECURRING_MAX_OCCURRENCES = int(os.environ.get('FITNESS_RECURRING_MAX_OCCURRENCES', '5000'))
+
+# Сколько секунд GET /api/stats ждёт пересчёта аналитики (при первом запуске
+# или после переноса в архив), прежде чем ответить 503
+STATS_WAIT = float(os.environ.get('FITNESS_STATS_WAIT', '5'))
+
+# Наибольшее число элементов в пакетных запросах
+BATCH_MAX_SIZE = int(os.environ.get('FITNESS_BATCH_MAX_SIZE', '1000'))
+
+# Допуск записей при ажиотаже (см. AdmissionController): темп записи на одно
+# занятие (в секунду, 0 — без ограничения) и запас, сколько секунд запрос может
+# ждать своей очереди, сколько записей процесс держит одновременно (ждущих
+# и выполняемых) и сколько из них выполняется. По умолчанию выключен
+# (FITNESS_ADMISSION=1 — включить): исполнителей записи не больше
+# ADMISSION_WORKERS, и пакет групповой записи users.txt не набирает больше
+# регистраций.
+ADMISSION_ENABLED = os.environ.get('FITNESS_ADMISSION', '0') != '0'
+ADMISSION_RATE = float(os.environ.get('FITNESS_ADMISSION_RATE', '200'))
+ADMISSION_BURST = int(os.environ.get('FITNESS_ADMISSION_BURST', '50'))
+ADMISSION_MAX_WAIT = float(os.environ.get('FITNESS_ADMISSION_MAX_WAIT', '1.0'))
+ADMISSION_MAX_PENDING = int(os.environ.get('FITNESS_ADMISSION_MAX_PENDING', '256'))
+ADMISSION_WORKERS = int(os.environ.get('FITNESS_ADMISSION_WORKERS', '8'))
+
+admission = AdmissionController(rate=ADMISSION_RATE, burst=ADMISSION_BURST, max_wait=ADMISSION_MAX_WAIT,
+                                max_pending=ADMISSION_MAX_PENDING,
+                                workers=ADMISSION_WORKERS) if ADMISSION_ENABLED else None
+
+# Групповая запись users.txt: размер пакета, максимальное ожидание
+# добора пакета (секунды) и длина очереди
+USERS_BATCH_SIZE = int(os.environ.get('FITNESS_USERS_BATCH_SIZE', '64'))
+USERS_FLUSH_INTERVAL = float(os.environ.get('FITNESS_USERS_FLUSH_INTERVAL', '0.001'))
+USERS_QUEUE_SIZE = int(os.environ.get('FITNESS_USERS_QUEUE_SIZE', '10000'))
+
+if STORAGE_BACKEND == 'sqlite':
+    # Пустая база при первом запуске заполняется из schedule.json и users.txt
+    storage = SqliteStorage(SQLITE_FILE, synchronous=SQLITE_SYNCHRONOUS, legacy_files=(SCHEDULE_FILE, USERS_FILE, TEMPLATES_FILE),
+                            archive=archive)
+elif STORAGE_BACKEND == 'files':
+    storage = FileStorage(SCHEDULE_FILE, USERS_FILE, persistence_mode=PERSISTENCE_MODE,
+                          compact_threshold=JOURNAL_COMPACT_THRESHOLD, counters=counters,
+                          snapshot_interval=SNAPSHOT_INTERVAL, batch_size=USERS_BATCH_SIZE,
+                          flush_interval=USERS_FLUSH_INTERVAL, queue_size=USERS_QUEUE_SIZE,
+                          schedule_source=lambda: store.all(), archive=archive, templates_file=TEMPLATES_FILE)
+else:
+    raise ValueError(f"Неизвестное хранилище FITNESS_STORAGE={STORAGE_BACKEND!r}: ожидается 'files' или 'sqlite'.")
+atexit.register(storage.close)
+
+# Загрузка расписания из хранилища или инициализация по умолчанию
 def load_schedule():
-    if os.path.exists(SCHEDULE_FILE):
-        with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
-            try:
-                schedule = json.load(f)
-                print(f"Загружено расписание из {SCHEDULE_FILE}.")
-                return schedule
-            except json.JSONDecodeError:
-                print("Ошибка при загрузке schedule.json. Используется расписание по умолчанию.")
-                return []
-    else:
-        default_schedule = [
-            {
-                "id": 1,
-                "name": "Йога",
-                "instructor": "Анна Иванова",
-                "datetime": "2024-05-01T10:00:00",
-                "capacity": 20,
-                "registered": 15
-            },
-            {
-                "id": 2,
-                "name": "Пилатес",
-                "instructor": "Игорь Смирнов",
-                "datetime": "2024-05-01T12:00:00",
-                "capacity": 15,
-                "registered": 10
-            },
-            {
-                "id": 3,
-                "name": "Кардио",
-                "instructor": "Мария Петрова",
-                "datetime": "2024-05-01T14:00:00",
-                "capacity": 25,
-                "registered": 20
-            }
-        ]
-        save_schedule(default_schedule)
-        print(f"Создано стандартное расписание в {SCHEDULE_FILE}.")
-        return default_schedule
-
-# Сохранение расписания в файл
+    schedule = storage.load_schedule()
+    if schedule is not None:
+        return schedule
+    default_schedule = [
+        {
+            "id": 1,
+            "name": "Йога",
+            "instructor": "Анна Иванова",
+            "datetime": "2024-05-01T10:00:00",
+            "capacity": 20,
+            "registered": 15
+        },
+        {
+            "id": 2,
+            "name": "Пилатес",
+            "instructor": "Игорь Смирнов",
+            "datetime": "2024-05-01T12:00:00",
+            "capacity": 15,
+            "registered": 10
+        },
+        {
+            "id": 3,
+            "name": "Кардио",
+            "instructor": "Мария Петрова",
+            "datetime": "2024-05-01T14:00:00",
+            "capacity": 25,
+            "registered": 20
+        }
+    ]
+    save_schedule(default_schedule)
+    log.info("Создано стандартное расписание.")
+    return default_schedule
+
+# Сохранение расписания целиком (в файле — атомарно, через временный файл)
 def save_schedule(schedule):
     try:
-        with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(schedule, f, ensure_ascii=False, indent=4)
-        print(f"Расписание сохранено в {SCHEDULE_FILE}.")
+        storage.save_schedule(schedule)
+        log.info("Расписание сохранено.")
     except Exception as e:
-        print(f"Ошибка при сохранении расписания: {e}")
+        log.error("Ошибка при сохранении расписания: %s", e)
 
 # Загрузка расписания при старте
-classes_schedule = load_schedule()
-
-# Список записей на тренировки (будет загружаться из users.txt)
-registrations = []
-
-# Загрузка регистраций из users.txt
-def load_registrations():
-    registrations = []
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    registration = json.loads(line.strip())
-                    registrations.append(registration)
-                except json.JSONDecodeError:
-                    print("Некорректная строка в users.txt, пропущена.")
-                    continue
-        print(f"Загружено {len(registrations)} регистраций из {USERS_FILE}.")
+store = ScheduleStore(load_schedule(), counters=counters)
+
+# Шаблоны повторяющихся занятий: повторения порождаются по запросу,
+# в расписании хранятся только те, на которые уже записывались
+recurring = RecurringSchedule(storage.load_templates())
+
+metrics.gauge('fitness_classes', 'Занятия в расписании', lambda: len(store))
+metrics.gauge('fitness_recurring_templates', 'Шаблоны повторяющихся занятий', lambda: len(recurring))
+metrics.gauge('fitness_registrations', 'Сохранённые регистрации', lambda: storage.registration_count())
+if isinstance(storage, FileStorage):
+    metrics.gauge('fitness_users_queue_depth', 'Записи в очереди групповой записи users.txt',
+                  lambda: storage.users_writer.stats()['queued'])
+
+# Записи на тренировки: у файлового хранилища в памяти только индекс
+# смещений users.txt (users.txt.idx), записи читаются с диска по запросу
+storage.load_registrations()
+
+# Общие счётчики: первый воркер заполняет их из файлов, остальные берут готовые
+if counters is not None:
+    if not counters.seed(store.all(), storage.next_registration_id()):
+        store.refresh_counters()
+    storage.start_snapshot_writer()
+elif STORAGE_BACKEND == 'files' and os.path.exists(COUNTERS_FILE):
+    # Счётчики, оставшиеся от работы в режиме нескольких процессов, точнее снимка
+    leftover = SharedCounters(COUNTERS_FILE)
+    if leftover.initialized():
+        for fitness_class in store.all():
+            fitness_class['registered'] = leftover.get(fitness_class['id'])
+        save_schedule(store.all())
+    leftover.close()
+    os.remove(COUNTERS_FILE)
+
+# Аналитика заполняемости (GET /api/stats): итоги нарастающим итогом,
+# сохраняются в occupancy.json при остановке
+occupancy = OccupancyStats(OCCUPANCY_FILE, store.all, storage.query_registrations).start()
+atexit.register(occupancy.save)
+
+# Версия общего состояния, до которой синхронизирован этот процесс
+synced_version = None
+
+# Замечены ли изменения от других процессов: тогда версии ленты изменений
+# у процессов расходятся и дельта-синхронизация отдаёт полный снимок
+shared_writers_seen = counters is not None
+
+# Подтягивание занятий и счётчиков, изменённых другими воркерами. Без общих
+# счётчиков (SQLite) из хранилища читаются только изменённые занятия и те,
+# чей счётчик не был сверен из-за идущей в этом процессе записи.
+def sync_shared_state():
+    global synced_version, shared_writers_seen
+    if counters is None:
+        changed = storage.changed_externally()
+        stale = store.stale_counters()
+        if changed:
+            shared_writers_seen = True
+        if changed or stale:
+            classes, removed_ids = storage.read_changes(stale)
+            store.sync_from(classes, removed_ids)
+            occupancy.forget(removed_ids)
+            occupancy.track([store.get(fitness_class['id']) for fitness_class in classes
+                             if fitness_class['id'] in store])
+        if changed:
+            sync_templates()
+        return
+    if storage.templates_changed():
+        sync_templates()
+    version = counters.version()
+    if version == synced_version:
+        return
+    if counters.next_class_id() > store.next_id:
+        store.merge(storage.read_schedule())
+        occupancy.sync()
+    store.refresh_counters()
+    # Запись о новом занятии могла ещё не попасть в журнал — тогда повторим позже
+    if counters.next_class_id() <= store.next_id:
+        synced_version = version
+
+# Шаблоны, добавленные другими процессами
+def sync_templates():
+    templates = storage.load_templates()
+    if templates != recurring.all():
+        recurring.replace(templates)
+        store.reset_changes()
+
+# Граница архива: занятия, начавшиеся раньше неё, переносятся в архив (None — выключено)
+def archive_cutoff():
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return None
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+# Перенос прошедших занятий в архив. Сначала занятия убираются из памяти,
+# чтобы на них больше не записывались, затем хранилище переносит их вместе
+# с регистрациями. Занятия с некорректной датой не переносятся. Позиции
+# регистраций при этом сдвигаются, поэтому аналитика пересчитывается заново.
+def archive_past_classes():
+    cutoff = archive_cutoff()
+    if cutoff is None:
+        return 0
+    past = [c for c in store.between(None, cutoff) if datetime_key(c['datetime']) != datetime.min]
+    if not past:
+        return 0
+    store.remove([fitness_class['id'] for fitness_class in past])
+    occupancy.suspend()
+    try:
+        archived, registrations_count = storage.archive_classes(past)
+    except Exception:
+        store.merge(past)
+        raise
+    finally:
+        occupancy.rebuild()
+    log.info("В архив перенесено занятий: %s, регистраций: %s.", len(archived), registrations_count)
+    return len(archived)
+
+# Архивирование в режиме общих счётчиков не поддерживается: users.txt
+# дописывают несколько процессов и перезаписать его безопасно нельзя
+if ARCHIVE_AFTER_DAYS > 0:
+    if counters is not None:
+        log.warning("Перенос занятий в архив недоступен в режиме FITNESS_SHARED_STATE.")
     else:
-        print(f"{USERS_FILE} не существует. Создаётся новый файл.")
-    return registrations
-
-registrations = load_registrations()
+        archive_worker = ArchiveWorker(archive_past_classes, ARCHIVE_INTERVAL).start()
+
+# Применение правки schedule.json: расписание с диска (снимок + журнал)
+# сравнивается с памятью по ID занятий. Новые занятия добавляются, удалённые
+# из файла убираются, у остальных меняются поля и вместимость; счётчики
+# registered остаются живыми и, если в файле другие, записываются в журнал.
+def reload_schedule_file():
+    edited = storage.read_edited_schedule()
+    if edited is None:
+        return None
+    schedule, removed_ids = edited
+    added, removed, changed = store.apply_edits(schedule, removed_ids)
+    stale = []
+    for fitness_class in schedule:
+        current = store.get(fitness_class['id'])
+        if current is not None and current['registered'] != fitness_class.get('registered', 0):
+            stale.append(current)
+    storage.record_counters(stale)
+    occupancy.sync()
+    SCHEDULE_RELOADS.inc()
+    log.info("Расписание перечитано из %s: добавлено %s, удалено %s, изменено %s.",
+             SCHEDULE_FILE, added, removed, changed)
+    return added, removed, changed
+
+if RELOAD_INTERVAL > 0 and STORAGE_BACKEND == 'files':
+    if counters is not None:
+        log.info("Перечитывание правленого schedule.json недоступно в режиме FITNESS_SHARED_STATE.")
+    else:
+        schedule_watcher = ScheduleWatcher(reload_schedule_file, RELOAD_INTERVAL).start()
+        # Правка, не дождавшаяся проверки, применяется перед перезаписью снимка
+        storage.apply_edit = reload_schedule_file
+
+# Начало горизонта повторений, на котором построено текущее расписание
+horizon_start = None
+
+# Горизонт повторений для полного расписания: [начало суток, + RECURRING_HORIZON_DAYS).
+# С наступлением новых суток меняется и состав повторений, поэтому версия
+# расписания сбрасывается — клиенты с since получат полный снимок.
+def recurring_horizon():
+    global horizon_start
+    start = today()
+    if start != horizon_start:
+        horizon_start = start
+        if len(recurring):
+            store.reset_changes()
+    return start, start + timedelta(days=RECURRING_HORIZON_DAYS)
+
+# Повторения шаблонов в интервале [start, end), для которых ещё нет своего
+# занятия. Повторения раньше границы архива не показываются: их занятия
+# могли уже уйти в архив.
+def pending_occurrences(start, end, instructor=None):
+    cutoff = archive_cutoff()
+    if cutoff is not None and (start is None or start < cutoff):
+        start = cutoff
+    for occurrence in recurring.occurrences(start, end, instructor):
+        if store.find_occurrence(occurrence['occurrence_id']) is None:
+            yield occurrence
+
+# Всё расписание: занятия и повторения шаблонов до горизонта
+def full_schedule():
+    if not len(recurring):
+        return store.all()
+    return store.all() + list(pending_occurrences(*recurring_horizon()))
+
+# Занятия в интервале [start, end) по времени вместе с повторениями шаблонов.
+# Без end повторения берутся на RECURRING_HORIZON_DAYS дней от start (или от сегодня).
+# Повторений больше RECURRING_MAX_OCCURRENCES — 400: интервал нужно сузить.
+def schedule_window(start, end, instructor=None):
+    classes = [c for c in store.between(start, end) if instructor is None or c['instructor'] == instructor]
+    if not len(recurring):
+        return classes
+    occurrences_end = end if end is not None else (start or today()) + timedelta(days=RECURRING_HORIZON_DAYS)
+    occurrences = list(itertools.islice(pending_occurrences(start, occurrences_end, instructor),
+                                        RECURRING_MAX_OCCURRENCES + 1))
+    if len(occurrences) > RECURRING_MAX_OCCURRENCES:
+        abort(400, description=f"Слишком широкий интервал: больше {RECURRING_MAX_OCCURRENCES} повторений "
+                               "шаблонов. Сузьте 'from' и 'to'.")
+    return list(heapq.merge(classes, occurrences, key=start_key))
+
+# ID занятия из запроса: целое число или ID повторения шаблона (строка).
+# Логические, дробные и составные значения не подходят: 2.0 и True иначе
+# нашлись бы в словаре занятий как 2 и 1.
+def is_class_id(value):
+    return isinstance(value, (int, str)) and not isinstance(value, bool)
+
+# ID занятия для записи. Повторение шаблона (ID вида "<ID шаблона>@<время>")
+# при первой записи становится обычным занятием со своим счётчиком мест.
+def resolve_class_id(class_id):
+    if not is_class_id(class_id):
+        SEATS_REJECTED.inc('not_found')
+        abort(404, description="Занятие не найдено.")
+    if not isinstance(class_id, str):
+        return class_id
+    fitness_class = store.find_occurrence(class_id)
+    if fitness_class is None:
+        with recurring.lock:
+            fitness_class = store.find_occurrence(class_id) or materialize_occurrence(class_id)
+    return fitness_class['id']
+
+# Создание занятия из повторения (под recurring.lock)
+def materialize_occurrence(occurrence_id):
+    # Занятие могло быть создано другим процессом
+    sync_shared_state()
+    fitness_class = store.find_occurrence(occurrence_id)
+    if fitness_class is not None:
+        return fitness_class
+    occurrence = recurring.occurrence(occurrence_id)
+    if occurrence is None:
+        SEATS_REJECTED.inc('not_found')
+        abort(404, description="Занятие не найдено.")
+    fitness_class = store.add({key: value for key, value in occurrence.items() if key != 'id'})
+    try:
+        existing = storage.add_occurrence(fitness_class)
+    except Exception as e:
+        store.remove([fitness_class['id']])
+        log.error("Ошибка при сохранении занятия из шаблона: %s", e)
+        abort(500, description="Ошибка при сохранении данных.")
+    if existing is not None:
+        # Другой процесс успел раньше: остаётся его занятие
+        store.remove([fitness_class['id']])
+        store.merge([existing])
+        fitness_class = store.get(existing['id'])
+    occupancy.track([fitness_class])
+    return fitness_class
+
+# Занятие или ещё не созданное повторение (без бронирования и создания занятия)
+def find_class(class_id):
+    if not is_class_id(class_id):
+        return None
+    if isinstance(class_id, int):
+        return store.get(class_id)
+    return store.find_occurrence(class_id) or recurring.occurrence(class_id)
+
+# Допуск запроса записи на занятие: очередь занятия и общий лимит записей.
+# Отказ (Rejected) превращается в 429 обработчиком ошибок. Некорректные
+# запросы и неизвестные занятия пропускаются — их отклонит проверка запроса.
+# Очередь повторения общая для записей по его ID и по ID созданного занятия.
+def admission_gate(data):
+    if admission is None or not isinstance(data, dict) or 'class_id' not in data:
+        return nullcontext()
+    class_id = data['class_id']
+    fitness_class = find_class(class_id)
+    if fitness_class is None:
+        return nullcontext()
+
+    def seats_left():
+        current = find_class(class_id)
+        return current['capacity'] - current['registered'] if current is not None else 0
+
+    return admission.admit(fitness_class.get('occurrence_id', fitness_class['id']), seats_left)
+
+# Бронирование места в памяти с переводом ошибок хранилища в HTTP-ответы
+def reserve_seat(class_id):
+    try:
+        try:
+            fitness_class = store.reserve(class_id)
+        except ClassNotFound:
+            # Занятие могло быть добавлено другим воркером
+            sync_shared_state()
+            fitness_class = store.reserve(class_id)
+    except ClassNotFound:
+        SEATS_REJECTED.inc('not_found')
+        abort(404, description="Занятие не найдено.")
+    except ClassFull:
+        SEATS_REJECTED.inc('full')
+        abort(400, description="Места на занятие закончились.")
+    return fitness_class
+
+# Возврат места, если регистрацию не удалось сохранить или её отклонило
+# хранилище; сохраняется и счётчик, иначе журнал остался бы с занятым местом
+def release_seat(class_id):
+    fitness_class = store.release(class_id)
+    if fitness_class is not None:
+        storage.record_registered(fitness_class, -1)
+
+# Сохранение регистрации вместе с занятым местом; ID регистрации выдаёт хранилище.
+# Ответ — только после того, как запись надёжно сохранена.
+def save_registration(registration, fitness_class):
+    try:
+        storage.add_registration(registration, fitness_class)
+    except ClassFull:
+        # Места заняли другие процессы
+        release_seat(registration['class_id'])
+        sync_shared_state()
+        SEATS_REJECTED.inc('full')
+        abort(400, description="Места на занятие закончились.")
+    except AlreadyRegistered:
+        # Такая же запись успела сохраниться раньше
+        release_seat(registration['class_id'])
+        SEATS_REJECTED.inc('duplicate')
+        abort(409, description="Участник с этим телефоном уже записан на занятие.")
+    except Exception as e:
+        # Возврат места, если не удалось сохранить
+        release_seat(registration['class_id'])
+        log.error("Ошибка при сохранении регистрации: %s", e)
+        abort(500, description="Ошибка при сохранении данных.")
+    store.confirm(registration['class_id'])
+    SEATS_RESERVED.inc()
+    occupancy.refresh(wait=False)
+    log.debug("Регистрация сохранена: %s", registration)
+
+# Страница собирается один раз при старте: CSS и JS отдаются с хэшем содержимого
+# в имени, index.html отрисовывается заранее и отдаётся готовыми байтами
+assets = AssetBundle(STATIC_DIR)
+with open(os.path.join(STATIC_DIR, 'index.html'), 'r', encoding='utf-8') as f:
+    index_html = app.jinja_env.from_string(f.read()).render(app_css=assets.add('app.css'), app_js=assets.add('app.js'))
+index_page = EncodedBody(index_html.encode('utf-8'), use_brotli=True)
 
 @app.route('/')
 def index():
-    return render_template_string("""
-    <!DOCTYPE html>
-    <html lang="ru">
-    <head>
-        <meta charset="UTF-8">
-        <title>Фитнес-Зал</title>
-        <!-- Bootstrap CSS -->
-        <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
-        <!-- Bootstrap Icons -->
-        <link href="https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/bootstrap-icons.css" rel="stylesheet">
-        <style>
-            body {
-                background-color: #f8f9fa;
-            }
-            .container {
-                margin-top: 50px;
-                margin-bottom: 50px;
-            }
-            .class-card:hover {
-                box-shadow: 0 4px 8px rgba(0,0,0,0.2);
-                transition: 0.3s;
-            }
-            .modal-header {
-                background-color: #0d6efd;
-                color: white;
-            }
-            .btn-custom {
-                transition: transform 0.2s;
-            }
-            .btn-custom:hover {
-                transform: scale(1.05);
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1 class="text-center mb-4">Расписание Занятий</h1>
-            <div id="schedule" class="row row-cols-1 row-cols-md-2 g-4"></div>
-            <div class="text-center mt-4">
-                <button id="add-schedule-button" class="btn btn-primary btn-lg btn-custom">
-                    <i class="bi bi-plus-circle"></i> Добавить Расписание
-                </button>
-            </div>
-        </div>
-    
-        <!-- Форма регистрации -->
-        <div id="registration-form" class="modal fade" tabindex="-1" aria-labelledby="registrationModalLabel" aria-hidden="true">
-            <div class="modal-dialog">
-                <div class="modal-content">
-                    <div class="modal-header">
-                        <h5 class="modal-title" id="registrationModalLabel">Оформить Регистрацию</h5>
-                        <button type="button" class="btn-close btn-close-white" data-bs-dismiss="modal" aria-label="Закрыть"></button>
-                    </div>
-                    <div class="modal-body">
-                        <form id="form">
-                            <input type="hidden" id="class_id" name="class_id">
-                            <div class="mb-3">
-                                <label for="user_name" class="form-label">Имя</label>
-                                <input type="text" class="form-control" id="user_name" name="user_name" required>
-                            </div>
-                            <div class="mb-3">
-                                <label for="phone_number" class="form-label">Номер Телефона</label>
-                                <input type="tel" class="form-control" id="phone_number" name="phone_number" required pattern="\+?\d{10,15}" placeholder="+79876543210">
-                                <div class="form-text">Формат: +1234567890</div>
-                            </div>
-                            <button type="submit" class="btn btn-success btn-custom">
-                                <i class="bi bi-check-circle"></i> Зарегистрироваться
-                            </button>
-                        </form>
-                        <div id="form-message" class="mt-3"></div>
-                    </div>
-                </div>
-            </div>
-        </div>
-    
-        <!-- Форма добавления расписания -->
-        <div id="add-schedule-form" class="modal fade" tabindex="-1" aria-labelledby="addScheduleModalLabel" aria-hidden="true">
-            <div class="modal-dialog">
-                <div class="modal-content">
-                    <div class="modal-header">
-                        <h5 class="modal-title" id="addScheduleModalLabel">Добавить Новое Занятие</h5>
-                        <button type="button" class="btn-close btn-close-white" data-bs-dismiss="modal" aria-label="Закрыть"></button>
-                    </div>
-                    <div class="modal-body">
-                        <form id="add-schedule">
-                            <div class="mb-3">
-                                <label for="name" class="form-label">Название Занятия</label>
-                                <input type="text" class="form-control" id="name" name="name" required>
-                            </div>
-                            <div class="mb-3">
-                                <label for="instructor" class="form-label">Инструктор</label>
-                                <input type="text" class="form-control" id="instructor" name="instructor" required>
-                            </div>
-                            <div class="mb-3">
-                                <label for="datetime" class="form-label">Дата и Время</label>
-                                <input type="datetime-local" class="form-control" id="datetime" name="datetime" required>
-                            </div>
-                            <div class="mb-3">
-                                <label for="capacity" class="form-label">Вместимость</label>
-                                <input type="number" class="form-control" id="capacity" name="capacity" min="1" required>
-                            </div>
-                            <button type="submit" class="btn btn-primary btn-custom">
-                                <i class="bi bi-plus-circle"></i> Добавить Занятие
-                            </button>
-                        </form>
-                        <div id="add-schedule-message" class="mt-3"></div>
-                    </div>
-                </div>
-            </div>
-        </div>
-    
-        <!-- Bootstrap JS and dependencies -->
-        <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-        <script>
-            document.addEventListener('DOMContentLoaded', function() {
-                const scheduleDiv = document.getElementById('schedule');
-                const registrationModal = new bootstrap.Modal(document.getElementById('registration-form'));
-                const addScheduleModal = new bootstrap.Modal(document.getElementById('add-schedule-form'));
-                const form = document.getElementById('form');
-                const formMessage = document.getElementById('form-message');
-                const addScheduleButton = document.getElementById('add-schedule-button');
-                const addScheduleForm = document.getElementById('add-schedule');
-                const addScheduleMessage = document.getElementById('add-schedule-message');
-            
-                // Функция для загрузки расписания
-                function loadSchedule() {
-                    fetch('/api/schedule')
-                        .then(response => response.json())
-                        .then(data => {
-                            scheduleDiv.innerHTML = ''; // Очистить текущие карточки
-                            data.forEach(cls => {
-                                const col = document.createElement('div');
-                                col.className = 'col';
-                
-                                const card = document.createElement('div');
-                                card.className = 'card h-100';
-                
-                                const cardBody = document.createElement('div');
-                                cardBody.className = 'card-body';
-                
-                                const cardTitle = document.createElement('h5');
-                                cardTitle.className = 'card-title';
-                                cardTitle.textContent = cls.name;
-                
-                                const instructor = document.createElement('p');
-                                instructor.className = 'card-text';
-                                instructor.innerHTML = `<strong>Инструктор:</strong> ${cls.instructor}`;
-                
-                                const datetime = document.createElement('p');
-                                datetime.className = 'card-text';
-                                const date = new Date(cls.datetime);
-                                datetime.innerHTML = `<strong>Дата и Время:</strong> ${date.toLocaleString()}`;
-                
-                                const capacity = document.createElement('p');
-                                capacity.className = 'card-text';
-                                capacity.innerHTML = `<strong>Вместимость:</strong> ${cls.capacity}`;
-                
-                                const registered = document.createElement('p');
-                                registered.className = 'card-text';
-                                registered.innerHTML = `<strong>Зарегистрировано:</strong> ${cls.registered}`;
-                
-                                cardBody.appendChild(cardTitle);
-                                cardBody.appendChild(instructor);
-                                cardBody.appendChild(datetime);
-                                cardBody.appendChild(capacity);
-                                cardBody.appendChild(registered);
-                
-                                const cardFooter = document.createElement('div');
-                                cardFooter.className = 'card-footer text-center';
-                
-                                const button = document.createElement('button');
-                                button.className = 'btn btn-success btn-custom';
-                                button.innerHTML = '<i class="bi bi-person-plus-fill"></i> Оформить';
-                                button.onclick = () => openRegistrationModal(cls.id);
-                
-                                cardFooter.appendChild(button);
-                
-                                card.appendChild(cardBody);
-                                card.appendChild(cardFooter);
-                
-                                col.appendChild(card);
-                                scheduleDiv.appendChild(col);
-                            });
-                        })
-                        .catch(error => {
-                            console.error('Ошибка при загрузке расписания:', error);
-                            scheduleDiv.innerHTML = '<p>Не удалось загрузить расписание.</p>';
-                        });
-                }
-            
-                loadSchedule(); // Загрузить расписание при загрузке страницы
-            
-                // Функция открытия модального окна регистрации
-                function openRegistrationModal(class_id) {
-                    document.getElementById('class_id').value = class_id;
-                    formMessage.innerHTML = '';
-                    form.reset();
-                    registrationModal.show();
-                }
-            
-                // Функция открытия модального окна добавления расписания
-                function openAddScheduleModal() {
-                    addScheduleMessage.innerHTML = '';
-                    addScheduleForm.reset();
-                    addScheduleModal.show();
-                }
-            
-                // Обработчик кнопки добавления расписания
-                addScheduleButton.addEventListener('click', openAddScheduleModal);
-            
-                // Обработка отправки формы регистрации
-                form.addEventListener('submit', function(e) {
-                    e.preventDefault();
-            
-                    const class_id = document.getElementById('class_id').value;
-                    const user_name = document.getElementById('user_name').value.trim();
-                    const phone_number = document.getElementById('phone_number').value.trim();
-            
-                    // Простая валидация
-                    if (!user_name || !phone_number) {
-                        formMessage.innerHTML = '<div class="alert alert-danger" role="alert">Пожалуйста, заполните все поля.</div>';
-                        return;
-                    }
-            
-                    // Отправка данных на сервер
-                    fetch('/api/register_web', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({ class_id: parseInt(class_id), user_name, phone_number })
-                    })
-                    .then(response => response.json().then(data => ({status: response.status, body: data})))
-                    .then(result => {
-                        if (result.status === 201) {
-                            formMessage.innerHTML = '<div class="alert alert-success" role="alert">Регистрация прошла успешно!</div>';
-                            // Обновить расписание
-                            setTimeout(() => {
-                                registrationModal.hide();
-                                loadSchedule();
-                            }, 1500);
-                        } else {
-                            formMessage.innerHTML = `<div class="alert alert-danger" role="alert">${result.body.message || 'Ошибка при регистрации.'}</div>`;
-                        }
-                    })
-                    .catch(error => {
-                        console.error('Ошибка при регистрации:', error);
-                        formMessage.innerHTML = '<div class="alert alert-danger" role="alert">Произошла ошибка. Пожалуйста, попробуйте позже.</div>';
-                    });
-                });
-            
-                // Обработка отправки формы добавления расписания
-                addScheduleForm.addEventListener('submit', function(e) {
-                    e.preventDefault();
-            
-                    const name = document.getElementById('name').value.trim();
-                    const instructor = document.getElementById('instructor').value.trim();
-                    const datetime = document.getElementById('datetime').value;
-                    const capacity = parseInt(document.getElementById('capacity').value);
-            
-                    // Простая валидация
-                    if (!name || !instructor || !datetime || !capacity) {
-                        addScheduleMessage.innerHTML = '<div class="alert alert-danger" role="alert">Пожалуйста, заполните все поля.</div>';
-                        return;
-                    }
-            
-                    // Преобразование datetime в ISO формат
-                    const datetimeISO = new Date(datetime).toISOString();
-            
-                    // Отправка данных на сервер
-                    fetch('/api/schedule', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({ name, instructor, datetime: datetimeISO, capacity })
-                    })
-                    .then(response => response.json().then(data => ({status: response.status, body: data})))
-                    .then(result => {
-                        if (result.status === 201) {
-                            addScheduleMessage.innerHTML = '<div class="alert alert-success" role="alert">Занятие успешно добавлено!</div>';
-                            // Обновить расписание
-                            setTimeout(() => {
-                                addScheduleModal.hide();
-                                loadSchedule();
-                            }, 1500);
-                        } else {
-                            addScheduleMessage.innerHTML = `<div class="alert alert-danger" role="alert">${result.body.message || 'Ошибка при добавлении занятия.'}</div>`;
-                        }
-                    })
-                    .catch(error => {
-                        console.error('Ошибка при добавлении занятия:', error);
-                        addScheduleMessage.innerHTML = '<div class="alert alert-danger" role="alert">Произошла ошибка. Пожалуйста, попробуйте позже.</div>';
-                    });
-                });
-            });
-        </script>
-    </body>
-    </html>
-    """, classes_schedule=classes_schedule)
-
-# Получение расписания
+    return encoded_response(index_page, 'text/html')
+
+# Статика с хэшем в имени кэшируется у клиента навсегда
+@app.route('/assets/<name>')
+def asset(name):
+    found = assets.get(name)
+    if found is None:
+        abort(404, description="Файл не найден.")
+    encoded, mimetype = found
+    return encoded_response(encoded, mimetype, cache_control=IMMUTABLE_CACHE_CONTROL)
+
+# Закодированный ответ GET /api/schedule для текущей версии хранилища
+schedule_cache = VersionedCache()
+
+# Закодированный ответ GET /api/stats для текущей версии итогов
+stats_cache = VersionedCache()
+
+# Получение расписания: тело собирается и сжимается один раз на версию данных,
+# повторные запросы с тем же ETag получают 304. Версия данных передаётся
+# в заголовке X-Schedule-Version.
+# С параметром since=<версия> возвращаются только занятия, изменённые после неё:
+# {"version": N, "full": false, "classes": [...]}; если лента изменений уже не
+# помнит эту версию — всё расписание с "full": true.
+# Фильтры: from/to — время начала занятия (ISO, интервал [from, to)), выбирается
+# двоичным поиском по индексу дат; instructor — имя инструктора. С фильтрами
+# занятия отдаются в порядке времени.
+# Повторения шаблонов, на которые ещё не записывались, отдаются со строковым
+# ID вида "<ID шаблона>@<время>": с фильтрами — в запрошенном интервале,
+# без них — на RECURRING_HORIZON_DAYS дней от начала текущих суток.
 @app.route('/api/schedule', methods=['GET'])
 def get_schedule():
-    return jsonify(classes_schedule), 200
-
-# Добавление нового занятия
-@app.route('/api/schedule', methods=['POST'])
-def add_schedule():
-    if not request.json:
+    sync_shared_state()
+    recurring_horizon()
+    since = int_arg('since')
+    time_from = datetime_arg('from')
+    time_to = datetime_arg('to')
+    instructor = request.args.get('instructor')
+    filtered = time_from is not None or time_to is not None or instructor is not None
+
+    def selected(fitness_class):
+        start = datetime_key(fitness_class['datetime'])
+        return ((time_from is None or start >= time_from) and (time_to is None or start < time_to)
+                and (instructor is None or fitness_class['instructor'] == instructor))
+
+    if since is not None:
+        # В режиме нескольких процессов версии у воркеров свои, поэтому всегда полный снимок
+        version, changed = store.changes_since(since) if not shared_writers_seen else (store.version, None)
+        if changed is None:
+            classes = schedule_window(time_from, time_to, instructor) if filtered else full_schedule()
+            return jsonify({"version": version, "full": True, "classes": classes}), 200
+        if filtered:
+            changed = [c for c in changed if selected(c)]
+        return jsonify({"version": version, "full": False, "classes": changed}), 200
+
+    version = store.version
+    if filtered:
+        response = jsonify(schedule_window(time_from, time_to, instructor))
+        response.headers['X-Schedule-Version'] = str(version)
+        return response
+
+    encoded = schedule_cache.get(version, lambda: app.json.dumps(full_schedule()).encode('utf-8'))
+    return encoded_response(encoded, 'application/json', headers={'X-Schedule-Version': str(version)})
+
+# Проверка полей нового занятия; возвращает поля или прерывает запрос с 400
+def class_fields(data):
+    if not data or not isinstance(data, dict):
         abort(400, description="Некорректный запрос. Требуется JSON с полями 'name', 'instructor', 'datetime', 'capacity'.")
 
     required_fields = ['name', 'instructor', 'datetime', 'capacity']
     for field in required_fields:
-        if field not in request.json:
+        if field not in data:
             abort(400, description=f"Отсутствует поле '{field}'.")
 
-    name = request.json['name']
-    instructor = request.json['instructor']
-    datetime_str = request.json['datetime']
-    capacity = request.json['capacity']
+    name = data['name']
+    instructor = data['instructor']
+    datetime_str = data['datetime']
+    capacity = data['capacity']
 
     # Валидация данных
     try:
         # Проверка формата даты и времени
-        datetime_obj = datetime.fromisoformat(datetime_str.replace('Z', ''))
-    except ValueError:
+        datetime.fromisoformat(datetime_str.replace('Z', ''))
+    except (AttributeError, ValueError):
         abort(400, description="Некорректный формат 'datetime'. Используйте ISO формат, например '2024-05-01T10:00:00'.")
-    
+
     if not isinstance(capacity, int) or capacity <= 0:
         abort(400, description="'capacity' должно быть положительным целым числом.")
 
-    # Генерация нового ID
-    new_id = max([cls['id'] for cls in classes_schedule], default=0) + 1
-
-    new_class = {
-        "id": new_id,
+    return {
         "name": name,
         "instructor": instructor,
         "datetime": datetime_str,
@@ -432,93 +612,322 @@ def add_schedule():
         "registered": 0
     }
 
-    classes_schedule.append(new_class)
-    save_schedule(classes_schedule)
+# Добавление нового занятия
+@app.route('/api/schedule', methods=['POST'])
+def add_schedule():
+    # Новый ID выдаёт хранилище
+    new_class = store.add(class_fields(request.json))
+    storage.add_class(new_class)
+    occupancy.track([new_class])
 
     return jsonify(new_class), 201
 
+# Элементы пакетного запроса: непустой JSON-массив не длиннее BATCH_MAX_SIZE
+def batch_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        abort(400, description="Некорректный запрос. Требуется непустой JSON-массив.")
+    if len(items) > BATCH_MAX_SIZE:
+        abort(400, description=f"В пакете не больше {BATCH_MAX_SIZE} элементов.")
+    return items
+
+# Результат элемента пакета с ошибкой — как ответ одиночного запроса
+def batch_error(error):
+    return {"status": error.code, "message": error.description}
+
+# Пакетное добавление занятий: каждый элемент проверяется отдельно,
+# корректные занятия сохраняются одной записью.
+# Ответ: {"created": N, "results": [{"status": 201, "class": {...}} | {"status": 400, "message": ...}]}
+@app.route('/api/schedule/batch', methods=['POST'])
+def add_schedule_batch():
+    results = []
+    new_classes = []
+    for data in batch_items():
+        try:
+            fields = class_fields(data)
+        except HTTPException as e:
+            results.append(batch_error(e))
+            continue
+        new_class = store.add(fields)
+        new_classes.append(new_class)
+        results.append({"status": 201, "class": new_class})
+    if new_classes:
+        storage.add_classes(new_classes)
+        occupancy.track(new_classes)
+    return jsonify({"created": len(new_classes), "results": results}), 200
+
+# Шаблоны повторяющихся занятий
+@app.route('/api/templates', methods=['GET'])
+def get_templates():
+    return jsonify(recurring.all()), 200
+
+# Добавление шаблона: поля занятия (datetime — первое повторение) и правило
+# rrule, например "FREQ=WEEKLY;BYDAY=MO;UNTIL=20261231". Повторения
+# не сохраняются: они появляются в расписании по запросу.
+@app.route('/api/templates', methods=['POST'])
+def add_template():
+    fields = class_fields(request.json)
+    rrule = request.json.get('rrule')
+    if not isinstance(rrule, str):
+        abort(400, description="Отсутствует поле 'rrule'.")
+    try:
+        Recurrence(fields['datetime'], rrule)
+    except InvalidRule as e:
+        abort(400, description=f"Некорректное правило 'rrule': {e}")
+    del fields['registered']
+    template = storage.add_template({**fields, "rrule": rrule})
+    recurring.add(template)
+    store.reset_changes()
+    return jsonify(template), 201
+
 # Регистрация через API (существующий эндпоинт)
 @app.route('/api/register', methods=['POST'])
 def register_class():
+    with admission_gate(request.json):
+        return create_registration()
+
+def create_registration():
     if not request.json or 'class_id' not in request.json or 'user_name' not in request.json:
         abort(400, description="Некорректный запрос. Требуются 'class_id' и 'user_name'.")
 
-    class_id = request.json['class_id']
+    class_id = resolve_class_id(request.json['class_id'])
     user_name = request.json['user_name']
 
-    # Поиск занятия по ID
-    fitness_class = next((cls for cls in classes_schedule if cls['id'] == class_id), None)
-    if not fitness_class:
-        abort(404, description="Занятие не найдено.")
-
-    if fitness_class['registered'] >= fitness_class['capacity']:
-        abort(400, description="Места на занятие закончились.")
+    # Поиск занятия и бронирование места одним шагом
+    fitness_class = reserve_seat(class_id)
 
     # Создание записи
     registration = {
-        "registration_id": len(registrations) + 1,
+        "registration_id": None,
         "class_id": class_id,
         "user_name": user_name,
         "registration_time": datetime.now(timezone.utc).isoformat()
     }
-    registrations.append(registration)
-
-    # Обновление количества зарегистрированных
-    fitness_class['registered'] += 1
-    save_schedule(classes_schedule)
+    save_registration(registration, fitness_class)
 
     return jsonify(registration), 201
 
-# Регистрация через веб-интерфейс
-@app.route('/api/register_web', methods=['POST'])
-def register_web():
-    if not request.json or 'class_id' not in request.json or 'user_name' not in request.json or 'phone_number' not in request.json:
+# Проверка запроса регистрации через веб-интерфейс и бронирование места;
+# возвращает (регистрация без ID, занятие) или прерывает запрос.
+# claimed — пары (занятие, телефон), уже принятые в этом пакете
+def web_registration(data, claimed=None):
+    if not data or not isinstance(data, dict) or 'class_id' not in data or 'user_name' not in data or 'phone_number' not in data:
         abort(400, description="Некорректный запрос. Требуются 'class_id', 'user_name' и 'phone_number'.")
 
-    class_id = request.json['class_id']
-    user_name = request.json['user_name']
-    phone_number = request.json['phone_number']
+    if not isinstance(data['user_name'], str):
+        abort(400, description="'user_name' должен быть строкой.")
+    if not isinstance(data['phone_number'], str):
+        abort(400, description="'phone_number' должен быть строкой.")
 
-    # Поиск занятия по ID
-    fitness_class = next((cls for cls in classes_schedule if cls['id'] == class_id), None)
-    if not fitness_class:
-        abort(404, description="Занятие не найдено.")
+    class_id = resolve_class_id(data['class_id'])
 
-    if fitness_class['registered'] >= fitness_class['capacity']:
-        abort(400, description="Места на занятие закончились.")
+    # Повторная запись по индексу участников, до бронирования места
+    # (окончательная проверка — при сохранении)
+    claim = (class_id, data['phone_number'])
+    if storage.has_registration(*claim) or (claimed is not None and claim in claimed):
+        SEATS_REJECTED.inc('duplicate')
+        abort(409, description="Участник с этим телефоном уже записан на занятие.")
 
-    # Обновление количества зарегистрированных
-    fitness_class['registered'] += 1
-    save_schedule(classes_schedule)
+    # Поиск занятия и бронирование места одним шагом
+    fitness_class = reserve_seat(class_id)
+    if claimed is not None:
+        claimed.add(claim)
 
     # Создание записи
     registration = {
-        "registration_id": len(registrations) + 1,
+        "registration_id": None,
         "class_id": class_id,
-        "user_name": user_name,
-        "phone_number": phone_number,
+        "user_name": data['user_name'],
+        "phone_number": data['phone_number'],
         "registration_time": datetime.now(timezone.utc).isoformat()
     }
-    registrations.append(registration)
+    return registration, fitness_class
 
-    # Сохранение в users.txt
-    try:
-        with open(USERS_FILE, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(registration, ensure_ascii=False) + '\n')
-        print(f"Регистрация записана в {USERS_FILE}: {registration}")
-    except Exception as e:
-        # Отмена изменения зарегистрированных, если не удалось сохранить
-        fitness_class['registered'] -= 1
-        save_schedule(classes_schedule)
-        print(f"Ошибка при сохранении в users.txt: {e}")
-        abort(500, description="Ошибка при сохранении данных.")
+# Регистрация через веб-интерфейс
+@app.route('/api/register_web', methods=['POST'])
+def register_web():
+    with admission_gate(request.json):
+        registration, fitness_class = web_registration(request.json)
+
+        save_registration(registration, fitness_class)
 
     return jsonify({"message": "Регистрация успешна!"}), 201
 
-# Получение всех регистраций
+# Пакетная регистрация (киоски, интеграции): места бронируются за один проход,
+# все принятые записи сохраняются одной записью в хранилище. Результат
+# у каждого элемента свой, некорректный элемент не мешает остальным.
+# Ответ: {"registered": N, "results": [{"status": 201, "registration": {...}} | {"status": 4xx/500, "message": ...}]}
+@app.route('/api/register_web/batch', methods=['POST'])
+def register_web_batch():
+    # Пакет занимает одного исполнителя записи, без очередей отдельных занятий
+    with admission.lane() if admission is not None else nullcontext():
+        return save_registration_batch()
+
+def save_registration_batch():
+    results = []
+    accepted = []
+    # Повтор внутри пакета отклоняется до бронирования места
+    claimed = set()
+    for data in batch_items():
+        try:
+            registration, fitness_class = web_registration(data, claimed)
+        except HTTPException as e:
+            results.append(batch_error(e))
+            continue
+        except Exception as e:
+            # Сбой на элементе (место для него ещё не занято) — ошибка только этого
+            # элемента: места, уже занятые для остальных, сохраняются как обычно
+            log.error("Ошибка при проверке элемента пакета регистраций: %s", e)
+            results.append({"status": 500, "message": "Ошибка при обработке данных."})
+            continue
+        accepted.append((len(results), registration, fitness_class))
+        results.append(None)
+    if not accepted:
+        return jsonify({"registered": 0, "results": results}), 200
+
+    try:
+        outcomes = storage.add_registrations([(registration, fitness_class) for _, registration, fitness_class in accepted])
+    except Exception as e:
+        # Пакет не сохранён: возвращаем все места
+        log.error("Ошибка при сохранении пакета регистраций: %s", e)
+        for index, registration, _ in accepted:
+            release_seat(registration['class_id'])
+            results[index] = {"status": 500, "message": "Ошибка при сохранении данных."}
+        return jsonify({"registered": 0, "results": results}), 200
+
+    registered = 0
+    full = False
+    for (index, registration, _), outcome in zip(accepted, outcomes):
+        if isinstance(outcome, ClassFull):
+            # Места заняли другие процессы
+            release_seat(registration['class_id'])
+            SEATS_REJECTED.inc('full')
+            results[index] = {"status": 400, "message": "Места на занятие закончились."}
+            full = True
+        elif isinstance(outcome, AlreadyRegistered):
+            # Запись, сохранённая параллельно
+            release_seat(registration['class_id'])
+            SEATS_REJECTED.inc('duplicate')
+            results[index] = {"status": 409, "message": "Участник с этим телефоном уже записан на занятие."}
+        else:
+            store.confirm(registration['class_id'])
+            registered += 1
+            results[index] = {"status": 201, "registration": registration}
+    if full:
+        sync_shared_state()
+    SEATS_RESERVED.inc(amount=registered)
+    occupancy.refresh(wait=False)
+    log.debug("Пакет регистраций сохранён: %s из %s.", registered, len(results))
+    return jsonify({"registered": registered, "results": results}), 200
+
+# Записи участника по номеру телефона (по индексу участников, без просмотра
+# всех регистраций). Номер передаётся в пути, '+' можно закодировать как %2B.
+@app.route('/api/members/<phone_number>/registrations', methods=['GET'])
+def get_member_registrations(phone_number):
+    return jsonify({"phone_number": phone_number, "registrations": storage.member_registrations(phone_number)}), 200
+
+# Целочисленный параметр запроса (None, если не задан)
+def int_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, description=f"Параметр '{name}' должен быть целым числом.")
+
+# Параметр запроса с датой и временем в ISO формате
+def datetime_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        abort(400, description=f"Некорректный формат '{name}'. Используйте ISO формат, например '2024-05-01T10:00:00'.")
+    return datetime_key(value)
+
+# Получение регистраций.
+# Без параметров — весь список, как раньше (для небольших установок).
+# С параметрами — страница: class_id, phone_number, from/to (время регистрации),
+# limit и cursor (значение next_cursor из предыдущего ответа).
+# format=ndjson — потоковая выдача по строке на запись прямо из хранилища.
 @app.route('/api/registrations', methods=['GET'])
 def get_registrations():
-    return jsonify(registrations), 200
+    if not request.args:
+        return jsonify(list(storage.iter_registrations())), 200
+
+    cursor = int_arg('cursor') or 0
+    limit = int_arg('limit')
+    if cursor < 0 or (limit is not None and limit <= 0):
+        abort(400, description="'cursor' и 'limit' должны быть положительными.")
+    rows = storage.query_registrations(cursor, class_id=int_arg('class_id'),
+                                       phone_number=request.args.get('phone_number'),
+                                       time_from=datetime_arg('from'), time_to=datetime_arg('to'))
+
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(stream_registrations(rows, limit)),
+                        mimetype='application/x-ndjson'), 200
+
+    limit = min(limit or REGISTRATIONS_PAGE_SIZE, REGISTRATIONS_MAX_PAGE_SIZE)
+    page = []
+    next_cursor = None
+    for position, line in rows:
+        page.append(json.loads(line))
+        if len(page) == limit:
+            next_cursor = position + 1
+            break
+    return jsonify({"registrations": page, "next_cursor": next_cursor}), 200
+
+# Генератор NDJSON: записи отдаются как есть, без сборки ответа в памяти
+def stream_registrations(rows, limit):
+    sent = 0
+    for _, line in rows:
+        yield line + b'\n'
+        sent += 1
+        if limit is not None and sent >= limit:
+            return
+
+# Аналитика заполняемости: итоги и доля занятых мест (fill_rate) в целом,
+# по инструкторам (by_instructor), названиям (by_name) и дням недели
+# (by_weekday, MO..SU); sold_out — заполненные занятия. booking_curve — сколько
+# регистраций сделано не позже чем за hours_before_start часов до начала
+# занятия и какой была к этому моменту заполняемость; sell_out_curve — сколько
+# занятий к этому моменту уже заполнились. registrations сходится со счётчиками
+# registered расписания: места без записей (стандартное расписание, перенос
+# данных) входят в итоги, но не в кривые. Ответ собирается из итогов,
+# которые обновляются при каждой записи, и не зависит от объёма истории;
+# закодированный ответ кэшируется до следующего изменения итогов.
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    sync_shared_state()
+    if not occupancy.wait(STATS_WAIT):
+        response = jsonify({"error": "Service Unavailable", "message": "Аналитика пересчитывается. Попробуйте позже."})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    occupancy.refresh()
+    encoded = stats_cache.get(occupancy.version, lambda: app.json.dumps(occupancy.snapshot()).encode('utf-8'))
+    return encoded_response(encoded, 'application/json')
+
+# Время и код ответа каждого запроса по шаблону маршрута (не по пути,
+# чтобы число рядов метрик не зависело от ID в адресах)
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, str(response.status_code))
+    return response
+
+# Метрики процесса в текстовом формате Prometheus
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 # Обработка ошибок
 @app.errorhandler(400)
@@ -529,22 +938,59 @@ def bad_request(error):
 def not_found(error):
     return jsonify({"error": "Not Found", "message": error.description}), 404
 
+@app.errorhandler(409)
+def conflict(error):
+    return jsonify({"error": "Conflict", "message": error.description}), 409
+
+# Отказ в допуске записи: повторить через Retry-After секунд
+ADMISSION_MESSAGES = {
+    'queue': "На оставшиеся места уже стоит очередь. Попробуйте позже.",
+    'rate': "Слишком много записей на это занятие. Попробуйте позже.",
+    'overload': "Сервер перегружен записями. Попробуйте позже.",
+    'lane': "Сервер перегружен записями. Попробуйте позже."
+}
+
+@app.errorhandler(Rejected)
+def admission_rejected(error):
+    response = jsonify({"error": "Too Many Requests", "message": ADMISSION_MESSAGES[error.reason]})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
 @app.errorhandler(500)
 def server_error(error):
     return jsonify({"error": "Server Error", "message": error.description}), 500
 
+# Однократный перенос schedule.json и users.txt в базу SQLite:
+# flask --app app migrate-sqlite (база должна быть пустой)
+@app.cli.command('migrate-sqlite')
+def migrate_sqlite():
+    target = SqliteStorage(SQLITE_FILE, synchronous=SQLITE_SYNCHRONOUS)
+    try:
+        target.migrate_from_files(SCHEDULE_FILE, USERS_FILE, TEMPLATES_FILE)
+    except RuntimeError as e:
+        log.error("%s", e)
+    finally:
+        target.close()
+
+# Пересчёт аналитики заполняемости по всем регистрациям (users.txt или базы)
+# и сохранение в occupancy.json: flask --app app rebuild-stats
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    occupancy.rebuild()
+    occupancy.save()
+
 if __name__ == '__main__':
     # Убедимся, что users.txt существует
-    if not os.path.exists(USERS_FILE):
+    if STORAGE_BACKEND == 'files' and not os.path.exists(USERS_FILE):
         try:
             with open(USERS_FILE, 'w', encoding='utf-8') as f:
-                print(f"{USERS_FILE} создан.")
+                log.info("%s создан.", USERS_FILE)
         except Exception as e:
-            print(f"Не удалось создать {USERS_FILE}: {e}")
+            log.error("Не удалось создать %s: %s", USERS_FILE, e)
     
     # Убедимся, что schedule.json существует
-    if not os.path.exists(SCHEDULE_FILE):
-        save_schedule(classes_schedule)
-        print(f"{SCHEDULE_FILE} создан с начальным расписанием.")
+    if STORAGE_BACKEND == 'files' and not os.path.exists(SCHEDULE_FILE):
+        save_schedule(store.all())
+        log.info("%s создан с начальным расписанием.", SCHEDULE_FILE)
     
     app.run(debug=True)
@@ -0,0 +1,363 @@
+# Нагрузочный замер приложения на синтетических данных: запросы к настоящим
+# маршрутам (/, /api/schedule, /api/register, /api/register_web,
+# /api/registrations) через тестовый клиент Flask и через локальный
+# HTTP-сервер с многопоточным генератором нагрузки. Кроме пропускной
+# способности и задержек (p50/p95/p99) замеряются время запуска приложения
+# и load_registrations(), пиковый RSS. Результат сохраняется в JSON; с
+# --compare он сравнивается с прошлым прогоном, и при ухудшении больше
+# --tolerance скрипт завершается с кодом 1.
+#
+# Запуск: python bench/load.py [--classes 10000] [--registrations 1000000]
+#         [--threads 8] [--requests 200] [--mode client|http|both] [--storage sqlite]
+#         [--output результат.json] [--compare прошлый.json] [--tolerance 0.2]
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'bench', 'results')
+
+# Замер запуска в отдельном процессе: импорт app (загрузка расписания
+# и регистраций), затем load_registrations() на новом экземпляре хранилища
+# того же типа. Последняя строка вывода — JSON с результатами.
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+began = time.perf_counter()
+import app
+startup = time.perf_counter() - began
+from storage import FileStorage, SqliteStorage
+if isinstance(app.storage, SqliteStorage):
+    fresh = SqliteStorage(app.SQLITE_FILE)
+else:
+    fresh = FileStorage(app.SCHEDULE_FILE, app.USERS_FILE, persistence_mode='snapshot', schedule_source=list)
+began = time.perf_counter()
+count = fresh.load_registrations()
+load_registrations = time.perf_counter() - began
+fresh.close()
+print(json.dumps({
+    "startup_seconds": startup,
+    "load_registrations_seconds": load_registrations,
+    "registrations": count,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+}))
+"""
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Синтетические schedule.json и users.txt: занятия равномерно на год вперёд,
+# регистрации постоянных участников по случайным занятиям. Вместимость
+# с запасом, чтобы записи во время замера не упирались в места.
+def generate_dataset(data_dir, classes, registrations, members, headroom, seed=1):
+    rng = random.Random(seed)
+    start = datetime.combine(datetime.now(timezone.utc).date(), datetime.min.time())
+    registered = [0] * (classes + 1)
+    people = [(f"Участник {n}", f"+7900{n:07d}") for n in range(members)]
+    registered_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with open(os.path.join(data_dir, 'users.txt'), 'w', encoding='utf-8') as f:
+        for registration_id in range(1, registrations + 1):
+            class_id = rng.randrange(1, classes + 1)
+            name, phone = people[rng.randrange(members)]
+            registered[class_id] += 1
+            f.write(json.dumps({
+                "registration_id": registration_id,
+                "class_id": class_id,
+                "user_name": name,
+                "phone_number": phone,
+                "registration_time": (registered_at + timedelta(seconds=registration_id)).isoformat()
+            }, ensure_ascii=False) + '\n')
+    schedule = [{
+        "id": class_id,
+        "name": f"Занятие {class_id}",
+        "instructor": f"Инструктор {class_id % 50}",
+        "datetime": (start + timedelta(minutes=class_id * 525600 // classes)).isoformat(timespec='seconds'),
+        "capacity": registered[class_id] + headroom,
+        "registered": registered[class_id]
+    } for class_id in range(1, classes + 1)]
+    with open(os.path.join(data_dir, 'schedule.json'), 'w', encoding='utf-8') as f:
+        json.dump(schedule, f, ensure_ascii=False)
+    return people
+
+
+def measure_startup(data_dir, storage):
+    env = dict(os.environ, FITNESS_DATA_DIR=data_dir, FITNESS_STORAGE=storage)
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=REPO_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# Сценарии: имя -> функция (номер потока, номер запроса) -> (метод, путь, тело).
+# Новые записи идут с уникальными телефонами (run различает прогоны клиентом
+# и по HTTP), выборки — по существующим данным.
+def scenarios(args, people, run=0):
+    today = datetime.now(timezone.utc).date()
+
+    def class_id(thread, i):
+        return 1 + (thread * 7919 + i * 104729) % args.classes
+
+    def phone(thread, i):
+        return people[(thread * 7919 + i) % len(people)][1]
+
+    return {
+        "index": lambda thread, i: ('GET', '/', None),
+        "schedule": lambda thread, i: ('GET', '/api/schedule', None),
+        "schedule_window": lambda thread, i: (
+            'GET', f"/api/schedule?from={today + timedelta(days=i % 300)}&to={today + timedelta(days=i % 300 + 7)}", None),
+        "register": lambda thread, i: ('POST', '/api/register', {
+            "class_id": class_id(thread, i), "user_name": f"Нагрузка {thread}"}),
+        "register_web": lambda thread, i: ('POST', '/api/register_web', {
+            "class_id": class_id(thread, i), "user_name": f"Нагрузка {thread}",
+            "phone_number": f"+78{run:02d}{thread:03d}{i:06d}"}),
+        "registrations_by_class": lambda thread, i: (
+            'GET', f"/api/registrations?class_id={class_id(thread, i)}&limit=100", None),
+        "registrations_by_phone": lambda thread, i: (
+            'GET', f"/api/registrations?phone_number={phone(thread, i).replace('+', '%2B')}&limit=100", None),
+        "registrations_page": lambda thread, i: (
+            'GET', f"/api/registrations?cursor={(thread * 7919 + i * 104729) % args.registrations}&limit=100", None),
+    }
+
+
+# Запросчики: тестовый клиент Flask или HTTP-соединение (keep-alive) на поток
+def client_requester(fitness_app):
+    client = fitness_app.app.test_client()
+
+    def send(method, path, body):
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+    return send
+
+
+def http_requester(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def send(method, path, body):
+        headers = {'Accept-Encoding': 'gzip'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    return send
+
+
+# Перцентиль по ближайшему рангу, в миллисекундах
+def percentile(latencies, fraction):
+    index = max(0, math.ceil(fraction * len(latencies)) - 1)
+    return latencies[index] * 1000
+
+
+def run_scenario(make_requester, build, threads, requests):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(thread):
+        send = make_requester()
+        local_latencies = []
+        local_errors = 0
+        barrier.wait()
+        for i in range(requests):
+            method, path, body = build(thread, i)
+            began = time.perf_counter()
+            status = send(method, path, body)
+            local_latencies.append(time.perf_counter() - began)
+            if status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    began = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": latencies[-1] * 1000
+    }
+
+
+# Локальный многопоточный HTTP-сервер werkzeug с keep-alive
+def start_http_server(flask_app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, name='bench-http', daemon=True).start()
+    return server
+
+
+# Ухудшения относительно прошлого прогона: падение пропускной способности
+# или рост p95 больше чем на tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for mode, current in results['scenarios'].items():
+        for name, stats in current.items():
+            previous = baseline.get('scenarios', {}).get(mode, {}).get(name)
+            if previous is None:
+                continue
+            if stats['throughput'] < previous['throughput'] * (1 - tolerance):
+                regressions.append(f"{mode}/{name}: {stats['throughput']:.0f} запросов/с, "
+                                   f"было {previous['throughput']:.0f}")
+            if stats['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{mode}/{name}: p95 {stats['p95_ms']:.2f} мс, было {previous['p95_ms']:.2f}")
+    for run, current in results['startup'].items():
+        previous = baseline.get('startup', {}).get(run)
+        if previous is not None and current['startup_seconds'] > previous['startup_seconds'] * (1 + tolerance):
+            regressions.append(f"запуск ({run}): {current['startup_seconds']:.2f} с, "
+                               f"было {previous['startup_seconds']:.2f}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=int, default=10000)
+    parser.add_argument('--registrations', type=int, default=1000000)
+    parser.add_argument('--members', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='запросов на поток в каждом сценарии')
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='both')
+    parser.add_argument('--storage', choices=('files', 'sqlite'), default='files')
+    parser.add_argument('--scenario', action='append', help='только эти сценарии (можно несколько раз)')
+    parser.add_argument('--output', help='файл результата (по умолчанию bench/results/load-<время>.json)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='fitness-load-')
+    began = time.perf_counter()
+    people = generate_dataset(data_dir, args.classes, args.registrations, args.members,
+                              headroom=2 * args.threads * args.requests)
+    generate_seconds = time.perf_counter() - began
+    print(f"Данные: {data_dir} ({args.classes} занятий, {args.registrations} регистраций, "
+          f"{generate_seconds:.1f} с)")
+
+    # Первый запуск строит индекс users.txt.idx (у SQLite — переносит данные в базу),
+    # второй — обычный перезапуск с готовым индексом
+    startup = {}
+    for run in ('first', 'second'):
+        startup[run] = measure_startup(data_dir, args.storage)
+        print(f"Запуск ({run}): {startup[run]['startup_seconds']:.2f} с, load_registrations() "
+              f"{startup[run]['load_registrations_seconds']:.2f} с, RSS {startup[run]['peak_rss_mb']:.0f} МБ")
+
+    os.environ['FITNESS_DATA_DIR'] = data_dir
+    os.environ['FITNESS_STORAGE'] = args.storage
+    # Журнал приложения во время замера — только предупреждения и ошибки
+    os.environ.setdefault('FITNESS_LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, REPO_DIR)
+    import app as fitness_app
+
+    names = list(scenarios(args, people))
+    if args.scenario:
+        unknown = set(args.scenario) - set(names)
+        if unknown:
+            parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}; есть: {', '.join(names)}")
+        names = args.scenario
+
+    requesters = {}
+    if args.mode in ('client', 'both'):
+        requesters['client'] = lambda: client_requester(fitness_app)
+    server = None
+    if args.mode in ('http', 'both'):
+        server = start_http_server(fitness_app.app)
+        requesters['http'] = lambda: http_requester(server.server_port)
+
+    results = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args)
+        },
+        "dataset": {"classes": args.classes, "registrations": args.registrations,
+                    "members": args.members, "generate_seconds": generate_seconds},
+        "startup": startup,
+        "scenarios": {}
+    }
+    for run, (mode, make_requester) in enumerate(requesters.items()):
+        results['scenarios'][mode] = {}
+        builders = scenarios(args, people, run)
+        for name in names:
+            stats = run_scenario(make_requester, builders[name], args.threads, args.requests)
+            results['scenarios'][mode][name] = stats
+            print(f"{mode:6} {name:24} {stats['throughput']:8.0f} запросов/с  p50 {stats['p50_ms']:7.2f}  "
+                  f"p95 {stats['p95_ms']:7.2f}  p99 {stats['p99_ms']:7.2f} мс  ошибок {stats['errors']}")
+    if server is not None:
+        server.shutdown()
+    results['peak_rss_mb'] = peak_rss_mb()
+    results['storage_stats'] = fitness_app.storage.stats()
+    print(f"Пиковый RSS: {results['peak_rss_mb']:.0f} МБ")
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результат: {output}")
+
+    failed = any(stats['errors'] for current in results['scenarios'].values() for stats in current.values())
+    if failed:
+        print("Есть ответы с ошибками.")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        previous_args = baseline.get('meta', {}).get('args', {})
+        for key in ('storage', 'classes', 'registrations', 'threads'):
+            if previous_args.get(key) != getattr(args, key):
+                print(f"Внимание: {key} = {getattr(args, key)}, в {args.compare} — {previous_args.get(key)}.")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Ухудшения относительно " + args.compare + ":\n" + '\n'.join(regressions))
+            failed = True
+        else:
+            print(f"Ухудшений больше {args.tolerance:.0%} относительно {args.compare} нет.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Сравнение памяти под регистрации: список словарей (как раньше хранился
+# весь users.txt) и столбцы RegistrationColumns со смещениями строк
+# (как их держит RegistrationLog). Данные синтетические: постоянные
+# участники с повторяющимися именами и телефонами, много занятий.
+#
+# Запуск: python bench/registrations_memory.py [--count 1000000] [--members 20000]
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+from datetime import datetime, timedelta, timezone
+
+
+def generate_lines(count, members, classes, seed=1):
+    rng = random.Random(seed)
+    people = [(f"Участник {n}", f"+7900{n:07d}") for n in range(members)]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    lines = []
+    for registration_id in range(1, count + 1):
+        name, phone = people[rng.randrange(members)]
+        registered_at = start + timedelta(seconds=registration_id * 7, microseconds=rng.randrange(1000000))
+        lines.append(json.dumps({
+            "registration_id": registration_id,
+            "class_id": rng.randrange(1, classes + 1),
+            "user_name": name,
+            "phone_number": phone,
+            "registration_time": registered_at.isoformat()
+        }, ensure_ascii=False).encode('utf-8') + b'\n')
+    return lines
+
+
+# Память, которую занимает результат build(lines), и время построения
+def measure(build, lines):
+    gc.collect()
+    tracemalloc.start()
+    began = time.perf_counter()
+    result = build(lines)
+    elapsed = time.perf_counter() - began
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, used, elapsed
+
+
+def build_dicts(lines):
+    return [json.loads(line) for line in lines]
+
+
+def build_columns(lines):
+    columns = RegistrationColumns()
+    offsets = array('q')
+    offset = 0
+    for line in lines:
+        columns.append(json.loads(line))
+        offsets.append(offset)
+        offset += len(line)
+    return columns, offsets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200000)
+    parser.add_argument('--members', type=int, default=20000)
+    parser.add_argument('--classes', type=int, default=500)
+    args = parser.parse_args()
+
+    lines = generate_lines(args.count, args.members, args.classes)
+    dicts, dicts_bytes, dicts_seconds = measure(build_dicts, lines)
+    (columns, offsets), columns_bytes, columns_seconds = measure(build_columns, lines)
+
+    # Выдача: сборка словарей из столбцов против уже готовых словарей
+    began = time.perf_counter()
+    rebuilt = [columns.record(position) for position in range(len(columns))]
+    record_seconds = time.perf_counter() - began
+    if rebuilt != dicts:
+        print("Столбцы восстановили записи не в точности.")
+        sys.exit(1)
+
+    print(f"Регистраций: {args.count}, участников: {args.members}, занятий: {args.classes}")
+    print(f"Список словарей: {dicts_bytes / 2 ** 20:.1f} МБ ({dicts_bytes / args.count:.0f} байт на запись), "
+          f"построение {dicts_seconds:.2f} с")
+    print(f"Столбцы: {columns_bytes / 2 ** 20:.1f} МБ ({columns_bytes / args.count:.0f} байт на запись), "
+          f"построение {columns_seconds:.2f} с, в overflow {len(columns.overflow)}")
+    print(f"Экономия: в {dicts_bytes / columns_bytes:.1f} раза; "
+          f"сборка всех словарей для ответа {record_seconds:.2f} с")
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from registration_columns import RegistrationColumns
+    main()
@@ -0,0 +1,118 @@
+# Нагрузочная проверка бронирования: много потоков записываются на одно
+# занятие и на множество занятий одновременно, после чего проверяется,
+# что ни одно занятие не переполнено и счётчики совпадают с сохранёнными записями.
+#
+# Запуск: python bench/reservations.py [--threads 32] [--requests 2000] [--storage sqlite]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+def prepare_data_dir(hot_capacity, classes, capacity):
+    data_dir = tempfile.mkdtemp(prefix='fitness-bench-')
+    schedule = [{
+        "id": 1,
+        "name": "Горячее занятие",
+        "instructor": "Тест",
+        "datetime": "2024-05-01T10:00:00",
+        "capacity": hot_capacity,
+        "registered": 0
+    }]
+    for class_id in range(2, classes + 2):
+        schedule.append({
+            "id": class_id,
+            "name": f"Занятие {class_id}",
+            "instructor": "Тест",
+            "datetime": "2024-05-02T10:00:00",
+            "capacity": capacity,
+            "registered": 0
+        })
+    with open(os.path.join(data_dir, 'schedule.json'), 'w', encoding='utf-8') as f:
+        json.dump(schedule, f, ensure_ascii=False)
+    open(os.path.join(data_dir, 'users.txt'), 'w').close()
+    return data_dir
+
+
+# Половина запросов бьёт в одно занятие, остальные — по кругу по всем занятиям
+def pick_class(args, index, i):
+    return 1 if i % 2 == 0 else 2 + (i // 2 * args.threads + index) % args.classes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000, help='запросов на поток')
+    parser.add_argument('--hot-capacity', type=int, default=50)
+    parser.add_argument('--classes', type=int, default=200)
+    parser.add_argument('--capacity', type=int, default=10)
+    parser.add_argument('--storage', choices=('files', 'sqlite'), default='files')
+    args = parser.parse_args()
+
+    data_dir = prepare_data_dir(args.hot_capacity, args.classes, args.capacity)
+    os.environ['FITNESS_DATA_DIR'] = data_dir
+    os.environ['FITNESS_STORAGE'] = args.storage
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as fitness_app
+
+    # Частое переключение потоков, чтобы гонки проявлялись
+    sys.setswitchinterval(1e-6)
+    statuses = Counter()
+    statuses_lock = threading.Lock()
+    start = threading.Barrier(args.threads)
+
+    def worker(index):
+        client = fitness_app.app.test_client()
+        local = Counter()
+        start.wait()
+        for i in range(args.requests):
+            class_id = pick_class(args, index, i)
+            response = client.post('/api/register_web', json={
+                "class_id": class_id,
+                "user_name": f"user{index}",
+                "phone_number": f"+7900{index:03d}{i:04d}"
+            })
+            local[response.status_code] += 1
+        with statuses_lock:
+            statuses.update(local)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    written = Counter(registration['class_id'] for registration in fitness_app.storage.iter_registrations())
+
+    errors = []
+    for fitness_class in fitness_app.store.all():
+        if fitness_class['registered'] > fitness_class['capacity']:
+            errors.append(f"занятие {fitness_class['id']} переполнено: "
+                          f"{fitness_class['registered']} > {fitness_class['capacity']}")
+        if fitness_class['registered'] != written[fitness_class['id']]:
+            errors.append(f"занятие {fitness_class['id']}: счётчик {fitness_class['registered']}, "
+                          f"записей {written[fitness_class['id']]}")
+    demand = Counter(pick_class(args, index, i) for index in range(args.threads) for i in range(args.requests))
+    expected = sum(min(demand[fitness_class['id']], fitness_class['capacity'])
+                   for fitness_class in fitness_app.store.all())
+    if statuses[201] != expected:
+        errors.append(f"успешных записей {statuses[201]}, ожидалось {expected}")
+
+    total = args.threads * args.requests
+    print(f"Запросов: {total} за {elapsed:.2f} с ({total / elapsed:.0f} запросов/с), ответы: {dict(statuses)}")
+    print(f"Хранилище {args.storage}: {fitness_app.storage.stats()}")
+    print(f"Данные: {data_dir}")
+    if errors:
+        print('\n'.join(errors))
+        sys.exit(1)
+    print("Переполнений нет, счётчики совпадают с записями.")
+
+
+if __name__ == '__main__':
+    main()
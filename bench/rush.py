@@ -0,0 +1,252 @@
+# Замер «ажиотажа»: много потоков одновременно записываются через
+# /api/register_web на одно занятие, пока другие потоки читают расписание.
+# Сравниваются задержки чтения (p50/p95/p99) без записи, во время ажиотажа
+# с допуском записей (FITNESS_ADMISSION=1) и без него, а также ответы на
+# запись: 201, 400 «мест нет», 429 и прочие. Поток записи ведёт себя как
+# пользователь: после 429 ждёт Retry-After и повторяет, после «мест нет»
+# уходит. После каждого прогона
+# проверяется, что занятие не переполнено и записей сохранено столько же,
+# сколько выдано ответов 201. Сервер с каждой настройкой запускается
+# в отдельном процессе на своей копии данных.
+#
+# Запуск: python bench/rush.py [--classes 2000] [--seats 300] [--writers 64]
+#         [--writes 50] [--readers 4] [--storage sqlite] [--output результат.json]
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import REPO_DIR, RESULTS_DIR, generate_dataset, git_commit, http_requester, percentile, start_http_server
+
+HOT_CLASS_ID = 1
+
+
+# Данные: обычное расписание и одно «горячее» занятие на seats мест
+def prepare_data(args):
+    data_dir = tempfile.mkdtemp(prefix='fitness-rush-')
+    generate_dataset(data_dir, args.classes, args.registrations, members=1000, headroom=10)
+    path = os.path.join(data_dir, 'schedule.json')
+    with open(path, 'r', encoding='utf-8') as f:
+        schedule = json.load(f)
+    hot = schedule[HOT_CLASS_ID - 1]
+    hot['name'] = "Горячее занятие"
+    hot['capacity'] = hot['registered'] + args.seats
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(schedule, f, ensure_ascii=False)
+    return data_dir
+
+
+def read_latencies(port, stop, latencies, lock):
+    send = http_requester(port)
+    local = []
+    while not stop.is_set():
+        began = time.perf_counter()
+        send('GET', '/api/schedule', None)
+        local.append(time.perf_counter() - began)
+    with lock:
+        latencies.extend(local)
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": latencies[-1] * 1000
+    }
+
+
+# Чтение расписания потоками readers в течение seconds секунд
+def measure_reads(port, readers, seconds=None, until=None):
+    stop = threading.Event()
+    latencies = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=read_latencies, args=(port, stop, latencies, lock)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    if until is not None:
+        until()
+    else:
+        time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return summary(latencies)
+
+
+# Сервер в дочернем процессе: данные уже в FITNESS_DATA_DIR, настройка допуска —
+# в окружении. Печатает порт и работает, пока не закроют его stdin. Нагрузка
+# идёт из родительского процесса, чтобы потоки генератора не делили GIL с сервером.
+def run_child():
+    sys.path.insert(0, REPO_DIR)
+    import app as fitness_app
+
+    server = start_http_server(fitness_app.app)
+    print(server.server_port, flush=True)
+    sys.stdin.read()
+    server.shutdown()
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.request('GET', path)
+    return connection.getresponse().read()
+
+
+# Пользователь: на 429 ждёт Retry-After и повторяет, на 201 записывается
+# следующий, на прочие ответы («мест нет») поток заканчивает
+def post_registration(connection, body):
+    connection.request('POST', '/api/register_web', body=json.dumps(body).encode('utf-8'),
+                       headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    return response.status, response.getheader('Retry-After')
+
+
+def rush(args, port):
+    statuses = Counter()
+    write_latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.writers + 1)
+
+    def writer(thread):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        local_statuses = Counter()
+        local_latencies = []
+        barrier.wait()
+        i = 0
+        while i < args.writes:
+            began = time.perf_counter()
+            status, retry_after = post_registration(connection, {
+                "class_id": HOT_CLASS_ID, "user_name": f"Ажиотаж {thread}",
+                "phone_number": f"+79{thread:04d}{i:06d}"})
+            local_latencies.append(time.perf_counter() - began)
+            local_statuses[status] += 1
+            if status == 429:
+                time.sleep(min(float(retry_after or 1), args.max_retry_after))
+            elif status == 201:
+                i += 1
+            else:
+                break
+        with lock:
+            statuses.update(local_statuses)
+            write_latencies.extend(local_latencies)
+
+    writers = [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for thread in writers:
+        thread.start()
+
+    def wait_writers():
+        barrier.wait()
+        for thread in writers:
+            thread.join()
+
+    return write_latencies, statuses, wait_writers
+
+
+def run_config(args, data_dir, admission):
+    run_dir = tempfile.mkdtemp(prefix='fitness-rush-run-')
+    for name in ('schedule.json', 'users.txt'):
+        shutil.copy(os.path.join(data_dir, name), run_dir)
+    env = dict(os.environ, FITNESS_DATA_DIR=run_dir, FITNESS_STORAGE=args.storage,
+               FITNESS_ADMISSION='1' if admission else '0')
+    env.setdefault('FITNESS_LOG_LEVEL', 'WARNING')
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child'], cwd=REPO_DIR, env=env,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(child.stdout.readline())
+        idle = measure_reads(port, args.readers, seconds=args.idle_seconds)
+
+        write_latencies, statuses, wait_writers = rush(args, port)
+        began = time.perf_counter()
+        during = measure_reads(port, args.readers, until=wait_writers)
+        rush_seconds = time.perf_counter() - began
+
+        hot = next(c for c in json.loads(get(port, '/api/schedule')) if c['id'] == HOT_CLASS_ID)
+        saved = len(get(port, f'/api/registrations?class_id={HOT_CLASS_ID}&format=ndjson').splitlines())
+    finally:
+        child.stdin.close()
+        child.wait()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return {
+        "reads_idle": idle,
+        "reads_rush": during,
+        "writes": dict(summary(write_latencies),
+                       statuses={str(status): count for status, count in sorted(statuses.items())}),
+        "rush_seconds": rush_seconds,
+        "hot_class": {"capacity": hot['capacity'], "registered": hot['registered'], "saved": saved},
+        "consistent": hot['registered'] <= hot['capacity'] and saved == hot['registered']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=int, default=2000)
+    parser.add_argument('--registrations', type=int, default=50000)
+    parser.add_argument('--seats', type=int, default=300, help='свободных мест на горячем занятии')
+    parser.add_argument('--writers', type=int, default=64, help='потоков записи')
+    parser.add_argument('--writes', type=int, default=50, help='записей на поток (поток останавливается, когда мест нет)')
+    parser.add_argument('--max-retry-after', type=float, default=1.0, help='ожидание после 429 не дольше, с')
+    parser.add_argument('--readers', type=int, default=4, help='потоков чтения расписания')
+    parser.add_argument('--idle-seconds', type=float, default=3.0, help='замер чтения без записи')
+    parser.add_argument('--storage', choices=('files', 'sqlite'), default='files')
+    parser.add_argument('--output', help='файл результата (по умолчанию bench/results/rush-<время>.json)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return
+
+    data_dir = prepare_data(args)
+    results = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {key: value for key, value in vars(args).items() if key != 'child'}
+        },
+        "runs": {}
+    }
+    try:
+        for name, admission in (('no_admission', False), ('admission', True)):
+            run = results['runs'][name] = run_config(args, data_dir, admission)
+            idle, during, writes = run['reads_idle'], run['reads_rush'], run['writes']
+            print(f"{name:13} чтение без записи p50 {idle['p50_ms']:6.2f} p95 {idle['p95_ms']:6.2f} "
+                  f"p99 {idle['p99_ms']:6.2f} мс; во время записи p50 {during['p50_ms']:6.2f} "
+                  f"p95 {during['p95_ms']:6.2f} p99 {during['p99_ms']:6.2f} мс")
+            print(f"{'':13} запись p50 {writes['p50_ms']:6.2f} p99 {writes['p99_ms']:7.2f} мс, ответы "
+                  f"{writes['statuses']}, {run['rush_seconds']:.1f} с; занято "
+                  f"{run['hot_class']['registered']}/{run['hot_class']['capacity']}, сохранено "
+                  f"{run['hot_class']['saved']}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"rush-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результат: {output}")
+
+    if not all(run['consistent'] for run in results['runs'].values()):
+        print("Занятие переполнено или счётчик не совпадает с сохранёнными записями.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from journal import write_json_atomic
+
+log = logging.getLogger(__name__)
+
+
+# Холодное хранилище прошедших занятий: каждый перенос — пара сжатых файлов
+# в форматах рабочих данных (schedule-<время>.json.gz со списком занятий
+# и users-<время>.txt.gz с исходными строками users.txt) и запись в manifest.json.
+# В манифесте также хранится наибольший ID перенесённых регистраций,
+# чтобы эти ID не выдавались повторно.
+class ColdArchive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self._lock = threading.Lock()
+
+    def _manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {"last_registration_id": 0, "runs": []}
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def last_registration_id(self):
+        return self._manifest()['last_registration_id']
+
+    # Атомарная запись сжатого файла из кусков байт
+    def _write_gzip(self, name, chunks):
+        fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=self.directory)
+        try:
+            with open(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9) as compressed:
+                    for chunk in chunks:
+                        compressed.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    # Сохранение занятий и строк их регистраций; файлы записываются до того,
+    # как данные удаляются из рабочего хранилища
+    def write(self, classes, registration_lines, last_registration_id=0):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+            schedule_name = f"schedule-{stamp}.json.gz"
+            users_name = f"users-{stamp}.txt.gz"
+            self._write_gzip(users_name, registration_lines)
+            self._write_gzip(schedule_name, [json.dumps(classes, ensure_ascii=False, indent=4).encode('utf-8')])
+            manifest = self._manifest()
+            manifest['last_registration_id'] = max(manifest['last_registration_id'], last_registration_id)
+            manifest['runs'].append({
+                "archived_at": datetime.now(timezone.utc).isoformat(),
+                "schedule": schedule_name,
+                "users": users_name,
+                "classes": len(classes),
+                "registrations": len(registration_lines)
+            })
+            write_json_atomic(self.manifest_path, manifest)
+        return schedule_name, users_name
+
+
+# Фоновый поток, периодически вызывающий перенос в архив
+class ArchiveWorker:
+    def __init__(self, run, interval=3600.0):
+        self.run = run
+        self.interval = interval
+        self._thread = threading.Thread(target=self._loop, name='class-archiver', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                log.exception("Ошибка при переносе занятий в архив: %s", e)
+            time.sleep(self.interval)
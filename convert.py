@@ -0,0 +1,626 @@
+# Потоковый перенос данных между форматами:
+#   legacy — старый формат jcon.41.json: {"classes": [{"id", "name", "time",
+#            "duration", "instructor", "capacity", "participants": [...]}]};
+#   app    — schedule.json и users.txt приложения;
+#   csv    — classes.csv и registrations.csv.
+# Файлы не загружаются в память целиком: JSON-массивы занятий разбираются по
+# одному элементу, а регистрации (users.txt, registrations.csv) читаются
+# кусками по границам записей и конвертируются в пуле процессов, результаты
+# пишутся в исходном порядке. Участники старого формата лежат внутри занятий,
+# поэтому они разбираются последовательно. Файлы с суффиксом .gz читаются
+# и пишутся сжатыми (например, прогоны холодного архива archive/). Выходные
+# файлы заменяются только после успешного завершения. Во время работы в
+# stderr выводится прогресс, в конце — число записей и скорость.
+#
+# Запуск: python convert.py --from legacy jcon.41.json --to app schedule.json users.txt
+#         python convert.py --from app schedule.json users.txt --to csv classes.csv registrations.csv
+#         [--workers 4] [--chunk-size 8] [--quiet]
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import textwrap
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+# Форматы и число их файлов
+FORMATS = {'legacy': 1, 'app': 2, 'csv': 2}
+
+CLASS_COLUMNS = ('id', 'name', 'instructor', 'datetime', 'capacity', 'registered', 'duration',
+                 'template_id', 'occurrence_id')
+REGISTRATION_COLUMNS = ('registration_id', 'class_id', 'user_name', 'phone_number', 'registration_time')
+# Столбцы CSV, которые читаются как целые числа
+INTEGER_COLUMNS = {'id', 'capacity', 'registered', 'duration', 'template_id', 'registration_id', 'class_id'}
+
+# Участники для старого формата раскладываются во временные файлы по группам
+# из стольких занятий подряд, а затем собираются по одной группе за раз
+LEGACY_GROUP_SIZE = 64
+
+
+# Файл для чтения; .gz распаковывается на лету. Возвращает (поток, исходный
+# файл — по его позиции считается прогресс)
+def open_input(path):
+    raw = open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.GzipFile(fileobj=raw, mode='rb'), raw
+    return raw, raw
+
+
+# Запись через временный файл рядом с path: до успешного конца на месте
+# path остаётся прежний файл
+@contextmanager
+def open_output(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with open(fd, 'wb') as raw:
+            if path.endswith('.gz'):
+                with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                    yield f
+            else:
+                yield raw
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def megabytes(size):
+    return size / (1024 * 1024)
+
+
+# Прогресс по прочитанным байтам входных файлов (файлы читаются по очереди);
+# в stderr не чаще раза в interval секунд
+class Progress:
+    def __init__(self, paths, quiet=False, interval=1.0):
+        self.total = sum(os.path.getsize(path) for path in paths)
+        self.quiet = quiet
+        self.interval = interval
+        self.records = 0
+        self.skipped = 0
+        self.began = time.perf_counter()
+        self._done = 0
+        self._current = None
+        self._shown = self.began
+
+    def open(self, path):
+        if self._current is not None:
+            self._done += os.path.getsize(self._current.name)
+        f, self._current = open_input(path)
+        return f
+
+    def position(self):
+        if self._current is None:
+            return self._done
+        if self._current.closed:
+            return self._done + os.path.getsize(self._current.name)
+        return self._done + self._current.tell()
+
+    def add(self, records, skipped=0):
+        self.records += records
+        self.skipped += skipped
+        now = time.perf_counter()
+        if not self.quiet and now - self._shown >= self.interval:
+            self._shown = now
+            position = self.position()
+            print(f"\r{100 * position / max(self.total, 1):5.1f}%  {megabytes(position):.1f} из "
+                  f"{megabytes(self.total):.1f} МБ, записей {self.records}, "
+                  f"{megabytes(position) / (now - self.began):.1f} МБ/с", end='', file=sys.stderr, flush=True)
+
+    def summary(self, classes):
+        seconds = time.perf_counter() - self.began
+        if not self.quiet and seconds >= self.interval:
+            print(file=sys.stderr)
+        line = (f"Занятий: {classes}, регистраций: {self.records - classes} за {seconds:.2f} с: "
+                f"{megabytes(self.total) / seconds:.1f} МБ/с, {self.records / seconds:.0f} записей/с")
+        if self.skipped:
+            line += f"; пропущено {self.skipped} (некорректные записи или регистрации на неизвестные занятия)"
+        return line
+
+
+# Поэлементный разбор JSON: значения декодируются JSONDecoder.raw_decode
+# из буфера, который дочитывается кусками и растёт, если элемент в него
+# не поместился
+class JsonStream:
+    def __init__(self, f, chunk_size):
+        self.f = io.TextIOWrapper(f, encoding='utf-8')
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.f.read(max(self.chunk_size, len(self.buffer)))
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    # Следующий символ после пробелов ('' — конец файла)
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Некорректный JSON: ожидался {char!r}, найдено {found or 'конец файла'!r}.")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Число в самом конце буфера могло оборваться на середине
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    # Элементы массива по одному
+    def items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Некорректный JSON: ожидалась ',' или ']', найдено {separator!r}.")
+
+    # Элементы массива по ключу объекта верхнего уровня: {"key": [...]};
+    # значения остальных ключей пропускаются
+    def items_at(self, key):
+        self.expect('{')
+        while self.peek() != '}':
+            name = self.value()
+            self.expect(':')
+            if name == key:
+                yield from self.items()
+                return
+            self.value()
+            if self.peek() == ',':
+                self.pos += 1
+        raise ValueError(f"В файле нет ключа {key!r}.")
+
+
+# Куски файла регистраций по границам записей: по переводу строки, а в CSV
+# (quoted) — только вне кавычек, где поле может содержать перевод строки
+def record_chunks(f, chunk_size, quoted=False):
+    rest = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            if rest:
+                yield rest
+            return
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        if quoted:
+            while cut > 0 and data.count(b'"', 0, cut) % 2:
+                cut = data.rfind(b'\n', 0, cut - 1) + 1
+        if cut == 0:
+            rest = data
+            continue
+        yield data[:cut]
+        rest = data[cut:]
+
+
+def csv_value(column, value):
+    if value == '':
+        return None
+    if column in INTEGER_COLUMNS:
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+# Строка CSV -> словарь; пустые ячейки — отсутствующие поля
+def from_csv_row(columns, row):
+    return {column: csv_value(column, value) for column, value in zip(columns, row) if value != ''}
+
+
+# Занятие старого формата -> (занятие приложения, участники)
+def class_from_legacy(item):
+    participants = item.get('participants') or []
+    fitness_class = {
+        "id": item['id'],
+        "name": item.get('name'),
+        "instructor": item.get('instructor'),
+        "datetime": item.get('time'),
+        "capacity": item.get('capacity', 0),
+        "registered": len(participants)
+    }
+    if item.get('duration') is not None:
+        fitness_class['duration'] = item['duration']
+    return fitness_class, participants
+
+
+def class_to_legacy(fitness_class, participants):
+    return {
+        "id": fitness_class['id'],
+        "name": fitness_class.get('name'),
+        "time": fitness_class.get('datetime'),
+        "duration": fitness_class.get('duration'),
+        "instructor": fitness_class.get('instructor'),
+        "capacity": fitness_class.get('capacity'),
+        "participants": participants
+    }
+
+
+# Участник старого формата: строка с именем или объект с полями
+# name/user_name, phone/phone_number, registered_at/registration_time
+def registration_from_participant(class_id, participant, registration_id):
+    if not isinstance(participant, dict):
+        participant = {"name": participant}
+    registration = {
+        "registration_id": participant.get('registration_id', registration_id),
+        "class_id": class_id,
+        "user_name": participant.get('user_name', participant.get('name'))
+    }
+    phone_number = participant.get('phone_number', participant.get('phone'))
+    if phone_number is not None:
+        registration['phone_number'] = phone_number
+    registration_time = participant.get('registration_time', participant.get('registered_at'))
+    if registration_time is not None:
+        registration['registration_time'] = registration_time
+    return registration
+
+
+def participant_from_registration(registration):
+    participant = {"registration_id": registration.get('registration_id'), "name": registration.get('user_name')}
+    if registration.get('phone_number') is not None:
+        participant['phone'] = registration['phone_number']
+    if registration.get('registration_time') is not None:
+        participant['registered_at'] = registration['registration_time']
+    return participant
+
+
+# Позиции занятий для старого формата (ID занятия -> номер в расписании) в процессе пула
+_class_positions = None
+
+
+def set_class_positions(positions):
+    global _class_positions
+    _class_positions = positions
+
+
+# Разбор куска регистраций: (регистрации, число некорректных записей)
+def parse_registrations(source, data, columns):
+    registrations = []
+    skipped = 0
+    if source == 'app':
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                registrations.append(json.loads(line))
+            except ValueError:
+                skipped += 1
+    else:
+        for row in csv.reader(io.StringIO(data.decode('utf-8'), newline='')):
+            if row:
+                registrations.append(from_csv_row(columns, row))
+    return registrations, skipped
+
+
+# Регистрации в формате target: байты для users.txt / registrations.csv или,
+# для старого формата, {группа: строки "позиция занятия<TAB>участник в JSON"}.
+# Возвращает (результат, число регистраций на неизвестные занятия)
+def format_registrations(target, registrations, positions=None):
+    if target == 'app':
+        return ''.join(json.dumps(registration, ensure_ascii=False) + '\n'
+                       for registration in registrations).encode('utf-8'), 0
+    if target == 'csv':
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        for registration in registrations:
+            writer.writerow([registration.get(column) for column in REGISTRATION_COLUMNS])
+        return output.getvalue().encode('utf-8'), 0
+    grouped = {}
+    dropped = 0
+    for registration in registrations:
+        position = positions.get(registration.get('class_id'))
+        if position is None:
+            dropped += 1
+            continue
+        line = f"{position}\t{json.dumps(participant_from_registration(registration), ensure_ascii=False)}\n"
+        grouped.setdefault(position // LEGACY_GROUP_SIZE, []).append(line)
+    return {group: ''.join(lines).encode('utf-8') for group, lines in grouped.items()}, dropped
+
+
+# Работа процесса пула: кусок регистраций из формата source в формат target.
+# Возвращает (результат, число регистраций, число пропущенных)
+def convert_chunk(task):
+    source, target, data, columns = task
+    registrations, skipped = parse_registrations(source, data, columns)
+    output, dropped = format_registrations(target, registrations, _class_positions)
+    return output, len(registrations) - dropped, skipped + dropped
+
+
+# Конвертация кусков в пуле процессов с сохранением порядка. Одновременно
+# в работе не больше 2 * workers кусков, поэтому чтение не убегает вперёд
+# записи и память ограничена.
+def convert_parallel(tasks, workers, positions=None):
+    if workers <= 1:
+        set_class_positions(positions)
+        for task in tasks:
+            yield convert_chunk(task)
+        return
+    with ProcessPoolExecutor(workers, initializer=set_class_positions, initargs=(positions,)) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(convert_chunk, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Источники: занятия по одному, затем регистрации кусками (registration_chunks
+# возвращает (формат кусков, столбцы, куски)). Старый формат отдаёт занятия
+# вместе с участниками (legacy_items).
+class AppSource:
+    def __init__(self, paths, progress, chunk_size):
+        self.schedule_path, self.users_path = paths
+        self.progress = progress
+        self.chunk_size = chunk_size
+
+    def classes(self):
+        with self.progress.open(self.schedule_path) as f:
+            yield from JsonStream(f, self.chunk_size).items()
+
+    def registration_chunks(self):
+        f = self.progress.open(self.users_path)
+
+        def chunks():
+            with f:
+                yield from record_chunks(f, self.chunk_size)
+        return 'app', None, chunks()
+
+
+class CsvSource:
+    def __init__(self, paths, progress, chunk_size):
+        self.classes_path, self.registrations_path = paths
+        self.progress = progress
+        self.chunk_size = chunk_size
+
+    def classes(self):
+        with self.progress.open(self.classes_path) as f:
+            reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+            columns = next(reader, None)
+            if columns is None:
+                return
+            missing = {'id', 'name', 'instructor', 'datetime', 'capacity'} - set(columns)
+            if missing:
+                raise ValueError(f"В {self.classes_path} нет столбцов: {', '.join(sorted(missing))}.")
+            for row in reader:
+                if row:
+                    fitness_class = from_csv_row(columns, row)
+                    fitness_class.setdefault('registered', 0)
+                    yield fitness_class
+
+    def registration_chunks(self):
+        f = self.progress.open(self.registrations_path)
+        header = f.readline().decode('utf-8-sig')
+        columns = next(csv.reader([header]), [])
+        missing = {'registration_id', 'class_id'} - set(columns)
+        if header and missing:
+            f.close()
+            raise ValueError(f"В {self.registrations_path} нет столбцов: {', '.join(sorted(missing))}.")
+
+        def chunks():
+            with f:
+                yield from record_chunks(f, self.chunk_size, quoted=True)
+        return 'csv', columns, chunks()
+
+
+class LegacySource:
+    def __init__(self, paths, progress, chunk_size):
+        self.path, = paths
+        self.progress = progress
+        self.chunk_size = chunk_size
+
+    def legacy_items(self):
+        with self.progress.open(self.path) as f:
+            yield from JsonStream(f, self.chunk_size).items_at('classes')
+
+
+# Приёмники: write_class по одному занятию, write_registrations — результат
+# format_registrations, finish — после всех записей
+class AppTarget:
+    def __init__(self, paths, stack):
+        self.schedule = stack.enter_context(open_output(paths[0]))
+        self.users = stack.enter_context(open_output(paths[1]))
+        self.classes = 0
+
+    # Расписание пишется так же, как json.dump(..., indent=4) в приложении
+    def write_class(self, fitness_class):
+        self.schedule.write(b'[\n' if not self.classes else b',\n')
+        self.schedule.write(textwrap.indent(json.dumps(fitness_class, ensure_ascii=False, indent=4),
+                                            '    ').encode('utf-8'))
+        self.classes += 1
+
+    def write_registrations(self, data):
+        self.users.write(data)
+
+    def finish(self):
+        self.schedule.write(b'\n]' if self.classes else b'[]')
+
+
+class CsvTarget:
+    def __init__(self, paths, stack):
+        self.classes_file = io.TextIOWrapper(stack.enter_context(open_output(paths[0])), encoding='utf-8',
+                                             newline='', write_through=True)
+        self.classes_writer = csv.writer(self.classes_file, lineterminator='\n')
+        self.classes_writer.writerow(CLASS_COLUMNS)
+        self.registrations = stack.enter_context(open_output(paths[1]))
+        self.registrations.write((','.join(REGISTRATION_COLUMNS) + '\n').encode('utf-8'))
+        self.classes = 0
+
+    def write_class(self, fitness_class):
+        self.classes_writer.writerow([fitness_class.get(column) for column in CLASS_COLUMNS])
+        self.classes += 1
+
+    def write_registrations(self, data):
+        self.registrations.write(data)
+
+    def finish(self):
+        self.classes_file.detach()
+
+
+class LegacyTarget:
+    def __init__(self, paths, stack):
+        self.path, = paths
+        self.output = stack.enter_context(open_output(self.path))
+        self.spool = stack.enter_context(tempfile.TemporaryDirectory(prefix='convert-legacy-'))
+        self.class_list = []
+        self.positions = {}
+
+    @property
+    def classes(self):
+        return len(self.class_list)
+
+    def write_class(self, fitness_class):
+        self.positions[fitness_class['id']] = len(self.class_list)
+        self.class_list.append(fitness_class)
+
+    def write_registrations(self, grouped):
+        for group, data in grouped.items():
+            with open(os.path.join(self.spool, f"{group}.txt"), 'ab') as f:
+                f.write(data)
+
+    # Занятия пишутся по группам: участники группы читаются из её временного
+    # файла и вставляются готовым JSON, по одному на строку
+    def finish(self):
+        self.output.write(b'{\n    "classes": [')
+        for start in range(0, len(self.class_list), LEGACY_GROUP_SIZE):
+            participants = {}
+            path = os.path.join(self.spool, f"{start // LEGACY_GROUP_SIZE}.txt")
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        position, participant = line.rstrip('\n').split('\t', 1)
+                        participants.setdefault(int(position), []).append(participant)
+            for position, fitness_class in enumerate(self.class_list[start:start + LEGACY_GROUP_SIZE], start):
+                text = textwrap.indent(json.dumps(class_to_legacy(fitness_class, []), ensure_ascii=False, indent=4),
+                                       ' ' * 8)
+                if position in participants:
+                    lines = ',\n'.join(' ' * 16 + participant for participant in participants[position])
+                    text = text[:-len('[]\n        }')] + f"[\n{lines}\n            ]\n        }}"
+                self.output.write(b',\n' if position else b'\n')
+                self.output.write(text.encode('utf-8'))
+        self.output.write(b'\n    ]\n}\n' if self.class_list else b']\n}\n')
+
+
+SOURCES = {'app': AppSource, 'csv': CsvSource, 'legacy': LegacySource}
+TARGETS = {'app': AppTarget, 'csv': CsvTarget, 'legacy': LegacyTarget}
+
+
+# Старый формат: участники каждого занятия конвертируются сразу за ним.
+# ID регистрации берётся у участника, иначе выдаётся следующий по порядку.
+def convert_legacy(source, target_format, target, progress):
+    next_id = 1
+    for item in source.legacy_items():
+        fitness_class, participants = class_from_legacy(item)
+        target.write_class(fitness_class)
+        registrations = []
+        for participant in participants:
+            registration = registration_from_participant(fitness_class['id'], participant, next_id)
+            if isinstance(registration['registration_id'], int):
+                next_id = max(next_id, registration['registration_id'] + 1)
+            registrations.append(registration)
+        output, dropped = format_registrations(target_format, registrations, getattr(target, 'positions', None))
+        target.write_registrations(output)
+        progress.add(1 + len(registrations) - dropped, dropped)
+
+
+def convert(source_format, source_paths, target_format, target_paths, workers=1, chunk_size=8 * 1024 * 1024,
+            quiet=False):
+    progress = Progress(source_paths, quiet=quiet)
+    source = SOURCES[source_format](source_paths, progress, chunk_size)
+    with ExitStack() as stack:
+        target = TARGETS[target_format](target_paths, stack)
+        if source_format == 'legacy':
+            convert_legacy(source, target_format, target, progress)
+        else:
+            for fitness_class in source.classes():
+                target.write_class(fitness_class)
+                progress.add(1)
+            chunk_format, columns, chunks = source.registration_chunks()
+            tasks = ((chunk_format, target_format, chunk, columns) for chunk in chunks)
+            for output, count, skipped in convert_parallel(tasks, workers, getattr(target, 'positions', None)):
+                target.write_registrations(output)
+                progress.add(count, skipped)
+        target.finish()
+    return progress.summary(target.classes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос данных между форматами legacy (jcon.41.json), "
+                                                 "app (schedule.json и users.txt) и csv (classes.csv и "
+                                                 "registrations.csv).")
+    parser.add_argument('--from', dest='source', nargs='+', required=True, metavar='ФОРМАТ_И_ФАЙЛЫ',
+                        help='legacy ФАЙЛ | app РАСПИСАНИЕ РЕГИСТРАЦИИ | csv ЗАНЯТИЯ РЕГИСТРАЦИИ')
+    parser.add_argument('--to', dest='target', nargs='+', required=True, metavar='ФОРМАТ_И_ФАЙЛЫ',
+                        help='то же для результата')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='процессов для конвертации регистраций (по умолчанию — число ядер)')
+    parser.add_argument('--chunk-size', type=float, default=8, help='размер куска чтения, МБ')
+    parser.add_argument('--quiet', action='store_true', help='без прогресса в stderr')
+    args = parser.parse_args()
+
+    for name, (file_format, *paths) in (('--from', args.source), ('--to', args.target)):
+        if file_format not in FORMATS:
+            parser.error(f"{name}: неизвестный формат {file_format!r}; есть {', '.join(FORMATS)}.")
+        if len(paths) != FORMATS[file_format]:
+            parser.error(f"{name} {file_format}: нужно файлов — {FORMATS[file_format]}.")
+    source_format, *source_paths = args.source
+    target_format, *target_paths = args.target
+    overlap = {os.path.abspath(path) for path in source_paths} & {os.path.abspath(path) for path in target_paths}
+    if overlap:
+        parser.error(f"файл одновременно входной и выходной: {', '.join(sorted(overlap))}.")
+
+    try:
+        print(convert(source_format, source_paths, target_format, target_paths, workers=args.workers,
+                      chunk_size=max(1, int(args.chunk_size * 1024 * 1024)), quiet=args.quiet))
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
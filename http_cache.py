@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import Response, request
+
+# brotli — необязательная зависимость: без неё статика отдаётся в gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Срок кэширования статики с хэшем содержимого в имени
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+# Готовое к отправке тело ответа: исходные байты, сжатые варианты и ETag.
+# Brotli (максимальное сжатие) строится только для статики, собираемой один раз.
+class EncodedBody:
+    __slots__ = ('body', 'gzip_body', 'br_body', 'etag')
+
+    def __init__(self, body, use_brotli=False):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6, mtime=0)
+        self.br_body = brotli.compress(body) if use_brotli and brotli is not None else None
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+
+
+# Ответ из закодированного тела: 304 при совпадении If-None-Match,
+# сжатый вариант, если клиент его принимает (у вариантов разные ETag)
+def encoded_response(encoded, mimetype, cache_control='no-cache', headers=None):
+    if encoded.br_body is not None and 'br' in request.accept_encodings:
+        encoding, body = 'br', encoded.br_body
+    elif 'gzip' in request.accept_encodings:
+        encoding, body = 'gzip', encoded.gzip_body
+    else:
+        encoding, body = None, encoded.body
+    etag = f"{encoded.etag}-{encoding}" if encoding else encoded.etag
+    if etag in request.if_none_match or encoded.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    if headers:
+        response.headers.update(headers)
+    return response
+
+
+# Кэш одного закодированного ответа, привязанный к версии данных:
+# при совпадении версии тело не пересобирается
+class VersionedCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry = (None, None)
+
+    def get(self, version, build):
+        cached_version, encoded = self._entry
+        if encoded is not None and cached_version == version:
+            return encoded
+        with self._lock:
+            cached_version, encoded = self._entry
+            if encoded is None or cached_version != version:
+                encoded = EncodedBody(build())
+                self._entry = (version, encoded)
+            return encoded
+
+
+# Статические файлы, собранные при старте: имя содержит хэш содержимого,
+# поэтому их можно кэшировать у клиента навсегда
+class AssetBundle:
+    def __init__(self, directory, url_prefix='/assets/'):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self._assets = {}
+
+    # Добавление файла; возвращает URL вида /assets/app.<хэш>.js
+    def add(self, filename):
+        with open(os.path.join(self.directory, filename), 'rb') as f:
+            encoded = EncodedBody(f.read(), use_brotli=True)
+        stem, ext = os.path.splitext(filename)
+        hashed_name = f"{stem}.{encoded.etag[:12]}{ext}"
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self._assets[hashed_name] = (encoded, mimetype)
+        return self.url_prefix + hashed_name
+
+    def get(self, hashed_name):
+        return self._assets.get(hashed_name)
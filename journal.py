@@ -0,0 +1,383 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+JOURNAL_APPEND_SECONDS = metrics.histogram(
+    'fitness_journal_append_seconds', 'Время дописывания записей в журнал расписания')
+
+
+# Атомарная запись JSON: сначала во временный файл, затем os.replace,
+# чтобы падение посреди записи не оставляло обрезанный файл
+def write_json_atomic(path, data, indent=4):
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Чтение записей журнала; недописанная последняя строка (после сбоя) пропускается
+def read_records(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                log.warning("Некорректная запись в %s, пропущена.", path)
+
+
+# Применение одной записи журнала к расписанию.
+# Записи хранят абсолютные значения, поэтому повторное применение
+# уже учтённых в снимке записей не меняет результат.
+def apply_record(schedule, by_id, record):
+    op = record.get('op')
+    if op == 'add':
+        new_class = dict(record['class'])
+        existing = by_id.get(new_class['id'])
+        if existing is None:
+            schedule.append(new_class)
+            by_id[new_class['id']] = new_class
+        else:
+            existing.update(new_class)
+    elif op == 'registered':
+        fitness_class = by_id.get(record['id'])
+        if fitness_class is not None:
+            fitness_class['registered'] = record['registered']
+    elif op == 'remove':
+        removed = set(record['ids'])
+        schedule[:] = [fitness_class for fitness_class in schedule if fitness_class['id'] not in removed]
+        for class_id in removed:
+            by_id.pop(class_id, None)
+
+
+# Чтение снимка расписания (пустой список, если снимка нет)
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Признак версии файла для дешёвой проверки изменений: inode (атомарная
+# замена создаёт новый файл), время изменения и размер; None — файла нет
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+# Снимок расписания на диске. signature — признак файла после последнего
+# чтения или записи приложением: если признак на диске другой, файл правили
+# вручную. Запись снимка и проверка правки идут под lock.
+class SnapshotFile:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.signature = None
+
+    def edited(self):
+        return file_signature(self.path) != self.signature
+
+    # Признак берётся до чтения: правку посреди чтения заметит следующая проверка
+    def remember(self):
+        self.signature = file_signature(self.path)
+
+    # Запись снимка приложением. Если перед этим файл правили вручную, признак
+    # остаётся старым, и следующая проверка перечитает файл. Сжатие журнала
+    # собирает снимок из файла на диске, так что правка в него уже вошла;
+    # перед записью из памяти (режим snapshot) правку применяет FileStorage.
+    def write(self, schedule):
+        with self.lock:
+            edited = self.edited()
+            write_json_atomic(self.path, schedule)
+            if not edited:
+                self.remember()
+
+
+# Журнал изменений расписания: вместо полной перезаписи schedule.json
+# каждое изменение дописывается строкой в журнал, а снимок периодически
+# пересобирается в фоне из старого снимка и накопленных записей.
+# В режиме shared журнал пишут несколько процессов: запись идёт под flock,
+# ротации нет, а снимок собирает только один процесс (SharedSnapshotWriter).
+class ScheduleJournal:
+    def __init__(self, snapshot_path, journal_path=None, compact_threshold=1000, shared=False, snapshot=None):
+        self.snapshot_path = snapshot_path
+        self.snapshot = snapshot or SnapshotFile(snapshot_path)
+        self.journal_path = journal_path or os.path.splitext(snapshot_path)[0] + '.journal'
+        self.rotated_path = self.journal_path + '.old'
+        self.compact_threshold = compact_threshold
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._file = None
+        self._records = 0
+        # Есть ли записи, ещё не сброшенные на диск (fsync)
+        self._dirty = False
+        self._compactor = None
+
+    # Межпроцессная блокировка журнала (только в режиме shared)
+    @contextmanager
+    def _file_lock(self, operation):
+        if not self.shared:
+            yield
+            return
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Наложение журнала на загруженный снимок
+    def replay(self, schedule):
+        count = self.apply_to(schedule)
+        # Незавершённое после сбоя сжатие доводим до конца сразу
+        if os.path.exists(self.rotated_path):
+            self._compact()
+        self._records = count
+        return count
+
+    # Наложение записей журнала (и ротированного, если сжатие не закончено)
+    # на расписание без побочных действий; возвращает число записей
+    def apply_to(self, schedule):
+        by_id = {cls['id']: cls for cls in schedule}
+        count = 0
+        with self._file_lock(fcntl.LOCK_SH):
+            for path in (self.rotated_path, self.journal_path):
+                for record in read_records(path):
+                    apply_record(schedule, by_id, record)
+                    count += 1
+        return count
+
+    # Расписание с диска, как при запуске: снимок + журнал. Журнал читается
+    # под блокировкой записи, чтобы ротация не пришлась на середину чтения.
+    def read_full(self):
+        with self.snapshot.lock, self._lock:
+            self.snapshot.remember()
+            schedule = read_snapshot(self.snapshot_path)
+            self.apply_to(schedule)
+        return schedule
+
+    # Записи о нескольких новых занятиях одной записью в файл
+    def record_new_classes(self, classes):
+        self._append(lambda: [{"op": "add", "class": dict(fitness_class)} for fitness_class in classes])
+
+    # Запись об удалении занятий (перенесены в архив)
+    def record_removed(self, class_ids):
+        self._append(lambda: [{"op": "remove", "ids": list(class_ids)}])
+
+    # Запись об изменении счётчика зарегистрированных.
+    # Значение читается под блокировкой журнала, поэтому последняя запись
+    # по занятию всегда содержит актуальный счётчик.
+    def record_registered(self, fitness_class, delta):
+        self.record_registered_many([(fitness_class, delta)])
+
+    # Изменения счётчиков нескольких занятий (пары (занятие, delta)) одной записью в файл
+    def record_registered_many(self, changes):
+        self._append(lambda: [{
+            "op": "registered",
+            "id": fitness_class['id'],
+            "delta": delta,
+            "registered": fitness_class['registered']
+        } for fitness_class, delta in changes])
+
+    def _append(self, make_records):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.journal_path, 'a', encoding='utf-8')
+            records = make_records()
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            self._dirty = True
+            if self.shared:
+                with JOURNAL_APPEND_SECONDS.time():
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+                    try:
+                        self._file.write(data)
+                        self._file.flush()
+                    finally:
+                        fcntl.flock(self._file, fcntl.LOCK_UN)
+                return
+            with JOURNAL_APPEND_SECONDS.time():
+                self._file.write(data)
+                self._file.flush()
+            self._records += len(records)
+            if self._records >= self.compact_threshold:
+                self._start_compaction()
+
+    # Сброс дописанных записей на диск. Вызывается писателем users.txt перед
+    # fsync пакета регистраций (GroupCommitWriter, before_commit): счётчики
+    # в журнале надёжно сохраняются не позже самих регистраций, одним fsync
+    # на пакет. fsync идёт по копии дескриптора, без блокировки журнала.
+    def sync(self):
+        with self._lock:
+            if not self._dirty or self._file is None:
+                return
+            fd = os.dup(self._file.fileno())
+            self._dirty = False
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Закрытие файла журнала с fsync недосохранённых записей (под self._lock)
+    def _close_file(self):
+        if self._file is None:
+            return
+        if self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+        self._file.close()
+        self._file = None
+
+    # Ротация журнала и запуск сжатия в фоновом потоке (под self._lock)
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._close_file()
+        if not os.path.exists(self.journal_path):
+            return
+        os.replace(self.journal_path, self.rotated_path)
+        self._records = 0
+        self._compactor = threading.Thread(target=self._compact, name='schedule-compactor', daemon=True)
+        self._compactor.start()
+
+    # Сборка нового снимка: старый снимок + ротированный журнал. Правленый
+    # вручную снимок тоже собирается с журналом, как при запуске.
+    def _compact(self):
+        try:
+            with self.snapshot.lock:
+                schedule = read_snapshot(self.snapshot_path)
+                by_id = {cls['id']: cls for cls in schedule}
+                for record in read_records(self.rotated_path):
+                    apply_record(schedule, by_id, record)
+                self.snapshot.write(schedule)
+                os.remove(self.rotated_path)
+            log.info("Журнал сжат в снимок %s.", self.snapshot_path)
+        except Exception as e:
+            log.error("Ошибка при сжатии журнала: %s", e)
+
+    # Текущее расписание с диска: снимок + журнал (для процессов, которым
+    # нужно узнать о занятиях, добавленных другими воркерами)
+    def read_schedule(self):
+        with self._file_lock(fcntl.LOCK_SH):
+            schedule = read_snapshot(self.snapshot_path)
+            by_id = {cls['id']: cls for cls in schedule}
+            for record in read_records(self.journal_path):
+                apply_record(schedule, by_id, record)
+        return schedule
+
+    # Сжатие в режиме shared: снимок + журнал со счётчиками из общей памяти
+    # записываются в новый снимок, журнал обнуляется под исключительной блокировкой
+    def compact_shared(self, registered_for):
+        with open(self.journal_path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                schedule = read_snapshot(self.snapshot_path)
+                by_id = {cls['id']: cls for cls in schedule}
+                for record in read_records(self.journal_path):
+                    apply_record(schedule, by_id, record)
+                for fitness_class in schedule:
+                    fitness_class['registered'] = registered_for(fitness_class['id'])
+                self.snapshot.write(schedule)
+                f.truncate(0)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return len(schedule)
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+
+# Фоновый поток, сохраняющий снимки в режиме нескольких процессов.
+# Писателем становится процесс, захвативший flock на файле блокировки;
+# остальные воркеры периодически пытаются его перехватить на случай,
+# если писатель завершился.
+class SharedSnapshotWriter:
+    def __init__(self, journal, counters, interval=5.0):
+        self.journal = journal
+        self.counters = counters
+        self.interval = interval
+        self.lock_path = journal.snapshot_path + '.lock'
+        self.is_writer = False
+        self._lock_file = None
+        self._last_version = None
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _try_acquire(self):
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.is_writer = True
+        log.info("Процесс %s сохраняет снимки расписания.", os.getpid())
+        return True
+
+    def _run(self):
+        while True:
+            if self.is_writer or self._try_acquire():
+                try:
+                    self.flush()
+                except Exception as e:
+                    log.error("Ошибка при сохранении снимка: %s", e)
+            time.sleep(self.interval)
+
+    # Сохранение снимка, если общее состояние изменилось с прошлого раза
+    def flush(self):
+        version = self.counters.version()
+        if version == self._last_version:
+            return False
+        self.journal.compact_shared(self.counters.get)
+        self._last_version = version
+        return True
+
+
+# Фоновый поток, который раз в interval секунд вызывает check — проверку,
+# не правили ли снимок расписания вручную (см. app.reload_schedule_file)
+class ScheduleWatcher:
+    def __init__(self, check, interval=2.0):
+        self.check = check
+        self.interval = interval
+        self._thread = threading.Thread(target=self._run, name='schedule-watcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                log.exception("Ошибка при перечитывании расписания: %s", e)
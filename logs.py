@@ -0,0 +1,40 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Уровни журнала: стандартные имена logging и OFF — журнал выключен
+LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+    'OFF': logging.CRITICAL + 10
+}
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+# Буферизованный журнал: обработчик корневого логгера только кладёт запись
+# в очередь, а в поток вывода её пишет фоновый поток QueueListener, поэтому
+# запрос не ждёт вывода. Сообщения горячего пути (каждая регистрация) пишутся
+# с уровнем DEBUG и при уровне INFO и выше даже не форматируются.
+def configure_logging(level='INFO', stream=None):
+    level_number = LEVELS.get(str(level).upper())
+    if level_number is None:
+        raise ValueError(f"Неизвестный уровень журнала {level!r}: ожидается один из {', '.join(LEVELS)}.")
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level_number)
+    listener.start()
+    # Остановка дописывает всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
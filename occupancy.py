@@ -0,0 +1,399 @@
+import bisect
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from journal import write_json_atomic
+from recurrence import WEEKDAYS
+from schedule_store import datetime_key
+
+log = logging.getLogger(__name__)
+
+# Границы корзин времени записи: за сколько часов до начала занятия сделана
+# регистрация. Корзина 0 — после начала, i — [LEAD_HOURS[i-1], LEAD_HOURS[i]),
+# последняя — LEAD_HOURS[-1] часов и раньше.
+LEAD_HOURS = (0, 1, 3, 6, 12, 24, 48, 72, 168, 336, 720)
+
+# Разрезы заполняемости: инструктор, название занятия, день недели
+GROUPS = ('instructor', 'name', 'weekday')
+
+OCCUPANCY_FORMAT = 2
+
+
+# Корзина времени записи; None — время занятия или регистрации неизвестно
+def lead_bucket(start, registration_time):
+    registered_at = datetime_key(registration_time)
+    if start is None or registered_at == datetime.min:
+        return None
+    return bisect.bisect_right(LEAD_HOURS, (start - registered_at).total_seconds() / 3600)
+
+
+# Вклад одного занятия в агрегаты: поля занятия, число регистраций, их
+# распределение по корзинам времени записи и корзина, в которой занятие
+# заполнилось (регистрация, занявшая последнее место). seeded — места,
+# учтённые счётчиком registered занятия без записей в хранилище (например,
+# из исходного расписания); они считаются занятыми раньше всех записей.
+# first — корзины первых capacity записей, пока seeded ещё не известно.
+class ClassOccupancy:
+    __slots__ = ('fields', 'keys', 'start', 'capacity', 'registered', 'seeded', 'first', 'lead', 'sold_out_bucket',
+                 'totals')
+
+    def __init__(self, fields, registered=0, lead=None, sold_out_bucket=None, seeded=0):
+        instructor, name, class_datetime, capacity = fields
+        self.fields = fields
+        self.start = datetime_key(class_datetime)
+        if self.start == datetime.min:
+            self.start = None
+        weekday = WEEKDAYS[self.start.weekday()] if self.start is not None else None
+        self.keys = (instructor, name, weekday)
+        self.capacity = capacity
+        self.registered = registered
+        self.seeded = seeded
+        self.first = None
+        self.lead = lead or [0] * (len(LEAD_HOURS) + 1)
+        self.sold_out_bucket = sold_out_bucket
+        self.totals = ()
+
+    # Занятые места: записи и места без записей
+    @property
+    def taken(self):
+        return self.registered + self.seeded
+
+    @property
+    def sold_out(self):
+        return 0 < self.capacity <= self.taken
+
+    # Учёт записей начинается до того, как известны места без записей
+    def start_seeding(self):
+        self.first = []
+
+    # Места без записей: счётчик registered занятия (прочитанный раньше записей)
+    # минус все его записи в хранилище, в том числе ещё не учтённые (later).
+    # Занятие заполнилось на записи номер capacity - seeded.
+    def seed(self, registered, later=0):
+        self.seeded = max(0, registered - self.registered - later)
+        last_seat = self.capacity - self.seeded
+        self.sold_out_bucket = self.first[last_seat - 1] if 0 < last_seat <= len(self.first) else None
+        self.first = None
+
+
+def class_fields(fitness_class):
+    return (fitness_class.get('instructor'), fitness_class.get('name'), fitness_class.get('datetime'),
+            fitness_class.get('capacity', 0))
+
+
+# Аналитика заполняемости для GET /api/stats: итоги по инструкторам,
+# названиям и дням недели и кривые времени записи поддерживаются
+# нарастающим итогом, поэтому ответ не зависит от объёма истории.
+# Регистрации читаются из хранилища по позиции (query_registrations) начиная
+# с cursor: так учитываются и записи этого процесса сразу после сохранения,
+# и записи других процессов, и хвост, дописанный после сохранения итогов.
+# Занятые места сходятся со счётчиками registered расписания: места, которые
+# счётчик учёл без записей (исходное расписание, перенос из старого формата),
+# добавляются к записям, но не попадают в кривые времени записи.
+# Занятие с изменёнными полями пересчитывается по своим регистрациям через
+# индекс занятий. Итоги сохраняются в occupancy.json при остановке; если файла
+# нет, они пересчитываются по всем регистрациям в фоновом потоке.
+class OccupancyStats:
+    # classes — функция, возвращающая все занятия; query — query_registrations хранилища
+    def __init__(self, path, classes, query):
+        self.path = path
+        self._classes = classes
+        self._query = query
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # Растёт при каждом изменении итогов: по нему кэшируется готовый ответ
+        self.version = 0
+        self._reset()
+
+    def _reset(self):
+        self.cursor = 0
+        self._entries = {}
+        self._groups = {kind: {} for kind in GROUPS}
+        # Итоги: занятия, места, регистрации, заполненные занятия
+        self._overall = [0, 0, 0, 0]
+        self._lead = [0] * (len(LEAD_HOURS) + 1)
+        self._sold_out = [0] * (len(LEAD_HOURS) + 1)
+
+    # Загрузка сохранённых итогов с дочитыванием новых регистраций или,
+    # если файла нет, пересчёт в фоновом потоке
+    def start(self):
+        if self.load():
+            self._ready.set()
+        else:
+            threading.Thread(target=self._rebuild_in_background, name='occupancy-rebuild', daemon=True).start()
+        return self
+
+    # Итоги недействительны до следующего rebuild (например, users.txt
+    # перезаписывается и позиции регистраций сдвигаются): учёт приостановлен
+    def suspend(self):
+        with self._lock:
+            self._ready.clear()
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            log.exception("Ошибка при пересчёте аналитики заполняемости: %s", e)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('format') != OCCUPANCY_FORMAT or tuple(data.get('lead_hours', ())) != LEAD_HOURS:
+                log.info("%s в другом формате, аналитика пересчитывается.", self.path)
+                return False
+            entries = {}
+            for (class_id, instructor, name, class_datetime, capacity, registered, seeded, sold_out_bucket,
+                 lead) in data['classes']:
+                entries[class_id] = ClassOccupancy((instructor, name, class_datetime, capacity), registered, lead,
+                                                   sold_out_bucket, seeded)
+            cursor = data['cursor']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Не удалось прочитать %s (%s), аналитика пересчитывается.", self.path, e)
+            return False
+        with self._lock:
+            self._reset()
+            self.cursor = cursor
+            for class_id, entry in entries.items():
+                self._entries[class_id] = entry
+                self._apply(entry, 1)
+            self._sync()
+            added = self._refresh()
+        log.info("Аналитика заполняемости загружена из %s (дочитано регистраций: %s).", self.path, added)
+        return True
+
+    # Сохранение итогов (атомарно); при следующем запуске дочитываются
+    # только регистрации после cursor
+    def save(self):
+        if not self._ready.is_set():
+            return
+        with self._lock:
+            data = {
+                "format": OCCUPANCY_FORMAT,
+                "lead_hours": LEAD_HOURS,
+                "cursor": self.cursor,
+                "classes": [[class_id, *entry.fields, entry.registered, entry.seeded, entry.sold_out_bucket, entry.lead]
+                            for class_id, entry in self._entries.items()]
+            }
+        try:
+            write_json_atomic(self.path, data, indent=None)
+        except OSError as e:
+            log.error("Ошибка при сохранении %s: %s", self.path, e)
+
+    # Пересчёт по всем регистрациям хранилища. Новые итоги собираются без
+    # блокировки, затем подменяют старые и догоняют изменения, сделанные за это время.
+    # Счётчики registered запоминаются до чтения регистраций: запись, идущая
+    # во время пересчёта, не попадёт в места без записей.
+    def rebuild(self):
+        fresh = OccupancyStats(self.path, self._classes, self._query)
+        counters = {}
+        for fitness_class in list(fresh._classes()):
+            entry = fresh._entries[fitness_class['id']] = ClassOccupancy(class_fields(fitness_class))
+            entry.start_seeding()
+            counters[fitness_class['id']] = fitness_class.get('registered', 0)
+        for position, line in fresh._query(0):
+            fresh._count(line)
+            fresh.cursor = position + 1
+        for class_id, entry in fresh._entries.items():
+            entry.seed(counters[class_id])
+            fresh._apply(entry, 1)
+        with self._lock:
+            for name in ('cursor', '_entries', '_groups', '_overall', '_lead', '_sold_out'):
+                setattr(self, name, getattr(fresh, name))
+            self.version += 1
+            self._sync()
+            self._refresh()
+            self._ready.set()
+        log.info("Аналитика заполняемости пересчитана: занятий %s, регистраций %s.",
+                 len(self._entries), self._overall[2])
+
+    # Учёт новых регистраций. wait=False — для обработчиков записи: если
+    # итоги уже обновляет другой поток, он подхватит и эту регистрацию
+    # (или её подхватит следующий вызов).
+    def refresh(self, wait=True):
+        if not self._ready.is_set():
+            return 0
+        if not self._lock.acquire(blocking=wait):
+            return 0
+        try:
+            return self._refresh()
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        added = 0
+        for position, line in self._query(self.cursor):
+            self._count(line, applied=True)
+            self.cursor = position + 1
+            added += 1
+        return added
+
+    # Новые и изменённые занятия (добавленные запросом или из повторения)
+    def track(self, classes):
+        if not self._ready.is_set():
+            return
+        with self._lock:
+            for fitness_class in classes:
+                self._update(fitness_class)
+
+    # Занятия, убранные из расписания (например, перенесённые в архив другим процессом)
+    def forget(self, class_ids):
+        if not self._ready.is_set() or not class_ids:
+            return
+        with self._lock:
+            for class_id in class_ids:
+                entry = self._entries.pop(class_id, None)
+                if entry is not None:
+                    self._apply(entry, -1)
+
+    # Сверка со всем расписанием: после перечитывания правленого файла
+    # и изменений из других процессов в режиме общих счётчиков
+    def sync(self):
+        if not self._ready.is_set():
+            return
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        present = set()
+        for fitness_class in list(self._classes()):
+            present.add(fitness_class['id'])
+            self._update(fitness_class)
+        for class_id in [class_id for class_id in self._entries if class_id not in present]:
+            self._apply(self._entries.pop(class_id), -1)
+
+    # Занятие с новыми полями пересчитывается по своим регистрациям до cursor
+    # (по индексу занятий хранилища, без просмотра остальных); записи после
+    # cursor учтёт _refresh, но места без записей считаются по всем
+    def _update(self, fitness_class):
+        class_id = fitness_class['id']
+        fields = class_fields(fitness_class)
+        entry = self._entries.get(class_id)
+        if entry is not None:
+            if entry.fields == fields:
+                return
+            self._apply(entry, -1)
+        registered = fitness_class.get('registered', 0)
+        entry = self._entries[class_id] = ClassOccupancy(fields)
+        entry.start_seeding()
+        later = 0
+        for position, line in self._query(0, class_id=class_id):
+            if position >= self.cursor:
+                later += 1
+            else:
+                self._add_registration(entry, json.loads(line))
+        entry.seed(registered, later)
+        self._apply(entry, 1)
+
+    def _apply(self, entry, sign):
+        self.version += 1
+        if sign > 0:
+            entry.totals = [self._groups[kind].setdefault(key, [0, 0, 0, 0])
+                            for kind, key in zip(GROUPS, entry.keys)] + [self._overall]
+        for totals in entry.totals:
+            totals[0] += sign
+            totals[1] += sign * entry.capacity
+            totals[2] += sign * entry.taken
+            totals[3] += sign * entry.sold_out
+        for bucket, count in enumerate(entry.lead):
+            self._lead[bucket] += sign * count
+        if entry.sold_out and entry.sold_out_bucket is not None:
+            self._sold_out[entry.sold_out_bucket] += sign
+        if sign < 0:
+            for kind, key in zip(GROUPS, entry.keys):
+                if self._groups[kind][key][0] == 0:
+                    del self._groups[kind][key]
+            entry.totals = ()
+
+    # Регистрация из хранилища (строка JSON); applied — занятие уже входит
+    # в итоги, и они сдвигаются вместе с ним. Регистрации на занятия, которых
+    # нет в расписании, не учитываются.
+    def _count(self, line, applied=False):
+        try:
+            registration = json.loads(line)
+        except ValueError:
+            return
+        entry = self._entries.get(registration.get('class_id'))
+        if entry is None:
+            return
+        bucket, sold_out = self._add_registration(entry, registration)
+        self.version += 1
+        for totals in entry.totals:
+            totals[2] += 1
+            totals[3] += sold_out
+        if applied:
+            if bucket is not None:
+                self._lead[bucket] += 1
+                if sold_out:
+                    self._sold_out[bucket] += 1
+
+    # Регистрация в счётчиках занятия: (корзина, заняла ли она последнее место)
+    def _add_registration(self, entry, registration):
+        entry.registered += 1
+        bucket = lead_bucket(entry.start, registration.get('registration_time'))
+        if bucket is not None:
+            entry.lead[bucket] += 1
+        if entry.first is not None and len(entry.first) < entry.capacity:
+            entry.first.append(bucket)
+        sold_out = entry.taken == entry.capacity
+        if sold_out:
+            entry.sold_out_bucket = bucket
+        return bucket, sold_out
+
+    # Готовы ли итоги (ожидание пересчёта не дольше timeout секунд)
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    # Ответ GET /api/stats: только итоги, без просмотра занятий и регистраций
+    def snapshot(self):
+        with self._lock:
+            classes, capacity, registered, sold_out = self._overall
+            response = {
+                "classes": classes,
+                "capacity": capacity,
+                "registrations": registered,
+                "fill_rate": fill_rate(registered, capacity),
+                "sold_out": sold_out
+            }
+            for kind in GROUPS:
+                rows = sorted(self._groups[kind].items(), key=lambda item: group_order(kind, item[0]))
+                response[f"by_{kind}"] = [{kind: key, "classes": totals[0], "capacity": totals[1],
+                                           "registrations": totals[2], "fill_rate": fill_rate(totals[2], totals[1]),
+                                           "sold_out": totals[3]} for key, totals in rows]
+            response["booking_curve"] = lead_curve(self._lead, "registrations", capacity)
+            response["booked_after_start"] = self._lead[0]
+            response["sell_out_curve"] = lead_curve(self._sold_out, "classes")
+        return response
+
+
+def fill_rate(registered, capacity):
+    return round(registered / capacity, 4) if capacity > 0 else None
+
+
+# Дни недели — по порядку недели, остальные разрезы — по имени
+def group_order(kind, key):
+    if kind == 'weekday':
+        return WEEKDAYS.index(key) if key is not None else len(WEEKDAYS)
+    return (key is None, str(key))
+
+
+# Кривая по корзинам времени записи: для каждой границы — сколько сделано не
+# позже чем за столько часов до начала занятия, и доля от всех с известным
+# временем; с capacity — ещё и средняя заполняемость к этому моменту
+def lead_curve(buckets, name, capacity=None):
+    total = sum(buckets)
+    points = []
+    cumulative = 0
+    for index in range(len(LEAD_HOURS), 0, -1):
+        cumulative += buckets[index]
+        point = {"hours_before_start": LEAD_HOURS[index - 1], name: cumulative,
+                 "share": round(cumulative / total, 4) if total else None}
+        if capacity is not None:
+            point["fill_rate"] = fill_rate(cumulative, capacity)
+        points.append(point)
+    return points
@@ -0,0 +1,201 @@
+import heapq
+import threading
+from datetime import datetime, time, timedelta, timezone
+
+from schedule_store import datetime_key
+
+# Дни недели в правилах повторения (как BYDAY в RRULE), понедельник — 0
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# Длина периода повторения в днях
+FREQUENCIES = {'DAILY': 1, 'WEEKLY': 7}
+
+
+class InvalidRule(ValueError):
+    pass
+
+
+# Граница UNTIL: дата (включительно весь день) или время, 'Z' — UTC
+def parse_until(value):
+    try:
+        if 'T' not in value:
+            return datetime.combine(datetime.strptime(value, '%Y%m%d').date(), time.max), False
+        if value.endswith('Z'):
+            return datetime.strptime(value[:-1], '%Y%m%dT%H%M%S'), True
+        return datetime.strptime(value, '%Y%m%dT%H%M%S'), False
+    except ValueError:
+        raise InvalidRule(f"Некорректное значение UNTIL: {value!r}.") from None
+
+
+# Правило повторения в духе RRULE: FREQ=DAILY|WEEKLY, INTERVAL, BYDAY, UNTIL,
+# например "FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;UNTIL=20261231".
+# start — строка datetime первого занятия; повторения идут в его местном
+# времени (со смещением start, без смещения — как UTC) не раньше start.
+class Recurrence:
+    def __init__(self, start, rule):
+        try:
+            parsed = datetime.fromisoformat(start.replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            raise InvalidRule(f"Некорректное время начала: {start!r}.") from None
+        self.start = parsed.replace(tzinfo=None)
+        self.offset = parsed.utcoffset() or timedelta(0)
+        # Суффикс часового пояса, с которым записываются времена повторений
+        if parsed.tzinfo is None:
+            self.suffix = ''
+        elif start.endswith('Z'):
+            self.suffix = 'Z'
+        else:
+            self.suffix = parsed.isoformat()[-6:]
+
+        parts = {}
+        for part in (rule or '').split(';'):
+            key, sep, value = part.partition('=')
+            if not sep or not value:
+                raise InvalidRule(f"Некорректная часть правила: {part!r}.")
+            parts[key.strip().upper()] = value.strip().upper()
+
+        self.period = FREQUENCIES.get(parts.pop('FREQ', None))
+        if self.period is None:
+            raise InvalidRule("FREQ должно быть DAILY или WEEKLY.")
+        try:
+            self.interval = int(parts.pop('INTERVAL', '1'))
+        except ValueError:
+            self.interval = 0
+        if self.interval <= 0:
+            raise InvalidRule("INTERVAL должно быть положительным целым числом.")
+        byday = parts.pop('BYDAY', None)
+        if byday is None:
+            # Без BYDAY: еженедельное — в день недели первого занятия, ежедневное — каждый день
+            self.weekdays = [self.start.weekday()] if self.period == 7 else list(range(7))
+        else:
+            try:
+                self.weekdays = sorted({WEEKDAYS.index(day) for day in byday.split(',')})
+            except ValueError:
+                raise InvalidRule(f"Некорректное значение BYDAY: {byday!r}.") from None
+        self.until = None
+        until = parts.pop('UNTIL', None)
+        if until is not None:
+            self.until, in_utc = parse_until(until)
+            if in_utc:
+                self.until += self.offset
+        if parts:
+            raise InvalidRule(f"Неподдерживаемые части правила: {', '.join(sorted(parts))}.")
+
+    # Местное время повторения -> ключ сортировки (наивное UTC), как datetime_key
+    def key(self, local):
+        return local - self.offset
+
+    def format(self, local):
+        return local.isoformat() + self.suffix
+
+    # Повторения (местное время) с ключами в интервале [start, end) по возрастанию.
+    # Генератор начинает сразу с периода, в который попадает start, поэтому
+    # стоимость не зависит от того, как давно начался шаблон. Без end и UNTIL
+    # генератор бесконечный.
+    def occurrences(self, start=None, end=None):
+        first = self.start if start is None else max(self.start, start + self.offset)
+        last = None if end is None else end + self.offset
+        if self.until is not None and (last is None or self.until < last):
+            last = self.until + timedelta(microseconds=1)
+        # Начало первого периода: неделя считается с понедельника
+        origin = self.start.date() - timedelta(days=self.start.weekday() if self.period == 7 else 0)
+        skipped = max(0, (first.date() - origin).days // (self.period * self.interval))
+        period_start = origin + timedelta(days=skipped * self.period * self.interval)
+        while True:
+            for offset in range(self.period):
+                day = period_start + timedelta(days=offset)
+                if day.weekday() not in self.weekdays:
+                    continue
+                local = datetime.combine(day, self.start.time())
+                if last is not None and local >= last:
+                    return
+                if local >= first:
+                    yield local
+            period_start += timedelta(days=self.period * self.interval)
+
+    # Есть ли повторение в этот момент (местное время)
+    def includes(self, local):
+        return next(self.occurrences(self.key(local), self.key(local) + timedelta(microseconds=1)), None) == local
+
+
+# ID повторения: "<ID шаблона>@<местное время без пояса>", например "3@2026-01-05T10:00:00"
+def occurrence_id(template_id, local):
+    return f"{template_id}@{local.isoformat()}"
+
+
+# Шаблоны повторяющихся занятий. Повторения не хранятся: они порождаются
+# генератором для запрошенного интервала. Занятие с собственным счётчиком
+# создаётся только при первой записи на повторение (см. app.resolve_class_id).
+class RecurringSchedule:
+    def __init__(self, templates=()):
+        self._templates = {}
+        # Создание занятий из повторений идёт по одному
+        self.lock = threading.Lock()
+        self.replace(templates)
+
+    def __len__(self):
+        return len(self._templates)
+
+    # Замена всех шаблонов (загрузка из хранилища)
+    def replace(self, templates):
+        self._templates = {template['id']: (template, Recurrence(template['datetime'], template['rrule']))
+                           for template in templates}
+
+    def add(self, template):
+        templates = dict(self._templates)
+        templates[template['id']] = (template, Recurrence(template['datetime'], template['rrule']))
+        self._templates = templates
+
+    def all(self):
+        return [template for template, _ in self._templates.values()]
+
+    def _occurrence(self, template, recurrence, local):
+        return {
+            "id": occurrence_id(template['id'], local),
+            "name": template['name'],
+            "instructor": template['instructor'],
+            "datetime": recurrence.format(local),
+            "capacity": template['capacity'],
+            "registered": 0,
+            "template_id": template['id'],
+            "occurrence_id": occurrence_id(template['id'], local)
+        }
+
+    def _expand(self, template, recurrence, start, end):
+        for local in recurrence.occurrences(start, end):
+            yield recurrence.key(local), self._occurrence(template, recurrence, local)
+
+    # Повторения всех шаблонов в интервале [start, end) в порядке времени
+    def occurrences(self, start=None, end=None, instructor=None):
+        streams = [self._expand(template, recurrence, start, end)
+                   for template, recurrence in self._templates.values()
+                   if instructor is None or template['instructor'] == instructor]
+        for _, occurrence in heapq.merge(*streams, key=lambda item: item[0]):
+            yield occurrence
+
+    # Повторение по ID (None, если шаблона нет или в это время повторения нет)
+    def occurrence(self, value):
+        if not isinstance(value, str):
+            return None
+        template_id, sep, local = value.partition('@')
+        try:
+            entry = self._templates.get(int(template_id))
+            local = datetime.fromisoformat(local)
+        except ValueError:
+            return None
+        if not sep or entry is None or local.tzinfo is not None:
+            return None
+        template, recurrence = entry
+        if not recurrence.includes(local):
+            return None
+        return self._occurrence(template, recurrence, local)
+
+
+# Начало текущих суток (UTC): от него отсчитывается горизонт повторений в полном расписании
+def today():
+    return datetime.combine(datetime.now(timezone.utc).date(), time.min)
+
+
+# Ключ сортировки занятия или повторения
+def start_key(fitness_class):
+    return datetime_key(fitness_class['datetime'])
@@ -0,0 +1,159 @@
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from schedule_store import datetime_key
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = EPOCH.replace(tzinfo=timezone.utc)
+
+# Время регистрации, которое не удалось разобрать (datetime_key вернул datetime.min)
+MISSING_TIME = -(2 ** 63)
+
+# Код отсутствующего значения в словарных столбцах
+ABSENT = -1
+
+
+# Наивное время в UTC -> микросекунды от начала эпохи
+def time_micros(value):
+    if value == datetime.min:
+        return MISSING_TIME
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+# Микросекунды от начала эпохи -> строка в формате datetime.now(timezone.utc).isoformat()
+def format_time(micros):
+    return (EPOCH_UTC + timedelta(microseconds=micros)).isoformat()
+
+
+# Словарь строк: каждая уникальная строка хранится один раз, в столбце — её код
+class StringPool:
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+    # Код строки без добавления (ABSENT, если такой строки нет)
+    def lookup(self, value):
+        return self.codes.get(value, ABSENT)
+
+
+# Регистрации по столбцам: ID регистрации и занятия — массивы целых, время —
+# микросекунды от начала эпохи, имя и телефон — коды в словарях строк.
+# Словари регистраций собираются только при выдаче. Запись, которую
+# столбцы не воспроизводят в точности (лишние поля, другой формат времени,
+# нестроковые значения), целиком хранится в overflow.
+class RegistrationColumns:
+    def __init__(self):
+        self.registration_ids = array('q')
+        self.class_ids = array('q')
+        self.times = array('q')
+        self.name_codes = array('i')
+        self.phone_codes = array('i')
+        self.names = StringPool()
+        self.phones = StringPool()
+        self.overflow = {}
+
+    def __len__(self):
+        return len(self.registration_ids)
+
+    def _code(self, pool, registration, key):
+        value = registration.get(key)
+        if isinstance(value, str):
+            return pool.encode(value)
+        return ABSENT
+
+    # Добавление записи; возвращает её позицию
+    def append(self, registration):
+        if not isinstance(registration, dict):
+            registration_id, class_id, registered_at, name_code, phone_code = 0, -1, MISSING_TIME, ABSENT, ABSENT
+        else:
+            registration_id = registration.get('registration_id', 0)
+            class_id = registration.get('class_id')
+            if not isinstance(registration_id, int):
+                registration_id = 0
+            if not isinstance(class_id, int):
+                class_id = -1
+            registered_at = time_micros(datetime_key(registration.get('registration_time')))
+            name_code = self._code(self.names, registration, 'user_name')
+            phone_code = self._code(self.phones, registration, 'phone_number')
+        position = len(self.registration_ids)
+        self.class_ids.append(class_id)
+        self.times.append(registered_at)
+        self.name_codes.append(name_code)
+        self.phone_codes.append(phone_code)
+        self.registration_ids.append(registration_id)
+        if self._build(position) != registration:
+            self.overflow[position] = registration
+        return position
+
+    def _build(self, position):
+        registration = {
+            "registration_id": self.registration_ids[position],
+            "class_id": self.class_ids[position]
+        }
+        name_code = self.name_codes[position]
+        if name_code != ABSENT:
+            registration["user_name"] = self.names.values[name_code]
+        phone_code = self.phone_codes[position]
+        if phone_code != ABSENT:
+            registration["phone_number"] = self.phones.values[phone_code]
+        registered_at = self.times[position]
+        if registered_at != MISSING_TIME:
+            registration["registration_time"] = format_time(registered_at)
+        return registration
+
+    # Словарь регистрации для ответа
+    def record(self, position):
+        registration = self.overflow.get(position)
+        if registration is not None:
+            return registration
+        return self._build(position)
+
+    # Проверка фильтров по столбцам без сборки словаря. phone_code — код из
+    # self.phones.lookup или None, время — микросекунды (интервал [time_from, time_to))
+    def matches(self, position, phone_code=None, time_from=None, time_to=None):
+        if phone_code is not None and self.phone_codes[position] != phone_code:
+            return False
+        if time_from is not None and self.times[position] < time_from:
+            return False
+        if time_to is not None and self.times[position] >= time_to:
+            return False
+        return True
+
+    # Первые count записей: массивы подряд, затем словари и overflow в JSON
+    def to_file(self, f, count):
+        for values in (self.registration_ids, self.class_ids, self.times, self.name_codes, self.phone_codes):
+            values[:count].tofile(f)
+        overflow = {str(position): record for position, record in self.overflow.items() if position < count}
+        extra = json.dumps({
+            "names": self.names.values,
+            "phones": self.phones.values,
+            "overflow": overflow
+        }, ensure_ascii=False).encode('utf-8')
+        f.write(len(extra).to_bytes(8, 'little'))
+        f.write(extra)
+
+    @classmethod
+    def from_file(cls, f, count):
+        columns = cls()
+        for values in (columns.registration_ids, columns.class_ids, columns.times,
+                       columns.name_codes, columns.phone_codes):
+            values.fromfile(f, count)
+        size = int.from_bytes(f.read(8), 'little')
+        extra = json.loads(f.read(size).decode('utf-8'))
+        columns.names = StringPool(extra['names'])
+        columns.phones = StringPool(extra['phones'])
+        columns.overflow = {int(position): record for position, record in extra['overflow'].items()}
+        return columns
@@ -0,0 +1,340 @@
+import bisect
+import io
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from array import array
+
+from registration_columns import ABSENT, RegistrationColumns, time_micros
+
+log = logging.getLogger(__name__)
+
+# Заголовок индекса users.txt.idx: сигнатура, проиндексированный размер
+# users.txt, число записей, последний ID регистрации, число занятий,
+# inode users.txt и контрольная сумма последних проиндексированных байтов
+INDEX_MAGIC = b'FITIDX03'
+INDEX_HEADER = struct.Struct('<8sqqqqQq')
+
+# Сколько последних проиндексированных байтов users.txt сверяется при загрузке
+TAIL_CHECK_BYTES = 4096
+
+
+# Признак users.txt, проиндексированного до размера size: inode и CRC32
+# последних байтов. Совпадает, только если файл с тех пор лишь дописывали.
+def file_check(path, size):
+    try:
+        with open(path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            start = max(0, size - TAIL_CHECK_BYTES)
+            f.seek(start)
+            tail = f.read(size - start)
+    except FileNotFoundError:
+        return 0, 0
+    return inode, zlib.crc32(tail)
+
+
+# Ключ пары (занятие, код телефона) в множестве записей участников
+def booking_key(class_id, phone_code):
+    return (class_id << 32) | phone_code
+
+
+# Журнал регистраций users.txt с индексом в памяти: смещения строк в файле
+# и сами регистрации по столбцам (RegistrationColumns), без словаря на запись.
+# Для участников (по телефону) хранятся позиции их записей и множество
+# пар (занятие, телефон) — для проверки повторной записи за O(1).
+# Фильтры проверяются по столбцам, словари собираются только для ответа,
+# а исходные строки (для NDJSON) читаются с диска по смещению. Индекс
+# сохраняется рядом (users.txt.idx), при старте загружается целиком
+# и дочитывает только новый хвост users.txt.
+class RegistrationLog:
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.size = 0
+        self.last_id = 0
+        self.offsets = array('q')
+        self.columns = RegistrationColumns()
+        self._by_class = {}
+        self._by_phone = {}
+        self._booked = set()
+        self._saved_size = -1
+        self._file_check = None
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Загрузка индекса и дочитывание хвоста; возвращает число новых записей
+    def load(self):
+        if not self._load_index():
+            self._reset()
+        if self.size and not self._indexed_file_unchanged():
+            # Файл был усечён, заменён или переписан — индекс не годится
+            log.warning("%s изменён не дописыванием, индекс перестраивается.", self.path)
+            self._reset()
+        added = self.refresh()
+        if self.size != self._saved_size:
+            self.save_index()
+        return added
+
+    def _indexed_file_unchanged(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < self.size:
+            return False
+        return file_check(self.path, self.size) == self._file_check
+
+    def _reset(self):
+        self.size = 0
+        self._saved_size = -1
+        self.last_id = 0
+        self.offsets = array('q')
+        self.columns = RegistrationColumns()
+        self._by_class = {}
+        self._by_phone = {}
+        self._booked = set()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, size, count, last_id, class_count, inode, checksum = INDEX_HEADER.unpack(
+                    f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC:
+                    return False
+                offsets, positions, classes, starts = [array('q') for _ in range(4)]
+                offsets.fromfile(f, count)
+                positions.fromfile(f, count)
+                classes.fromfile(f, class_count)
+                starts.fromfile(f, class_count)
+                columns = RegistrationColumns.from_file(f, count)
+        except (OSError, EOFError, ValueError, KeyError, struct.error):
+            log.warning("Не удалось прочитать %s, индекс перестраивается.", self.index_path)
+            return False
+        self.size = size
+        self.last_id = last_id
+        self._file_check = (inode, checksum)
+        self.offsets = offsets
+        self.columns = columns
+        self._by_class = {}
+        for n, class_id in enumerate(classes):
+            end = starts[n + 1] if n + 1 < class_count else count
+            self._by_class[class_id] = positions[starts[n]:end]
+        # Индекс участников не сохраняется, а собирается по столбцу телефонов
+        self._by_phone = {}
+        self._booked = set()
+        for position, phone_code in enumerate(columns.phone_codes):
+            if phone_code != ABSENT:
+                self._index_phone(position, columns.class_ids[position], phone_code)
+        self._saved_size = size
+        return True
+
+    # Атомарное сохранение индекса (собирается в памяти под блокировкой,
+    # на диск пишется уже без неё)
+    def save_index(self):
+        with self._lock:
+            size = self.size
+            count = len(self.offsets)
+            inode, checksum = file_check(self.path, size)
+            classes = array('q', sorted(self._by_class))
+            positions = array('q')
+            starts = array('q')
+            for class_id in classes:
+                starts.append(len(positions))
+                positions.extend(self._by_class[class_id])
+            data = io.BytesIO()
+            data.write(INDEX_HEADER.pack(INDEX_MAGIC, size, count, self.last_id, len(classes), inode, checksum))
+            for values in (self.offsets[:count], positions, classes, starts):
+                values.tofile(data)
+            self.columns.to_file(data, count)
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data.getbuffer())
+            os.replace(tmp_path, self.index_path)
+            self._saved_size = size
+            self._file_check = (inode, checksum)
+        except OSError as e:
+            log.error("Ошибка при сохранении индекса %s: %s", self.index_path, e)
+
+    def _index_phone(self, position, class_id, phone_code):
+        self._by_phone.setdefault(phone_code, array('q')).append(position)
+        self._booked.add(booking_key(class_id, phone_code))
+
+    # Столбцы и индексы дополняются раньше смещения: читатели видят запись
+    # только после появления её смещения (len(self.offsets))
+    def _add(self, offset, registration):
+        position = self.columns.append(registration)
+        class_id = self.columns.class_ids[position]
+        registration_id = self.columns.registration_ids[position]
+        self._by_class.setdefault(class_id, array('q')).append(position)
+        phone_code = self.columns.phone_codes[position]
+        if phone_code != ABSENT:
+            self._index_phone(position, class_id, phone_code)
+        self.offsets.append(offset)
+        if registration_id > self.last_id:
+            self.last_id = registration_id
+
+    # Дочитывание users.txt с проиндексированного размера до конца файла;
+    # недописанная последняя строка остаётся на следующий раз
+    def refresh(self):
+        if not os.path.exists(self.path):
+            return 0
+        with self._lock:
+            return self._scan()
+
+    def _scan(self):
+        added = 0
+        with open(self.path, 'rb') as f:
+            f.seek(self.size)
+            offset = self.size
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                # Размер сдвигается раньше, чем появляется смещение новой строки,
+                # чтобы параллельное чтение последней записи не получило пустой отрезок
+                self.size = offset + len(line)
+                try:
+                    registration = json.loads(line)
+                except ValueError:
+                    log.warning("Некорректная строка в users.txt, пропущена.")
+                else:
+                    self._add(offset, registration)
+                    added += 1
+                offset += len(line)
+        return added
+
+    # Учёт пакета, только что записанного GroupCommitWriter (вызывается в его потоке).
+    # Если между пакетами в файл писали другие процессы, сначала дочитываем их строки.
+    def index_batch(self, start, batch):
+        with self._lock:
+            if start != self.size:
+                self._scan()
+                return
+            offset = start
+            for pending in batch:
+                for size, record in zip(pending.sizes, pending.records):
+                    self.size = offset + size
+                    self._add(offset, record)
+                    offset += size
+
+    # Исходная строка записи без перевода строки (в том числе \r\n из файлов,
+    # сохранённых в Windows)
+    def _read_line(self, position):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        offset = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.size
+        data = os.pread(self._fd, end - offset, offset)
+        return data.split(b'\n', 1)[0].rstrip(b'\r')
+
+    # Запись по её порядковому номеру в файле (собирается из столбцов)
+    def get(self, position):
+        return self.columns.record(position)
+
+    # Все записи в порядке файла
+    def iter_all(self, start=0):
+        count = len(self.offsets)
+        for position in range(start, count):
+            yield self.get(position)
+
+    # Позиции записей начиная с start в порядке файла, подходящие под фильтры:
+    # class_id — по индексу занятий, телефон и интервал времени регистрации
+    # [time_from, time_to) (наивное UTC) — по столбцам, без чтения файла
+    def positions(self, start=0, class_id=None, phone_number=None, time_from=None, time_to=None):
+        count = len(self.offsets)
+        class_ids = self.columns.class_ids
+        if phone_number is not None:
+            # Записи участника по индексу телефонов, занятие проверяется по столбцу
+            phone_code = self.columns.phones.lookup(phone_number)
+            phone_positions = self._by_phone.get(phone_code, array('q'))
+            positions = phone_positions[bisect.bisect_left(phone_positions, start):len(phone_positions)]
+        elif class_id is not None:
+            class_positions = self._by_class.get(class_id, array('q'))
+            positions = class_positions[bisect.bisect_left(class_positions, start):len(class_positions)]
+            class_id = None
+        else:
+            positions = range(start, count)
+        low = time_micros(time_from) if time_from is not None else None
+        high = time_micros(time_to) if time_to is not None else None
+        filtered = low is not None or high is not None
+        for position in positions:
+            if position >= count:
+                break
+            if class_id is not None and class_ids[position] != class_id:
+                continue
+            if filtered and not self.columns.matches(position, None, low, high):
+                continue
+            yield position
+
+    # Сырые строки (без перевода строки) подходящих записей: (позиция, строка)
+    def scan(self, start=0, class_id=None, phone_number=None, time_from=None, time_to=None):
+        for position in self.positions(start, class_id, phone_number, time_from, time_to):
+            yield position, self._read_line(position)
+
+    # Есть ли уже запись участника с этим телефоном на занятие
+    def has_booking(self, class_id, phone_number):
+        if not isinstance(class_id, int) or not isinstance(phone_number, str):
+            return False
+        phone_code = self.columns.phones.lookup(phone_number)
+        return phone_code != ABSENT and booking_key(class_id, phone_code) in self._booked
+
+    # Записи участника в порядке файла
+    def iter_member(self, phone_number):
+        phone_code = self.columns.phones.lookup(phone_number)
+        if phone_code == ABSENT:
+            return
+        positions = self._by_phone.get(phone_code, ())
+        count = len(self.offsets)
+        for position in positions[:len(positions)]:
+            if position < count:
+                yield self.get(position)
+
+    # Исходные строки записей указанных занятий в порядке файла
+    def class_lines(self, class_ids):
+        positions = sorted(position for class_id in class_ids for position in self._by_class.get(class_id, ()))
+        return [self._read_line(position) + b'\n' for position in positions]
+
+    # Перезапись users.txt без записей указанных занятий и перестройка индекса;
+    # возвращает число удалённых записей. Вызывается, пока запись в файл
+    # приостановлена (GroupCommitWriter.paused). Позиции и курсоры после
+    # перезаписи сдвигаются.
+    def drop_classes(self, class_ids):
+        with self._lock:
+            drop = {self.offsets[position] for class_id in class_ids for position in self._by_class.get(class_id, ())}
+            if not drop:
+                return 0
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+                                            dir=os.path.dirname(self.path) or '.')
+            try:
+                with open(fd, 'wb') as out, open(self.path, 'rb') as f:
+                    offset = 0
+                    for line in f:
+                        if offset not in drop:
+                            out.write(line)
+                        offset += len(line)
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            # ID архивных записей не должны выдаваться снова
+            last_id = self.last_id
+            self.close()
+            self._reset()
+            self._scan()
+            self.last_id = max(self.last_id, last_id)
+        self.save_index()
+        return len(drop)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
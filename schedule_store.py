@@ -0,0 +1,324 @@
+import bisect
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+# Число блокировок, на которые распределяются занятия при бронировании
+LOCK_STRIPES = 64
+
+# Сколько последних изменений помнит лента для дельта-синхронизации
+CHANGE_LOG_SIZE = 10000
+
+
+class ClassNotFound(LookupError):
+    pass
+
+
+class ClassFull(Exception):
+    pass
+
+
+# Ключ сортировки занятий по дате: наивное время в UTC.
+# Некорректные даты из старых файлов уходят в начало индекса.
+def datetime_key(value):
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return datetime.min
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+# Хранилище расписания в памяти: поиск занятия по ID за O(1),
+# монотонный генератор ID и индекс, отсортированный по дате
+class ScheduleStore:
+    # counters — SharedCounters для режима нескольких процессов: тогда счётчики
+    # мест и ID занятий берутся из общей памяти, а словари занятий — их копия
+    def __init__(self, classes=(), counters=None, change_log_size=CHANGE_LOG_SIZE):
+        self.counters = counters
+        self._lock = threading.Lock()
+        # Блокировки бронирования: занятие с ID n защищено блокировкой n % LOCK_STRIPES,
+        # поэтому записи на разные занятия не ждут друг друга
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._classes = []
+        self._by_id = {}
+        self._by_time = []
+        # Занятия, созданные из повторений шаблонов: occurrence_id -> занятие
+        self._by_occurrence = {}
+        self._next_id = 1
+        # Места, занятые в памяти, но ещё не сохранённые хранилищем: ID -> число.
+        # Счётчики таких занятий не перезаписываются значениями из хранилища
+        # (sync_from), а помечаются (_stale) и сверяются, когда записи закончатся.
+        self._pending = {}
+        self._stale = set()
+        # Номер версии данных растёт при каждом изменении расписания или счётчиков.
+        # Отсчёт начинается с текущего времени в микросекундах, поэтому версия,
+        # полученная клиентом до перезапуска, всегда меньше новых.
+        # Лента изменений — кольцевой буфер пар (версия, ID занятия); блокировка
+        # держится только на время добавления в ленту.
+        self.version = time.time_ns() // 1000
+        self._changes_floor = self.version
+        self._changes = deque(maxlen=change_log_size)
+        self._changes_lock = threading.Lock()
+        for fitness_class in classes:
+            self._insert(fitness_class)
+
+    def _insert(self, fitness_class):
+        self._classes.append(fitness_class)
+        self._by_id[fitness_class['id']] = fitness_class
+        bisect.insort(self._by_time, (datetime_key(fitness_class['datetime']), fitness_class['id']))
+        if 'occurrence_id' in fitness_class:
+            self._by_occurrence[fitness_class['occurrence_id']] = fitness_class
+        if fitness_class['id'] >= self._next_id:
+            self._next_id = fitness_class['id'] + 1
+
+    @property
+    def next_id(self):
+        return self._next_id
+
+    def __len__(self):
+        return len(self._classes)
+
+    def __contains__(self, class_id):
+        return class_id in self._by_id
+
+    # Поиск занятия по ID (None, если не найдено)
+    def get(self, class_id):
+        return self._by_id.get(class_id)
+
+    # Занятие, созданное из повторения шаблона (None, если его ещё нет)
+    def find_occurrence(self, occurrence_id):
+        return self._by_occurrence.get(occurrence_id)
+
+    # Все занятия в порядке добавления (список не копируется — только для чтения)
+    def all(self):
+        return self._classes
+
+    # Добавление занятия с новым ID
+    def add(self, fields):
+        with self._lock:
+            if self.counters is not None:
+                new_id = self.counters.allocate_class_id(fields.get('registered', 0))
+            else:
+                new_id = self._next_id
+            fitness_class = {"id": new_id, **fields}
+            self._insert(fitness_class)
+        self._record_change(fitness_class['id'])
+        return fitness_class
+
+    # Добавление занятий, созданных в других процессах (известные ID пропускаются)
+    def merge(self, classes):
+        added = []
+        with self._lock:
+            for fitness_class in classes:
+                if fitness_class['id'] not in self._by_id:
+                    self._insert(fitness_class)
+                    added.append(fitness_class['id'])
+        for class_id in added:
+            self._record_change(class_id)
+        return len(added)
+
+    # Удаление занятий (перенос в архив). Лента изменений не умеет сообщать
+    # об удалении, поэтому она сбрасывается. Возвращает удалённые занятия.
+    def remove(self, class_ids):
+        class_ids = set(class_ids)
+        with self._lock:
+            removed = [self._by_id[class_id] for class_id in class_ids if class_id in self._by_id]
+            if not removed:
+                return []
+            for fitness_class in removed:
+                del self._by_id[fitness_class['id']]
+                if self._by_occurrence.get(fitness_class.get('occurrence_id')) is fitness_class:
+                    del self._by_occurrence[fitness_class['occurrence_id']]
+            # Новые списки вместо изменения на месте: all() мог отдать старый список читателю
+            self._classes = [c for c in self._classes if c['id'] not in class_ids]
+            self._by_time = [entry for entry in self._by_time if entry[1] not in class_ids]
+        self.reset_changes()
+        return removed
+
+    # Новая версия без записи в ленту: все прежние версии получат полный снимок.
+    # Для изменений, о которых лента сообщить не может (удаление занятий,
+    # новые шаблоны повторений, сдвиг горизонта повторений)
+    def reset_changes(self):
+        with self._changes_lock:
+            self.version += 1
+            self._changes_floor = self.version
+            self._changes.clear()
+
+    # Приведение к изменениям из хранилища (сделанным другими процессами):
+    # новые занятия добавляются, у известных обновляются поля, removed_ids
+    # (их перенёс в архив другой процесс) удаляются. Счётчик registered занятия,
+    # на которое в этом процессе идёт запись, остаётся прежним: в хранилище
+    # ещё нет её места. Такое занятие сверяется позже (stale_counters).
+    # Возвращает число изменённых занятий.
+    def sync_from(self, classes, removed_ids=()):
+        self.remove(removed_ids)
+        changed = []
+        with self._lock:
+            for fitness_class in classes:
+                class_id = fitness_class['id']
+                current = self._by_id.get(class_id)
+                if current is None:
+                    self._insert(fitness_class)
+                    changed.append(class_id)
+                    continue
+                with self._stripe(class_id):
+                    fields = fitness_class
+                    if self._pending.get(class_id):
+                        fields = {key: value for key, value in fitness_class.items() if key != 'registered'}
+                        self._stale.add(class_id)
+                    else:
+                        self._stale.discard(class_id)
+                    if all(current.get(key) == value for key, value in fields.items()):
+                        continue
+                    if current['datetime'] != fields['datetime']:
+                        self._by_time.remove((datetime_key(current['datetime']), class_id))
+                        bisect.insort(self._by_time, (datetime_key(fields['datetime']), class_id))
+                    current.update(fields)
+                changed.append(class_id)
+        for class_id in changed:
+            self._record_change(class_id)
+        return len(changed)
+
+    # Занятия, счётчик которых sync_from пропустил из-за идущей записи
+    # и которые теперь можно сверить с хранилищем
+    def stale_counters(self):
+        if not self._stale:
+            return []
+        with self._lock:
+            return [class_id for class_id in self._stale if not self._pending.get(class_id)]
+
+    # Правка расписания вручную: занятия с новыми ID добавляются, removed_ids
+    # удаляются, у остальных поля обновляются на месте — кроме счётчика
+    # registered: в памяти он живой и учитывает идущие записи, а в файле мог
+    # устареть. Вместимость меняется под блокировкой бронирования занятия.
+    # Возвращает (добавлено, удалено, изменено).
+    def apply_edits(self, classes, removed_ids=()):
+        removed = self.remove(removed_ids)
+        added = []
+        changed = []
+        with self._lock:
+            for fitness_class in classes:
+                current = self._by_id.get(fitness_class['id'])
+                if current is None:
+                    self._insert({"registered": 0, **fitness_class})
+                    added.append(fitness_class['id'])
+                    continue
+                fields = {key: value for key, value in fitness_class.items() if key != 'registered'}
+                if all(current.get(key) == value for key, value in fields.items()):
+                    continue
+                with self._stripe(current['id']):
+                    if current['datetime'] != fields['datetime']:
+                        self._by_time.remove((datetime_key(current['datetime']), current['id']))
+                        bisect.insort(self._by_time, (datetime_key(fields['datetime']), current['id']))
+                    current.update(fields)
+                changed.append(current['id'])
+        for class_id in added + changed:
+            self._record_change(class_id)
+        return len(added), len(removed), len(changed)
+
+    # Обновление локальных копий счётчиков из общей памяти
+    def refresh_counters(self):
+        if self.counters is None:
+            return
+        for fitness_class in self._classes:
+            registered = self.counters.get(fitness_class['id'])
+            if fitness_class['registered'] != registered:
+                fitness_class['registered'] = registered
+                self._record_change(fitness_class['id'])
+
+    # Занятия в интервале [start, end) в порядке времени; границы могут быть None
+    def between(self, start=None, end=None):
+        lo = 0 if start is None else bisect.bisect_left(self._by_time, (start,))
+        hi = len(self._by_time) if end is None else bisect.bisect_left(self._by_time, (end,))
+        for _, class_id in self._by_time[lo:hi]:
+            # Занятие могло быть удалено после взятия среза
+            fitness_class = self._by_id.get(class_id)
+            if fitness_class is not None:
+                yield fitness_class
+
+    # Запись изменения занятия в ленту (после того как само изменение сделано)
+    def _record_change(self, class_id):
+        with self._changes_lock:
+            self.version += 1
+            if len(self._changes) == self._changes.maxlen:
+                # Вытесняемая запись: версии до неё лента больше не помнит
+                self._changes_floor = self._changes[0][0]
+            self._changes.append((self.version, class_id))
+
+    # Занятия, изменённые после версии since: (текущая версия, список занятий)
+    # или (текущая версия, None), если лента уже не помнит версию since
+    def changes_since(self, since):
+        with self._changes_lock:
+            version = self.version
+            if since > version or since < self._changes_floor:
+                return version, None
+            changed_ids = []
+            for change_version, class_id in reversed(self._changes):
+                if change_version <= since:
+                    break
+                changed_ids.append(class_id)
+        seen = set()
+        changed = []
+        for class_id in reversed(changed_ids):
+            fitness_class = self._by_id.get(class_id)
+            if class_id not in seen and fitness_class is not None:
+                seen.add(class_id)
+                changed.append(fitness_class)
+        return version, changed
+
+    def _stripe(self, class_id):
+        return self._stripes[hash(class_id) % LOCK_STRIPES]
+
+    # Бронирование места: проверка вместимости и увеличение счётчика одним шагом.
+    # Возвращает занятие или бросает ClassNotFound / ClassFull.
+    def reserve(self, class_id):
+        fitness_class = self._by_id.get(class_id)
+        if fitness_class is None:
+            raise ClassNotFound(class_id)
+        with self._stripe(class_id):
+            if self.counters is not None:
+                registered = self.counters.try_increment(class_id, fitness_class['capacity'])
+                if registered is None:
+                    fitness_class['registered'] = self.counters.get(class_id)
+                    raise ClassFull(class_id)
+                fitness_class['registered'] = registered
+            elif fitness_class['registered'] >= fitness_class['capacity']:
+                raise ClassFull(class_id)
+            else:
+                fitness_class['registered'] += 1
+            self._pending[class_id] = self._pending.get(class_id, 0) + 1
+        self._record_change(class_id)
+        return fitness_class
+
+    # Место сохранено хранилищем: бронирование больше не идёт
+    def confirm(self, class_id):
+        with self._stripe(class_id):
+            self._settle(class_id)
+
+    # Возврат места, если запись не удалось сохранить. Если занятие тем временем
+    # убрали из расписания (архив), снимается только идущее бронирование и
+    # возвращается None.
+    def release(self, class_id):
+        with self._stripe(class_id):
+            fitness_class = self._by_id.get(class_id)
+            if fitness_class is None:
+                self._settle(class_id)
+                return None
+            if self.counters is not None:
+                fitness_class['registered'] = self.counters.add(class_id, -1)
+            else:
+                fitness_class['registered'] -= 1
+            self._settle(class_id)
+        self._record_change(class_id)
+        return fitness_class
+
+    # Снятие места из идущих записей (под блокировкой бронирования занятия)
+    def _settle(self, class_id):
+        pending = self._pending.get(class_id, 0) - 1
+        if pending > 0:
+            self._pending[class_id] = pending
+        else:
+            self._pending.pop(class_id, None)
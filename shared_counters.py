@@ -0,0 +1,168 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+# Счётчики, общие для всех процессов-воркеров: файл из 8-байтовых ячеек,
+# отображённый в память (MAP_SHARED). Расположение ячеек:
+#   [0, HEADER_SLOTS)                   — служебные значения
+#   [HEADER_SLOTS, +STRIPES)            — версии полос блокировки
+#   [HEADER_SLOTS + STRIPES + id]       — счётчик зарегистрированных занятия id
+SLOT = struct.Struct('q')
+HEADER_SLOTS = 8
+INITIALIZED, NEXT_CLASS_ID, NEXT_REGISTRATION_ID, VERSION = range(4)
+STRIPES = 64
+INITIAL_SLOTS = 4096
+
+
+class SharedCounters:
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Блокировки fcntl принадлежат процессу, поэтому потоки одного процесса
+        # дополнительно разделяются обычными блокировками
+        self._header_lock = threading.RLock()
+        self._header_depth = 0
+        self._mm = None
+        with self._header():
+            self._grow(INITIAL_SLOTS)
+
+    def _slot_offset(self, slot):
+        return slot * SLOT.size
+
+    def _class_slot(self, class_id):
+        return HEADER_SLOTS + STRIPES + class_id
+
+    # Увеличение файла и переотображение; старое отображение не закрывается,
+    # так как потоки могут ещё читать через него (оно видит тот же файл)
+    def _grow(self, slots):
+        size = os.fstat(self._fd).st_size
+        needed = self._slot_offset(slots)
+        if size < needed:
+            new_size = max(needed, size * 2)
+            os.ftruncate(self._fd, new_size)
+            size = new_size
+        if self._mm is None or len(self._mm) < size:
+            self._mm = mmap.mmap(self._fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _ensure_slot(self, slot):
+        if self._slot_offset(slot + 1) > len(self._mm):
+            with self._header():
+                self._grow(slot + 1)
+
+    def _read(self, slot):
+        self._ensure_slot(slot)
+        return SLOT.unpack_from(self._mm, self._slot_offset(slot))[0]
+
+    def _write(self, slot, value):
+        self._ensure_slot(slot)
+        SLOT.pack_into(self._mm, self._slot_offset(slot), value)
+
+    # Межпроцессная блокировка диапазона байт одной ячейки
+    @contextmanager
+    def _locked_slot(self, slot):
+        offset = self._slot_offset(slot)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT.size, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT.size, offset)
+
+    # Блокировка служебных ячеек; повторный вход из того же потока не снимает
+    # блокировку fcntl раньше времени
+    @contextmanager
+    def _header(self):
+        with self._header_lock:
+            self._header_depth += 1
+            try:
+                if self._header_depth == 1:
+                    with self._locked_slot(INITIALIZED):
+                        yield
+                else:
+                    yield
+            finally:
+                self._header_depth -= 1
+
+    def _stripe_slot(self, class_id):
+        return HEADER_SLOTS + class_id % STRIPES
+
+    # Полоса блокировки занятия; вызывающий держит и соответствующую
+    # блокировку потоков (ScheduleStore разбивает занятия на те же полосы)
+    def _stripe(self, class_id):
+        return self._locked_slot(self._stripe_slot(class_id))
+
+    def _bump(self, class_id):
+        stripe_slot = self._stripe_slot(class_id)
+        self._write(stripe_slot, self._read(stripe_slot) + 1)
+
+    # Первичное заполнение счётчиков; возвращает False, если файл уже
+    # заполнен другим воркером (тогда его значения главнее)
+    def seed(self, classes, next_registration_id):
+        with self._header():
+            if self._read(INITIALIZED):
+                return False
+            next_class_id = 1
+            for fitness_class in classes:
+                self._write(self._class_slot(fitness_class['id']), fitness_class['registered'])
+                next_class_id = max(next_class_id, fitness_class['id'] + 1)
+            self._write(NEXT_CLASS_ID, next_class_id)
+            self._write(NEXT_REGISTRATION_ID, next_registration_id)
+            self._write(INITIALIZED, 1)
+            self._mm.flush()
+            return True
+
+    def initialized(self):
+        return bool(self._read(INITIALIZED))
+
+    def get(self, class_id):
+        return self._read(self._class_slot(class_id))
+
+    # Проверка вместимости и увеличение счётчика под межпроцессной блокировкой;
+    # None, если мест нет
+    def try_increment(self, class_id, capacity):
+        slot = self._class_slot(class_id)
+        with self._stripe(class_id):
+            value = self._read(slot)
+            if value >= capacity:
+                return None
+            self._write(slot, value + 1)
+            self._bump(class_id)
+            return value + 1
+
+    def add(self, class_id, delta):
+        slot = self._class_slot(class_id)
+        with self._stripe(class_id):
+            value = self._read(slot) + delta
+            self._write(slot, value)
+            self._bump(class_id)
+            return value
+
+    # Выдача ID нового занятия и начального значения его счётчика
+    def allocate_class_id(self, registered=0):
+        with self._header():
+            class_id = self._read(NEXT_CLASS_ID)
+            self._write(NEXT_CLASS_ID, class_id + 1)
+            self._write(self._class_slot(class_id), registered)
+            self._write(VERSION, self._read(VERSION) + 1)
+            return class_id
+
+    def next_class_id(self):
+        return self._read(NEXT_CLASS_ID)
+
+    def allocate_registration_id(self):
+        with self._header():
+            registration_id = self._read(NEXT_REGISTRATION_ID)
+            self._write(NEXT_REGISTRATION_ID, registration_id + 1)
+            return registration_id
+
+    # Версия общего состояния: растёт при любом изменении счётчиков или расписания
+    def version(self):
+        total = self._read(VERSION)
+        for stripe in range(STRIPES):
+            total += self._read(HEADER_SLOTS + stripe)
+        return total
+
+    def close(self):
+        os.close(self._fd)
@@ -0,0 +1,234 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const scheduleDiv = document.getElementById('schedule');
+    const registrationModal = new bootstrap.Modal(document.getElementById('registration-form'));
+    const addScheduleModal = new bootstrap.Modal(document.getElementById('add-schedule-form'));
+    const form = document.getElementById('form');
+    const formMessage = document.getElementById('form-message');
+    const addScheduleButton = document.getElementById('add-schedule-button');
+    const addScheduleForm = document.getElementById('add-schedule');
+    const addScheduleMessage = document.getElementById('add-schedule-message');
+
+    // Карточки занятий по ID и версия расписания, до которой они актуальны
+    const cards = new Map();
+    let scheduleVersion = null;
+
+    // Создание карточки занятия
+    function createCard(cls) {
+        const col = document.createElement('div');
+        col.className = 'col';
+
+        const card = document.createElement('div');
+        card.className = 'card h-100';
+
+        const cardBody = document.createElement('div');
+        cardBody.className = 'card-body';
+
+        const cardTitle = document.createElement('h5');
+        cardTitle.className = 'card-title';
+
+        const instructor = document.createElement('p');
+        instructor.className = 'card-text';
+
+        const datetime = document.createElement('p');
+        datetime.className = 'card-text';
+
+        const capacity = document.createElement('p');
+        capacity.className = 'card-text';
+
+        const registered = document.createElement('p');
+        registered.className = 'card-text';
+
+        cardBody.appendChild(cardTitle);
+        cardBody.appendChild(instructor);
+        cardBody.appendChild(datetime);
+        cardBody.appendChild(capacity);
+        cardBody.appendChild(registered);
+
+        const cardFooter = document.createElement('div');
+        cardFooter.className = 'card-footer text-center';
+
+        const button = document.createElement('button');
+        button.className = 'btn btn-success btn-custom';
+        button.innerHTML = '<i class="bi bi-person-plus-fill"></i> Оформить';
+        button.onclick = () => openRegistrationModal(cls.id);
+
+        cardFooter.appendChild(button);
+
+        card.appendChild(cardBody);
+        card.appendChild(cardFooter);
+
+        col.appendChild(card);
+        scheduleDiv.appendChild(col);
+
+        return { col, cardTitle, instructor, datetime, capacity, registered };
+    }
+
+    // Заполнение карточки данными занятия (создаётся, если её ещё нет).
+    // Повторение шаблона и созданное из него при записи занятие — одна карточка.
+    function renderCard(cls) {
+        const key = cls.occurrence_id ?? cls.id;
+        let entry = cards.get(key);
+        if (!entry) {
+            entry = createCard(cls);
+            cards.set(key, entry);
+        }
+        entry.cardTitle.textContent = cls.name;
+        entry.instructor.innerHTML = `<strong>Инструктор:</strong> ${cls.instructor}`;
+        const date = new Date(cls.datetime);
+        entry.datetime.innerHTML = `<strong>Дата и Время:</strong> ${date.toLocaleString()}`;
+        entry.capacity.innerHTML = `<strong>Вместимость:</strong> ${cls.capacity}`;
+        entry.registered.innerHTML = `<strong>Зарегистрировано:</strong> ${cls.registered}`;
+    }
+
+    // Полная перерисовка расписания
+    function renderAll(classes) {
+        scheduleDiv.innerHTML = ''; // Очистить текущие карточки
+        cards.clear();
+        classes.forEach(renderCard);
+    }
+
+    function showScheduleError(error) {
+        console.error('Ошибка при загрузке расписания:', error);
+        scheduleDiv.innerHTML = '<p>Не удалось загрузить расписание.</p>';
+        cards.clear();
+        scheduleVersion = null;
+    }
+
+    // Функция для загрузки расписания целиком
+    function loadSchedule() {
+        fetch('/api/schedule')
+            .then(response => {
+                scheduleVersion = response.headers.get('X-Schedule-Version');
+                return response.json();
+            })
+            .then(renderAll)
+            .catch(showScheduleError);
+    }
+
+    // Догрузка только изменившихся занятий; если сервер уже не помнит
+    // нашу версию, он присылает расписание целиком
+    function syncSchedule() {
+        if (scheduleVersion === null) {
+            loadSchedule();
+            return;
+        }
+        fetch(`/api/schedule?since=${encodeURIComponent(scheduleVersion)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.full) {
+                    renderAll(data.classes);
+                } else {
+                    data.classes.forEach(renderCard);
+                }
+                scheduleVersion = String(data.version);
+            })
+            .catch(showScheduleError);
+    }
+
+    loadSchedule(); // Загрузить расписание при загрузке страницы
+
+    // Функция открытия модального окна регистрации
+    function openRegistrationModal(class_id) {
+        document.getElementById('class_id').value = class_id;
+        formMessage.innerHTML = '';
+        form.reset();
+        registrationModal.show();
+    }
+
+    // Функция открытия модального окна добавления расписания
+    function openAddScheduleModal() {
+        addScheduleMessage.innerHTML = '';
+        addScheduleForm.reset();
+        addScheduleModal.show();
+    }
+
+    // Обработчик кнопки добавления расписания
+    addScheduleButton.addEventListener('click', openAddScheduleModal);
+
+    // Обработка отправки формы регистрации
+    form.addEventListener('submit', function(e) {
+        e.preventDefault();
+
+        const class_id = document.getElementById('class_id').value;
+        const user_name = document.getElementById('user_name').value.trim();
+        const phone_number = document.getElementById('phone_number').value.trim();
+
+        // Простая валидация
+        if (!user_name || !phone_number) {
+            formMessage.innerHTML = '<div class="alert alert-danger" role="alert">Пожалуйста, заполните все поля.</div>';
+            return;
+        }
+
+        // Отправка данных на сервер
+        fetch('/api/register_web', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            // ID повторения шаблона ("3@2026-01-05T10:00:00") передаётся строкой
+            body: JSON.stringify({ class_id: /^\d+$/.test(class_id) ? parseInt(class_id) : class_id, user_name, phone_number })
+        })
+        .then(response => response.json().then(data => ({status: response.status, body: data})))
+        .then(result => {
+            if (result.status === 201) {
+                formMessage.innerHTML = '<div class="alert alert-success" role="alert">Регистрация прошла успешно!</div>';
+                // Обновить расписание
+                setTimeout(() => {
+                    registrationModal.hide();
+                    syncSchedule();
+                }, 1500);
+            } else {
+                formMessage.innerHTML = `<div class="alert alert-danger" role="alert">${result.body.message || 'Ошибка при регистрации.'}</div>`;
+            }
+        })
+        .catch(error => {
+            console.error('Ошибка при регистрации:', error);
+            formMessage.innerHTML = '<div class="alert alert-danger" role="alert">Произошла ошибка. Пожалуйста, попробуйте позже.</div>';
+        });
+    });
+
+    // Обработка отправки формы добавления расписания
+    addScheduleForm.addEventListener('submit', function(e) {
+        e.preventDefault();
+
+        const name = document.getElementById('name').value.trim();
+        const instructor = document.getElementById('instructor').value.trim();
+        const datetime = document.getElementById('datetime').value;
+        const capacity = parseInt(document.getElementById('capacity').value);
+
+        // Простая валидация
+        if (!name || !instructor || !datetime || !capacity) {
+            addScheduleMessage.innerHTML = '<div class="alert alert-danger" role="alert">Пожалуйста, заполните все поля.</div>';
+            return;
+        }
+
+        // Преобразование datetime в ISO формат
+        const datetimeISO = new Date(datetime).toISOString();
+
+        // Отправка данных на сервер
+        fetch('/api/schedule', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ name, instructor, datetime: datetimeISO, capacity })
+        })
+        .then(response => response.json().then(data => ({status: response.status, body: data})))
+        .then(result => {
+            if (result.status === 201) {
+                addScheduleMessage.innerHTML = '<div class="alert alert-success" role="alert">Занятие успешно добавлено!</div>';
+                // Обновить расписание
+                setTimeout(() => {
+                    addScheduleModal.hide();
+                    syncSchedule();
+                }, 1500);
+            } else {
+                addScheduleMessage.innerHTML = `<div class="alert alert-danger" role="alert">${result.body.message || 'Ошибка при добавлении занятия.'}</div>`;
+            }
+        })
+        .catch(error => {
+            console.error('Ошибка при добавлении занятия:', error);
+            addScheduleMessage.innerHTML = '<div class="alert alert-danger" role="alert">Произошла ошибка. Пожалуйста, попробуйте позже.</div>';
+        });
+    });
+});
@@ -0,0 +1,906 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from journal import ScheduleJournal, SharedSnapshotWriter, SnapshotFile, read_snapshot, write_json_atomic
+from registration_log import RegistrationLog
+from schedule_store import ClassFull, datetime_key
+from users_writer import GroupCommitWriter
+
+log = logging.getLogger(__name__)
+
+SCHEDULE_SAVE_SECONDS = metrics.histogram(
+    'fitness_schedule_save_seconds', 'Время полной записи расписания', ('storage',))
+SQLITE_TRANSACTION_SECONDS = metrics.histogram(
+    'fitness_sqlite_transaction_seconds', 'Время пишущей транзакции SQLite (с ожиданием блокировки)')
+
+
+# Участник с этим телефоном уже записан на занятие
+class AlreadyRegistered(Exception):
+    pass
+
+
+# Нормализованное время для сравнения и индексов (наивное UTC в ISO формате)
+def normalized_time(value):
+    return datetime_key(value).isoformat(timespec='microseconds')
+
+
+# Поля, без которых занятие из правленого вручную расписания не принимается
+CLASS_FIELDS = ('id', 'name', 'instructor', 'datetime', 'capacity')
+
+
+# Что не так с расписанием, прочитанным из файла (None — всё в порядке)
+def schedule_problem(schedule):
+    if not isinstance(schedule, list):
+        return "ожидается JSON-массив занятий."
+    seen = set()
+    for fitness_class in schedule:
+        if not isinstance(fitness_class, dict) or any(field not in fitness_class for field in CLASS_FIELDS):
+            return f"у занятия {fitness_class!r} нет полей {', '.join(CLASS_FIELDS)}."
+        class_id, capacity = fitness_class['id'], fitness_class['capacity']
+        if not isinstance(class_id, int) or not isinstance(capacity, int) or capacity < 0:
+            return f"у занятия {class_id!r} ID и вместимость должны быть целыми неотрицательными числами."
+        if class_id in seen:
+            return f"ID {class_id} встречается несколько раз."
+        seen.add(class_id)
+    return None
+
+
+# Интерфейс хранилища: где лежат расписание и регистрации.
+# ScheduleStore остаётся кэшем расписания в памяти, а хранилище отвечает
+# за долговременное сохранение и за выборки по истории регистраций.
+class Storage:
+    # Расписание из хранилища; None, если хранилище пустое
+    def load_schedule(self):
+        raise NotImplementedError
+
+    # Полная перезапись расписания
+    def save_schedule(self, schedule):
+        raise NotImplementedError
+
+    def add_class(self, fitness_class):
+        raise NotImplementedError
+
+    # Сохранение нескольких новых занятий одной записью
+    def add_classes(self, classes):
+        raise NotImplementedError
+
+    # Сохранение занятия, созданного из повторения шаблона при первой записи.
+    # Если занятие для этого повторения уже создал другой процесс, новое
+    # не сохраняется и возвращается существующее, иначе None.
+    def add_occurrence(self, fitness_class):
+        self.add_class(fitness_class)
+        return None
+
+    # Шаблоны повторяющихся занятий
+    def load_templates(self):
+        raise NotImplementedError
+
+    # Сохранение нового шаблона; ID выдаёт хранилище. Возвращает шаблон с ID.
+    def add_template(self, fields):
+        raise NotImplementedError
+
+    # Менялись ли шаблоны другими процессами с прошлой загрузки
+    def templates_changed(self):
+        return False
+
+    # Подготовка регистраций при старте; возвращает их число
+    def load_registrations(self):
+        raise NotImplementedError
+
+    # Надёжное сохранение регистрации вместе с занятым местом.
+    # Если registration_id равен None, ID выдаёт хранилище.
+    # ClassFull — мест нет по данным хранилища; AlreadyRegistered — участник
+    # с этим телефоном уже записан на занятие; другие исключения — сбой записи.
+    def add_registration(self, registration, fitness_class):
+        error = self.add_registrations([(registration, fitness_class)])[0]
+        if error is not None:
+            raise error
+
+    # Сохранение пакета регистраций (пары (регистрация, занятие)) одной записью.
+    # Возвращает список той же длины: None для сохранённой регистрации или
+    # исключение ClassFull / AlreadyRegistered для отклонённой. При сбое
+    # записи исключение относится ко всему пакету.
+    def add_registrations(self, items):
+        raise NotImplementedError
+
+    # Есть ли запись участника с этим телефоном на занятие
+    def has_registration(self, class_id, phone_number):
+        raise NotImplementedError
+
+    # Все записи участника по телефону в порядке записи
+    def member_registrations(self, phone_number):
+        raise NotImplementedError
+
+    # Сохранение счётчика после возврата места в памяти (при сбое записи)
+    def record_registered(self, fitness_class, delta):
+        raise NotImplementedError
+
+    def registration_count(self):
+        raise NotImplementedError
+
+    # Все регистрации в порядке записи
+    def iter_registrations(self):
+        raise NotImplementedError
+
+    # Выборка регистраций: пары (позиция, JSON-строка в байтах) начиная с позиции cursor
+    def query_registrations(self, cursor=0, class_id=None, phone_number=None, time_from=None, time_to=None):
+        raise NotImplementedError
+
+    # Перенос занятий и их регистраций в холодный архив (ColdArchive) с удалением
+    # из рабочих данных; возвращает (перенесённые занятия, число регистраций)
+    def archive_classes(self, classes):
+        raise NotImplementedError
+
+    # Текущее расписание в хранилище (для процессов, которым нужно
+    # узнать об изменениях, сделанных другими воркерами)
+    def read_schedule(self):
+        raise NotImplementedError
+
+    # Менялись ли данные другими процессами с прошлой проверки
+    def changed_externally(self):
+        return False
+
+    # Занятия, изменённые после прошлого вызова (или загрузки расписания), вместе
+    # с занятиями class_ids: (занятия, ID удалённых занятий). Для процессов,
+    # которым не нужно перечитывать ради этого всё расписание.
+    def read_changes(self, class_ids=()):
+        return [], []
+
+    # Расписание, изменённое вручную после последнего чтения или записи
+    # приложением: (занятия, ID исчезнувших из файла занятий) или None.
+    # Отслеживается только файловым хранилищем.
+    def read_edited_schedule(self):
+        return None
+
+    # Сохранение текущих счётчиков занятий, если в хранилище они другие
+    # (после перечитывания правленого расписания)
+    def record_counters(self, classes):
+        pass
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+# Файловое хранилище: schedule.json (+ журнал изменений) и users.txt
+class FileStorage(Storage):
+    def __init__(self, schedule_file, users_file, persistence_mode='journal', compact_threshold=1000,
+                 counters=None, snapshot_interval=5.0, batch_size=64, flush_interval=0.001,
+                 queue_size=10000, schedule_source=None, archive=None, templates_file=None):
+        self.schedule_file = schedule_file
+        self.snapshot = SnapshotFile(schedule_file)
+        # ID занятий в расписании с диска при последнем чтении: удалёнными из
+        # файла считаются только они, а не занятия, ещё не попавшие в журнал
+        self._file_class_ids = set()
+        self.templates_file = templates_file or os.path.join(os.path.dirname(schedule_file), 'templates.json')
+        self._templates_mtime = None
+        self._templates_lock = threading.Lock()
+        self.archive = archive
+        self.users_file = users_file
+        self.counters = counters
+        self.snapshot_interval = snapshot_interval
+        # Функция, возвращающая расписание из памяти (для режима полной перезаписи)
+        self.schedule_source = schedule_source
+        # Применение ручной правки schedule.json (проверка перечитывания): в режиме
+        # полной перезаписи вызывается перед записью снимка из памяти
+        self.apply_edit = None
+        if counters is not None:
+            self.journal = ScheduleJournal(schedule_file, shared=True, snapshot=self.snapshot)
+        elif persistence_mode == 'journal':
+            self.journal = ScheduleJournal(schedule_file, compact_threshold=compact_threshold, snapshot=self.snapshot)
+        else:
+            self.journal = None
+        self.registrations = RegistrationLog(users_file)
+        # Записи журнала о занятых местах сбрасываются на диск вместе с пакетом
+        # регистраций: после сбоя питания счётчики не отстают от users.txt
+        self.users_writer = GroupCommitWriter(users_file, batch_size=batch_size, flush_interval=flush_interval,
+                                              queue_size=queue_size, on_commit=self.registrations.index_batch,
+                                              before_commit=self.journal.sync if self.journal is not None else None)
+        self.snapshot_writer = None
+        self._registration_ids = None
+        self._ids_lock = threading.Lock()
+        # Пары (занятие, телефон), запись которых уже идёт: повторная запись
+        # отклоняется ещё до того, как первая попадёт в индекс
+        self._claims = set()
+        self._claims_lock = threading.Lock()
+
+    def load_schedule(self):
+        if not os.path.exists(self.schedule_file):
+            return None
+        self.snapshot.remember()
+        with open(self.schedule_file, 'r', encoding='utf-8') as f:
+            try:
+                schedule = json.load(f)
+                log.info("Загружено расписание из %s.", self.schedule_file)
+            except json.JSONDecodeError:
+                log.warning("Ошибка при загрузке schedule.json. Используется расписание по умолчанию.")
+                return []
+        if self.journal is not None:
+            replayed = self.journal.replay(schedule)
+            if replayed:
+                log.info("Применено %s записей журнала %s.", replayed, self.journal.journal_path)
+        self._file_class_ids = {fitness_class['id'] for fitness_class in schedule}
+        return schedule
+
+    def save_schedule(self, schedule):
+        with SCHEDULE_SAVE_SECONDS.time('files'):
+            self.snapshot.write(schedule)
+        self._file_class_ids = {fitness_class['id'] for fitness_class in schedule}
+
+    # Перезапись снимка расписанием из памяти (режим полной перезаписи). Правка
+    # schedule.json, которую проверка ещё не применила, сначала применяется,
+    # иначе перезапись стёрла бы её.
+    def _write_memory_schedule(self):
+        with self.snapshot.lock:
+            if self.apply_edit is not None and self.snapshot.edited():
+                self.apply_edit()
+            self.save_schedule(self.schedule_source())
+
+    # Проверка по признаку файла (inode, время изменения, размер) — без чтения;
+    # перечитывается снимок вместе с журналом, как при запуске. Файл, который
+    # не удалось разобрать (например, сохранён наполовину), пропускается до
+    # следующей правки.
+    def read_edited_schedule(self):
+        if not self.snapshot.edited():
+            return None
+        try:
+            if self.journal is not None:
+                schedule = self.journal.read_full()
+            else:
+                with self.snapshot.lock:
+                    self.snapshot.remember()
+                    schedule = read_snapshot(self.schedule_file)
+        except (OSError, ValueError) as e:
+            log.warning("Не удалось перечитать %s: %s", self.schedule_file, e)
+            return None
+        problem = schedule_problem(schedule)
+        if problem is not None:
+            log.warning("Правка %s не применена: %s", self.schedule_file, problem)
+            return None
+        class_ids = {fitness_class['id'] for fitness_class in schedule}
+        removed = self._file_class_ids - class_ids
+        self._file_class_ids = class_ids
+        return schedule, removed
+
+    # Живые счётчики записываются в журнал (в режиме полной перезаписи —
+    # всё расписание), чтобы перезапуск дал то же, что в памяти
+    def record_counters(self, classes):
+        if not classes or self.counters is not None:
+            return
+        if self.journal is not None:
+            self.journal.record_registered_many([(fitness_class, 0) for fitness_class in classes])
+        else:
+            self._write_memory_schedule()
+
+    def add_class(self, fitness_class):
+        self.add_classes([fitness_class])
+
+    def add_classes(self, classes):
+        if self.journal is not None:
+            self.journal.record_new_classes(classes)
+        else:
+            self._write_memory_schedule()
+
+    # Шаблоны и занятия из повторений, которые может создать и другой процесс,
+    # сохраняются под flock на templates.json.lock
+    @contextmanager
+    def _templates_file_lock(self):
+        with self._templates_lock:
+            with open(self.templates_file + '.lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # В режиме общих счётчиков занятие из повторения мог создать другой воркер:
+    # проверка по общему журналу под блокировкой
+    def add_occurrence(self, fitness_class):
+        if self.counters is None:
+            self.add_class(fitness_class)
+            return None
+        with self._templates_file_lock():
+            for existing in self.journal.read_schedule():
+                if existing.get('occurrence_id') == fitness_class['occurrence_id']:
+                    return existing
+            self.add_class(fitness_class)
+        return None
+
+    def load_templates(self):
+        # Время изменения — до чтения: запись между ними заметит следующая проверка
+        self._templates_mtime = os.stat(self.templates_file).st_mtime_ns if os.path.exists(self.templates_file) else None
+        return read_snapshot(self.templates_file)
+
+    # Шаблонов мало и меняются они редко: файл перезаписывается целиком
+    def add_template(self, fields):
+        with self._templates_file_lock():
+            templates = read_snapshot(self.templates_file)
+            template = {"id": max((t['id'] for t in templates), default=0) + 1, **fields}
+            templates.append(template)
+            write_json_atomic(self.templates_file, templates)
+        return template
+
+    # Шаблоны других процессов бывают только в режиме общих счётчиков
+    def templates_changed(self):
+        if self.counters is None:
+            return False
+        mtime = os.stat(self.templates_file).st_mtime_ns if os.path.exists(self.templates_file) else None
+        return mtime != self._templates_mtime
+
+    def load_registrations(self):
+        if os.path.exists(self.users_file):
+            added = self.registrations.load()
+            log.info("Загружено %s регистраций из %s (дочитано из файла: %s).", len(self.registrations), self.users_file, added)
+        else:
+            log.info("%s не существует. Создаётся новый файл.", self.users_file)
+        return len(self.registrations)
+
+    # Следующий свободный ID регистрации по users.txt и архиву
+    def next_registration_id(self):
+        archived = self.archive.last_registration_id() if self.archive is not None else 0
+        return max(self.registrations.last_id, archived) + 1
+
+    # Запуск сохранения снимков одним из процессов (режим общих счётчиков)
+    def start_snapshot_writer(self):
+        self.snapshot_writer = SharedSnapshotWriter(self.journal, self.counters, self.snapshot_interval).start()
+
+    def _allocate_registration_id(self):
+        if self.counters is not None:
+            return self.counters.allocate_registration_id()
+        with self._ids_lock:
+            if self._registration_ids is None:
+                self._registration_ids = self.next_registration_id()
+            registration_id = self._registration_ids
+            self._registration_ids += 1
+            return registration_id
+
+    # Места уже проверены в памяти, поэтому сохраняются все регистрации, кроме
+    # повторных: счётчики — одной записью в журнал, регистрации — одним куском
+    # users.txt через групповую фиксацию (возврат только после fsync её пакета)
+    def add_registrations(self, items):
+        results = []
+        accepted = []
+        claims = []
+        with self._claims_lock:
+            for registration, fitness_class in items:
+                phone_number = registration.get('phone_number')
+                if phone_number is not None:
+                    claim = (registration['class_id'], phone_number)
+                    if claim in self._claims or self.registrations.has_booking(*claim):
+                        results.append(AlreadyRegistered(registration['class_id']))
+                        continue
+                    self._claims.add(claim)
+                    claims.append(claim)
+                accepted.append((registration, fitness_class))
+                results.append(None)
+        try:
+            if accepted:
+                self._write_registrations(accepted)
+        finally:
+            # После записи пары уже есть в индексе регистраций
+            with self._claims_lock:
+                self._claims.difference_update(claims)
+        return results
+
+    def _write_registrations(self, items):
+        registrations = [registration for registration, _ in items]
+        for registration in registrations:
+            if registration.get('registration_id') is None:
+                registration['registration_id'] = self._allocate_registration_id()
+        if self.counters is None:
+            classes = {fitness_class['id']: fitness_class for _, fitness_class in items}
+            if self.journal is not None:
+                deltas = {}
+                for _, fitness_class in items:
+                    deltas[fitness_class['id']] = deltas.get(fitness_class['id'], 0) + 1
+                self.journal.record_registered_many([(classes[class_id], delta) for class_id, delta in deltas.items()])
+            else:
+                self._write_memory_schedule()
+        lines = [json.dumps(registration, ensure_ascii=False) + '\n' for registration in registrations]
+        self.users_writer.write_many(lines, registrations)
+
+    def has_registration(self, class_id, phone_number):
+        return self.registrations.has_booking(class_id, phone_number)
+
+    def member_registrations(self, phone_number):
+        return list(self.registrations.iter_member(phone_number))
+
+    # В режиме общих счётчиков значения уже лежат в общем файле
+    def record_registered(self, fitness_class, delta):
+        if self.counters is not None:
+            return
+        if self.journal is not None:
+            self.journal.record_registered(fitness_class, delta)
+        else:
+            self._write_memory_schedule()
+
+    def registration_count(self):
+        return len(self.registrations)
+
+    def iter_registrations(self):
+        return self.registrations.iter_all()
+
+    # Фильтры проверяются по столбцам индекса, с диска читаются только подходящие строки.
+    # В режиме общих счётчиков users.txt дописывают и другие процессы: индекс
+    # сначала дочитывает их строки, иначе аналитика увидела бы их места
+    # в счётчиках раньше, чем сами записи.
+    def query_registrations(self, cursor=0, class_id=None, phone_number=None, time_from=None, time_to=None):
+        if self.counters is not None:
+            self.registrations.refresh()
+        return self.registrations.scan(cursor, class_id, phone_number, time_from, time_to)
+
+    # Строки регистраций сначала сохраняются в архив, затем users.txt
+    # перезаписывается без них; запись новых регистраций на это время приостановлена.
+    # Регистрации, уже стоящие в очереди писателя, дописываются до паузы и
+    # уходят в архив вместе с остальными, а не остаются строками без занятия.
+    def archive_classes(self, classes):
+        class_ids = [fitness_class['id'] for fitness_class in classes]
+        with self.users_writer.paused():
+            lines = self.registrations.class_lines(class_ids)
+            self.archive.write(classes, lines, self.registrations.last_id)
+            self.registrations.drop_classes(class_ids)
+        if self.journal is not None:
+            self.journal.record_removed(class_ids)
+        else:
+            self._write_memory_schedule()
+        return classes, len(lines)
+
+    def read_schedule(self):
+        if self.journal is not None:
+            return self.journal.read_schedule()
+        return read_snapshot(self.schedule_file)
+
+    def stats(self):
+        return {"users_writer": self.users_writer.stats()}
+
+    def close(self):
+        self.users_writer.close()
+        self.registrations.save_index()
+        if self.journal is not None:
+            self.journal.close()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (id, version) VALUES (1, 0);
+
+CREATE TABLE IF NOT EXISTS archived (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_registration_id INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO archived (id, last_registration_id) VALUES (1, 0);
+
+CREATE TABLE IF NOT EXISTS classes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    instructor TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    starts_at TEXT NOT NULL,
+    capacity INTEGER NOT NULL,
+    registered INTEGER NOT NULL DEFAULT 0,
+    changed_version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS classes_starts_at ON classes (starts_at);
+
+-- Удалённые занятия (перенесённые в архив) с версией базы, в которой их удалили
+CREATE TABLE IF NOT EXISTS removed_classes (
+    id INTEGER PRIMARY KEY,
+    changed_version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS removed_classes_changed_version ON removed_classes (changed_version);
+
+CREATE TABLE IF NOT EXISTS templates (
+    id INTEGER PRIMARY KEY,
+    record TEXT NOT NULL
+);
+
+-- Занятия, созданные из повторений шаблонов: одно занятие на повторение
+CREATE TABLE IF NOT EXISTS occurrences (
+    occurrence_id TEXT PRIMARY KEY,
+    template_id INTEGER NOT NULL,
+    class_id INTEGER NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS registrations (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    registration_id INTEGER NOT NULL,
+    class_id INTEGER NOT NULL,
+    user_name TEXT,
+    phone_number TEXT,
+    registration_time TEXT,
+    registered_at TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS registrations_registration_id ON registrations (registration_id);
+CREATE INDEX IF NOT EXISTS registrations_class_id ON registrations (class_id, position);
+CREATE INDEX IF NOT EXISTS registrations_phone_number ON registrations (phone_number, position);
+CREATE INDEX IF NOT EXISTS registrations_registered_at ON registrations (registered_at);
+"""
+
+# Запросы заданы константами: sqlite3 держит их скомпилированными
+# в кэше подготовленных выражений соединения.
+# Изменённые занятия помечаются версией, которую получит текущая пишущая
+# транзакция (см. _write): другие процессы читают только занятия новее своей версии.
+CHANGE_VERSION = "(SELECT version + 1 FROM meta WHERE id = 1)"
+SELECT_CLASS_COLUMNS = """
+SELECT classes.id, name, instructor, datetime, capacity, registered, template_id, occurrence_id
+FROM classes LEFT JOIN occurrences ON occurrences.class_id = classes.id
+"""
+SELECT_CLASSES = SELECT_CLASS_COLUMNS + "ORDER BY classes.rowid"
+SELECT_OCCURRENCE = SELECT_CLASS_COLUMNS + "WHERE occurrence_id = ?"
+SELECT_CHANGED_CLASSES = SELECT_CLASS_COLUMNS + "WHERE classes.changed_version > ? ORDER BY classes.rowid"
+SELECT_REMOVED_CLASSES = "SELECT id FROM removed_classes WHERE changed_version > ?"
+INSERT_OCCURRENCE = "INSERT OR IGNORE INTO occurrences (occurrence_id, template_id, class_id) VALUES (?, ?, ?)"
+UPSERT_CLASS = f"""
+INSERT INTO classes (id, name, instructor, datetime, starts_at, capacity, registered, changed_version)
+VALUES (?, ?, ?, ?, ?, ?, ?, {CHANGE_VERSION})
+ON CONFLICT (id) DO UPDATE SET
+    name = excluded.name, instructor = excluded.instructor, datetime = excluded.datetime,
+    starts_at = excluded.starts_at, capacity = excluded.capacity, registered = excluded.registered,
+    changed_version = excluded.changed_version
+"""
+RESERVE_SEAT = f"""
+UPDATE classes SET registered = registered + 1, changed_version = {CHANGE_VERSION}
+WHERE id = ? AND registered < capacity
+"""
+# Пометка удаления для занятий из временной таблицы (kept_ids — все, кроме них)
+REMOVE_ARCHIVED = f"INSERT OR REPLACE INTO removed_classes (id, changed_version) SELECT id, {CHANGE_VERSION} FROM archive_ids"
+REMOVE_NOT_KEPT = f"""
+INSERT OR REPLACE INTO removed_classes (id, changed_version)
+SELECT id, {CHANGE_VERSION} FROM classes WHERE id NOT IN (SELECT id FROM kept_ids)
+"""
+# ID регистраций, перенесённых в архив, повторно не выдаются
+NEXT_REGISTRATION_ID = """
+SELECT MAX(COALESCE((SELECT MAX(registration_id) FROM registrations), 0),
+           (SELECT last_registration_id FROM archived WHERE id = 1)) + 1
+"""
+INSERT_REGISTRATION = """
+INSERT INTO registrations (registration_id, class_id, user_name, phone_number, registration_time, registered_at, record)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+REGISTRATION_EXISTS = """
+SELECT EXISTS (SELECT 1 FROM registrations WHERE class_id = ? AND phone_number = ?)
+"""
+SELECT_VERSION = "SELECT version FROM meta WHERE id = 1"
+UPDATE_VERSION = "UPDATE meta SET version = ? WHERE id = 1"
+
+
+def class_row(fitness_class):
+    return (fitness_class['id'], fitness_class['name'], fitness_class['instructor'], fitness_class['datetime'],
+            normalized_time(fitness_class['datetime']), fitness_class['capacity'], fitness_class['registered'])
+
+
+# Строка SELECT_CLASS_COLUMNS -> словарь занятия; поля шаблона — только у занятий из повторений
+def class_from_row(row):
+    fitness_class = {"id": row[0], "name": row[1], "instructor": row[2], "datetime": row[3],
+                     "capacity": row[4], "registered": row[5]}
+    if row[7] is not None:
+        fitness_class["template_id"] = row[6]
+        fitness_class["occurrence_id"] = row[7]
+    return fitness_class
+
+
+def registration_row(registration):
+    return (registration.get('registration_id', 0), registration.get('class_id'), registration.get('user_name'),
+            registration.get('phone_number'), registration.get('registration_time'),
+            normalized_time(registration.get('registration_time')),
+            json.dumps(registration, ensure_ascii=False))
+
+
+# Встроенная база SQLite (режим WAL): индексы по class_id, времени занятия
+# и регистрации, номеру телефона; бронирование места и запись регистрации —
+# одна транзакция. У каждого потока своё соединение.
+class SqliteStorage(Storage):
+    def __init__(self, path, synchronous='FULL', legacy_files=None, archive=None):
+        self.path = path
+        self.archive = archive
+        self.synchronous = synchronous
+        # (schedule.json, users.txt) для переноса в пустую базу при первом запуске
+        self.legacy_files = legacy_files
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._version_lock = threading.Lock()
+        self._known_version = None
+        # Версия базы, до которой изменения занятий уже прочитаны (read_changes)
+        self._synced_version = 0
+        self._connection().executescript(SQLITE_SCHEMA)
+        self._upgrade_schema()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                         check_same_thread=False, cached_statements=256)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    # Пишущая транзакция. Вместе с данными увеличивается версия базы; если до
+    # транзакции база была в известном этому процессу состоянии, версия
+    # остаётся известной, иначе следующая проверка увидит чужие изменения.
+    @contextmanager
+    def _write(self):
+        connection = self._connection()
+        began = time.perf_counter()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            version = connection.execute(SELECT_VERSION).fetchone()[0]
+            connection.execute(UPDATE_VERSION, (version + 1,))
+            with self._version_lock:
+                if self._known_version == version:
+                    self._known_version = version + 1
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            SQLITE_TRANSACTION_SECONDS.observe(time.perf_counter() - began)
+
+    # Базы, созданные до пометки изменённых занятий, получают столбец
+    # changed_version (0 у всех занятий: они прочитаны при загрузке)
+    def _upgrade_schema(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(classes)")}
+            if 'changed_version' not in columns:
+                connection.execute("ALTER TABLE classes ADD COLUMN changed_version INTEGER NOT NULL DEFAULT 0")
+            connection.execute("CREATE INDEX IF NOT EXISTS classes_changed_version ON classes (changed_version)")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _is_empty(self, connection):
+        has_classes = connection.execute("SELECT EXISTS (SELECT 1 FROM classes)").fetchone()[0]
+        has_registrations = connection.execute("SELECT EXISTS (SELECT 1 FROM registrations)").fetchone()[0]
+        has_templates = connection.execute("SELECT EXISTS (SELECT 1 FROM templates)").fetchone()[0]
+        return not has_classes and not has_registrations and not has_templates
+
+    def load_schedule(self):
+        connection = self._connection()
+        if self.legacy_files is not None and self._is_empty(connection):
+            schedule_file, users_file, templates_file = self.legacy_files
+            if os.path.exists(schedule_file) or os.path.exists(users_file):
+                self.migrate_from_files(schedule_file, users_file, templates_file)
+        with self._version_lock:
+            self._known_version = self._synced_version = connection.execute(SELECT_VERSION).fetchone()[0]
+        schedule = self.read_schedule()
+        if not schedule:
+            return None
+        log.info("Загружено расписание из %s.", self.path)
+        return schedule
+
+    def read_schedule(self):
+        return [class_from_row(row) for row in self._connection().execute(SELECT_CLASSES).fetchall()]
+
+    # Занятия вместе со связью с повторением шаблона
+    def _upsert_classes(self, connection, classes):
+        connection.executemany(UPSERT_CLASS, [class_row(fitness_class) for fitness_class in classes])
+        connection.executemany(INSERT_OCCURRENCE, [
+            (fitness_class['occurrence_id'], fitness_class['template_id'], fitness_class['id'])
+            for fitness_class in classes if 'occurrence_id' in fitness_class
+        ])
+
+    def save_schedule(self, schedule):
+        with SCHEDULE_SAVE_SECONDS.time('sqlite'), self._write() as connection:
+            self._upsert_classes(connection, schedule)
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS kept_ids (id INTEGER PRIMARY KEY)")
+            connection.execute("DELETE FROM kept_ids")
+            connection.executemany("INSERT INTO kept_ids (id) VALUES (?)", [(c['id'],) for c in schedule])
+            connection.execute(REMOVE_NOT_KEPT)
+            connection.execute("DELETE FROM classes WHERE id NOT IN (SELECT id FROM kept_ids)")
+            connection.execute("DELETE FROM occurrences WHERE class_id NOT IN (SELECT id FROM kept_ids)")
+
+    def add_class(self, fitness_class):
+        self.add_classes([fitness_class])
+
+    def add_classes(self, classes):
+        with self._write() as connection:
+            self._upsert_classes(connection, classes)
+
+    # Повторение занято первичным ключом occurrences: другой процесс мог успеть раньше
+    def add_occurrence(self, fitness_class):
+        with self._write() as connection:
+            row = connection.execute(SELECT_OCCURRENCE, (fitness_class['occurrence_id'],)).fetchone()
+            if row is not None:
+                return class_from_row(row)
+            self._upsert_classes(connection, [fitness_class])
+        return None
+
+    def load_templates(self):
+        rows = self._connection().execute("SELECT record FROM templates ORDER BY id")
+        return [json.loads(record) for (record,) in rows]
+
+    def add_template(self, fields):
+        with self._write() as connection:
+            template_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM templates").fetchone()[0]
+            template = {"id": template_id, **fields}
+            connection.execute("INSERT INTO templates (id, record) VALUES (?, ?)",
+                               (template_id, json.dumps(template, ensure_ascii=False)))
+        return template
+
+    def load_registrations(self):
+        count = self.registration_count()
+        log.info("В базе %s %s регистраций.", self.path, count)
+        return count
+
+    # Места и регистрации пакета — одна транзакция: регистрации на занятия без
+    # мест по данным базы (например, их заняли другие процессы) и повторные
+    # записи участника пропускаются
+    def add_registrations(self, items):
+        results = []
+        with self._write() as connection:
+            next_id = None
+            for registration, _ in items:
+                phone_number = registration.get('phone_number')
+                if phone_number is not None and connection.execute(
+                        REGISTRATION_EXISTS, (registration['class_id'], phone_number)).fetchone()[0]:
+                    results.append(AlreadyRegistered(registration['class_id']))
+                    continue
+                if connection.execute(RESERVE_SEAT, (registration['class_id'],)).rowcount == 0:
+                    results.append(ClassFull(registration['class_id']))
+                    continue
+                if registration.get('registration_id') is None:
+                    if next_id is None:
+                        next_id = connection.execute(NEXT_REGISTRATION_ID).fetchone()[0]
+                    registration['registration_id'] = next_id
+                    next_id += 1
+                connection.execute(INSERT_REGISTRATION, registration_row(registration))
+                results.append(None)
+        return results
+
+    # Транзакция регистрации откатывается целиком, сохранять нечего
+    def record_registered(self, fitness_class, delta):
+        pass
+
+    def has_registration(self, class_id, phone_number):
+        return bool(self._connection().execute(REGISTRATION_EXISTS, (class_id, phone_number)).fetchone()[0])
+
+    def member_registrations(self, phone_number):
+        rows = self._connection().execute(
+            "SELECT record FROM registrations WHERE phone_number = ? ORDER BY position", (phone_number,))
+        return [json.loads(record) for (record,) in rows]
+
+    def registration_count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM registrations").fetchone()[0]
+
+    def iter_registrations(self):
+        cursor = self._connection().execute("SELECT record FROM registrations ORDER BY position")
+        for (record,) in cursor:
+            yield json.loads(record)
+
+    # Позиция — rowid - 1, чтобы курсоры совпадали по смыслу с файловым хранилищем
+    def query_registrations(self, cursor=0, class_id=None, phone_number=None, time_from=None, time_to=None):
+        conditions = ["position > ?"]
+        params = [cursor]
+        if class_id is not None:
+            conditions.append("class_id = ?")
+            params.append(class_id)
+        if phone_number is not None:
+            conditions.append("phone_number = ?")
+            params.append(phone_number)
+        if time_from is not None:
+            conditions.append("registered_at >= ?")
+            params.append(time_from.isoformat(timespec='microseconds'))
+        if time_to is not None:
+            conditions.append("registered_at < ?")
+            params.append(time_to.isoformat(timespec='microseconds'))
+        sql = f"SELECT position, record FROM registrations WHERE {' AND '.join(conditions)} ORDER BY position"
+        for position, record in self._connection().execute(sql, params):
+            yield position - 1, record.encode('utf-8')
+
+    # Перенос одной транзакцией: занятия, уже перенесённые другим процессом,
+    # пропускаются; в архив попадают значения из базы
+    def archive_classes(self, classes):
+        with self._write() as connection:
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS archive_ids (id INTEGER PRIMARY KEY)")
+            connection.execute("DELETE FROM archive_ids")
+            connection.executemany("INSERT OR IGNORE INTO archive_ids (id) VALUES (?)",
+                                   [(fitness_class['id'],) for fitness_class in classes])
+            archived = [
+                class_from_row(row)
+                for row in connection.execute(
+                    SELECT_CLASS_COLUMNS + "WHERE classes.id IN (SELECT id FROM archive_ids) ORDER BY classes.rowid")
+            ]
+            if not archived:
+                return [], 0
+            lines = [record.encode('utf-8') + b'\n' for (record,) in connection.execute(
+                "SELECT record FROM registrations WHERE class_id IN (SELECT id FROM archive_ids) ORDER BY position")]
+            last_id = connection.execute(NEXT_REGISTRATION_ID).fetchone()[0] - 1
+            self.archive.write(archived, lines, last_id)
+            connection.execute("UPDATE archived SET last_registration_id = ? WHERE id = 1", (last_id,))
+            connection.execute(REMOVE_ARCHIVED)
+            connection.execute("DELETE FROM registrations WHERE class_id IN (SELECT id FROM archive_ids)")
+            connection.execute("DELETE FROM classes WHERE id IN (SELECT id FROM archive_ids)")
+            connection.execute("DELETE FROM occurrences WHERE class_id IN (SELECT id FROM archive_ids)")
+        return archived, len(lines)
+
+    # Версия базы только растёт: прочитанная раньше собственной транзакции
+    # этого процесса версия (меньше известной) — не чужое изменение
+    def changed_externally(self):
+        version = self._connection().execute(SELECT_VERSION).fetchone()[0]
+        with self._version_lock:
+            if self._known_version is not None and version <= self._known_version:
+                return False
+            self._known_version = version
+            return True
+
+    # Версия читается раньше занятий: изменения, закоммиченные до неё, уже
+    # видны запросу, а более новые просто прочитаются ещё раз в следующий раз
+    def read_changes(self, class_ids=()):
+        connection = self._connection()
+        with self._version_lock:
+            since = self._synced_version
+        version = connection.execute(SELECT_VERSION).fetchone()[0]
+        classes = [class_from_row(row) for row in connection.execute(SELECT_CHANGED_CLASSES, (since,))]
+        removed = [class_id for (class_id,) in connection.execute(SELECT_REMOVED_CLASSES, (since,))]
+        seen = {fitness_class['id'] for fitness_class in classes}
+        extra = [class_id for class_id in class_ids if class_id not in seen]
+        if extra:
+            placeholders = ', '.join('?' * len(extra))
+            classes += [class_from_row(row) for row in connection.execute(
+                SELECT_CLASS_COLUMNS + f"WHERE classes.id IN ({placeholders})", extra)]
+        with self._version_lock:
+            self._synced_version = max(self._synced_version, version)
+        return classes, removed
+
+    # Однократный перенос schedule.json (+ журнал), users.txt и templates.json в пустую базу
+    def migrate_from_files(self, schedule_file, users_file, templates_file=None, batch_size=10000):
+        classes = 0
+        registrations = 0
+        with self._write() as connection:
+            if not self._is_empty(connection):
+                raise RuntimeError(f"База {self.path} уже содержит данные.")
+            if os.path.exists(schedule_file):
+                schedule = read_snapshot(schedule_file)
+                ScheduleJournal(schedule_file).replay(schedule)
+                self._upsert_classes(connection, schedule)
+                classes = len(schedule)
+            if templates_file is not None and os.path.exists(templates_file):
+                connection.executemany("INSERT INTO templates (id, record) VALUES (?, ?)", [
+                    (template['id'], json.dumps(template, ensure_ascii=False))
+                    for template in read_snapshot(templates_file)
+                ])
+            if os.path.exists(users_file):
+                batch = []
+                with open(users_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            registration = json.loads(line)
+                        except json.JSONDecodeError:
+                            log.warning("Некорректная строка в users.txt, пропущена.")
+                            continue
+                        batch.append(registration_row(registration))
+                        if len(batch) >= batch_size:
+                            connection.executemany(INSERT_REGISTRATION, batch)
+                            registrations += len(batch)
+                            batch = []
+                if batch:
+                    connection.executemany(INSERT_REGISTRATION, batch)
+                    registrations += len(batch)
+        log.info("Перенесено в %s: занятий %s, регистраций %s.", self.path, classes, registrations)
+        return classes, registrations
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from recurrence import Recurrence, RecurringSchedule
+
+
+def test_daily_without_byday_yields_consecutive_days():
+    recurrence = Recurrence('2026-01-05T10:00:00', 'FREQ=DAILY')
+    days = [local.day for local in recurrence.occurrences(None, datetime(2026, 1, 16))]
+    assert days == list(range(5, 16))
+
+
+def test_daily_interval_skips_days():
+    recurrence = Recurrence('2026-01-05T10:00:00', 'FREQ=DAILY;INTERVAL=2;UNTIL=20260115')
+    assert [local.day for local in recurrence.occurrences()] == [5, 7, 9, 11, 13, 15]
+
+
+def test_weekly_without_byday_keeps_start_weekday():
+    recurrence = Recurrence('2026-01-05T10:00:00', 'FREQ=WEEKLY;UNTIL=20260131')
+    assert [local.day for local in recurrence.occurrences()] == [5, 12, 19, 26]
+
+
+def test_daily_occurrence_id_is_found():
+    schedule = RecurringSchedule([{"id": 1, "name": "Йога", "instructor": "Анна", "capacity": 10,
+                                   "datetime": "2026-01-05T10:00:00", "rrule": "FREQ=DAILY"}])
+    assert schedule.occurrence('1@2026-01-06T10:00:00') is not None
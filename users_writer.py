@@ -0,0 +1,248 @@
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+USERS_COMMIT_SECONDS = metrics.histogram(
+    'fitness_users_commit_seconds', 'Время записи пакета в users.txt (write + fsync)')
+USERS_BATCH_RECORDS = metrics.histogram(
+    'fitness_users_batch_records', 'Число элементов очереди в пакете записи users.txt',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+USERS_WRITE_SECONDS = metrics.histogram(
+    'fitness_users_write_latency_seconds', 'Задержка от постановки в очередь до подтверждения записи users.txt')
+
+
+# Ожидание подтверждения записи: одна или несколько строк, которые попадают
+# в файл подряд одним куском
+class PendingWrite:
+    __slots__ = ('data', 'records', 'sizes', 'offset', 'submitted', 'error', 'finished', 'cancelled', '_done')
+
+    def __init__(self, lines, records):
+        encoded = [line.encode('utf-8') for line in lines]
+        self.data = b''.join(encoded)
+        self.records = records
+        self.sizes = [len(line) for line in encoded]
+        self.offset = None
+        self.submitted = time.perf_counter()
+        self.error = None
+        # Исход известен (записано или ошибка) / запись отменена: оба меняются
+        # только под блокировкой фиксации писателя
+        self.finished = False
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Запись не подтверждена вовремя.")
+        if self.error is not None:
+            raise self.error
+        return self.offset
+
+
+# Остановка писателя в очереди: всё, что стоит перед ней, уже записано,
+# когда поток писателя до неё доходит; дальше он ждёт возобновления
+class PauseMark:
+    __slots__ = ('reached', 'resumed')
+
+    def __init__(self):
+        self.reached = threading.Event()
+        self.resumed = threading.Event()
+
+
+# Фоновый писатель users.txt с групповой фиксацией: строки из очереди
+# собираются в пакет и записываются одним write + fsync, а запрос получает
+# ответ только после того, как его пакет надёжно лёг на диск.
+# on_commit(start, batch) вызывается в потоке писателя после fsync пакета,
+# до подтверждения запросов, со смещением начала пакета в файле.
+# before_commit() вызывается перед записью пакета (например, fsync журнала
+# счётчиков); его ошибка — ошибка записи всего пакета.
+class GroupCommitWriter:
+    def __init__(self, path, batch_size=64, flush_interval=0.001, queue_size=10000, on_commit=None,
+                 before_commit=None):
+        self.path = path
+        self.on_commit = on_commit
+        self.before_commit = before_commit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Кроме PendingWrite в очереди бывают PauseMark и None (остановка)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._fd = None
+        # Держится на время записи пакета и его обработки (on_commit)
+        self._commit_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._records = 0
+        self._max_batch = 0
+        self._commit_seconds = 0.0
+        self._max_commit_seconds = 0.0
+        self._errors = 0
+        self._thread = threading.Thread(target=self._run, name='users-writer', daemon=True)
+        self._thread.start()
+
+    # Постановка нескольких строк одним элементом очереди: они не разрываются
+    # чужими записями и фиксируются одним пакетом. При переполненной очереди
+    # ждём не дольше timeout.
+    def submit_many(self, lines, records, timeout=1.0):
+        pending = PendingWrite(lines, records)
+        self._queue.put(pending, timeout=timeout)
+        return pending
+
+    # Запись нескольких строк с ожиданием fsync; возвращает смещение первой строки.
+    # Если подтверждения нет дольше timeout, запись отменяется и бросается
+    # TimeoutError — тогда строки в файл уже не попадут. Если отменить не
+    # удалось (пакет уже записан или пишется), ждём его исхода.
+    def write_many(self, lines, records, timeout=10.0):
+        pending = self.submit_many(lines, records)
+        try:
+            return pending.wait(timeout)
+        except TimeoutError:
+            if not self.cancel(pending):
+                return pending.wait()
+            raise
+
+    # Отмена записи, которая ещё не попала в пакет; False — исход уже решён
+    # (ждём, пока текущий пакет допишется)
+    def cancel(self, pending):
+        with self._commit_lock:
+            if pending.finished:
+                return False
+            pending.cancelled = True
+            return True
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and isinstance(batch[-1], PendingWrite):
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, data):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+        os.fsync(self._fd)
+        # При O_APPEND позиция после записи — конец нашего пакета
+        return os.lseek(self._fd, 0, os.SEEK_CUR) - len(data)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            last = batch[-1]
+            if not isinstance(last, PendingWrite):
+                batch.pop()
+            if batch:
+                self._flush(batch)
+            if last is None:
+                return
+            if isinstance(last, PauseMark):
+                last.reached.set()
+                last.resumed.wait()
+
+    def _flush(self, batch):
+        error = None
+        with self._commit_lock:
+            # Отменённые по таймауту записи выбрасываются из пакета
+            batch = [pending for pending in batch if not pending.cancelled]
+            if not batch:
+                return
+            data = b''.join(pending.data for pending in batch)
+            try:
+                with USERS_COMMIT_SECONDS.time():
+                    if self.before_commit is not None:
+                        self.before_commit()
+                    start = self._commit(data)
+            except Exception as e:
+                error = e
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+            else:
+                offset = start
+                for pending in batch:
+                    pending.offset = offset
+                    offset += len(pending.data)
+                if self.on_commit is not None:
+                    try:
+                        self.on_commit(start, batch)
+                    except Exception as e:
+                        log.error("Ошибка при обработке записанного пакета: %s", e)
+            for pending in batch:
+                pending.error = error
+                pending.finished = True
+        committed = time.perf_counter()
+        USERS_BATCH_RECORDS.observe(len(batch))
+        for pending in batch:
+            USERS_WRITE_SECONDS.observe(committed - pending.submitted)
+        with self._stats_lock:
+            self._batches += 1
+            self._records += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            if error is not None:
+                self._errors += 1
+            for pending in batch:
+                latency = committed - pending.submitted
+                self._commit_seconds += latency
+                self._max_commit_seconds = max(self._max_commit_seconds, latency)
+        for pending in batch:
+            pending._done.set()
+
+    # Приостановка записи (например, на время перезаписи файла): всё, что уже
+    # стоит в очереди, сначала дописывается, новые пакеты ждут в очереди,
+    # а после выхода файл открывается заново
+    @contextmanager
+    def paused(self):
+        mark = PauseMark()
+        self._queue.put(mark)
+        mark.reached.wait()
+        try:
+            with self._commit_lock:
+                try:
+                    yield
+                finally:
+                    if self._fd is not None:
+                        os.close(self._fd)
+                        self._fd = None
+        finally:
+            mark.resumed.set()
+
+    # Счётчики писателя: размер пакетов и задержка подтверждения записи
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "records": self._records,
+                "errors": self._errors,
+                "queued": self._queue.qsize(),
+                "avg_batch_size": self._records / self._batches if self._batches else 0.0,
+                "max_batch_size": self._max_batch,
+                "avg_commit_latency_ms": 1000 * self._commit_seconds / self._records if self._records else 0.0,
+                "max_commit_latency_ms": 1000 * self._max_commit_seconds
+            }
+
+    # Остановка: дописываем всё, что уже в очереди
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None